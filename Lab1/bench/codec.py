@@ -0,0 +1,42 @@
+"""Microbenchmark the JSON and binary CDProto encodings.
+
+Run from the Lab1 directory:
+
+    $ python3 -m bench.codec
+"""
+import argparse
+import timeit
+
+from src.protocol import CDProto
+
+
+def cases(msg):
+    json_payload = CDProto.encode_payload(msg, "json")
+    binary_payload = CDProto.encode_payload(msg, "binary")
+    return [
+        ("json encode", lambda: msg.__str__().encode("utf-8")),
+        ("json decode", lambda: CDProto.decode(json_payload)),
+        ("binary encode", lambda: CDProto.encode_payload(msg, "binary")),
+        ("binary decode", lambda: CDProto.decode(binary_payload).message),
+        ("binary route", lambda: CDProto.peek(binary_payload)),
+    ], len(json_payload), len(binary_payload)
+
+
+def main(sizes, number):
+    print(f"{'text':>6} {'case':<14} {'ns/op':>10}")
+    for size in sizes:
+        msg = CDProto.message("x" * size, "#benchmark")
+        runs, json_size, binary_size = cases(msg)
+        for name, run in runs:
+            elapsed = min(timeit.repeat(run, number=number, repeat=3))
+            print(f"{size:>6} {name:<14} {elapsed / number * 1e9:>10.0f}")
+        print(f"{size:>6} payload bytes: json {json_size}, binary {binary_size}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 256, 4096])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    main(args.sizes, args.number)
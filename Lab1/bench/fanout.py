@@ -0,0 +1,76 @@
+"""Benchmark broadcast fan-out against total connections and channel size.
+
+Run from the Lab1 directory:
+
+    $ python3 -m bench.fanout
+"""
+import argparse
+import time
+
+from src.protocol import CDProto, Connection
+from src.server import Server
+
+
+class NullSocket:
+    """Stands in for a client socket, taking and dropping everything sent to it."""
+
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def legacy_broadcast(server, msg):
+    """The old fan-out: scan every channel list of every connection."""
+    for k, v in server.data.items():
+        for channel in v:
+            if msg.channel == channel:
+                CDProto.send_msg(k, msg)
+
+
+def populate(server, connections, channel_size, channels_per_conn):
+    """Put channel_size conns in "#target" and spread the rest over other channels."""
+    for i in range(connections):
+        conn = Connection(NullSocket())
+        server.add(conn)
+        if i < channel_size:
+            server.join(conn, "#target")
+        for c in range(channels_per_conn):
+            server.join(conn, f"#c{(i + c) % 64}")
+
+
+def measure(fanout, server, msg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fanout(server, msg)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(connections, channel_sizes, channels_per_conn, repeat):
+    msg = CDProto.message("benchmark", "#target")
+    print(f"{'conns':>8} {'members':>8} {'indexed (us)':>14} {'scan (us)':>12}")
+    for total in connections:
+        for size in channel_sizes:
+            if size > total:
+                continue
+            server = Server(port=0)
+            populate(server, total, size, channels_per_conn)
+            indexed = measure(Server.broadcast, server, msg, repeat)
+            scan = measure(legacy_broadcast, server, msg, repeat)
+            print(f"{total:>8} {size:>8} {indexed * 1e6:>14.1f} {scan * 1e6:>12.1f}")
+            server.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--channel-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--channels-per-conn", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args.connections, args.channel_sizes, args.channels_per_conn, args.repeat)
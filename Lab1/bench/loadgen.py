@@ -0,0 +1,141 @@
+"""Load generator and latency benchmark for a running chat server.
+
+Opens many CDProto clients over asyncio, spreads them over channels and
+publishes at a target rate, then reports the connection setup rate, the
+end-to-end delivery latency percentiles and the throughput. Run from the
+Lab1 directory against a server started separately:
+
+    $ python3 server.py &
+    $ python3 -m bench.loadgen --clients 2000 --channels 10 --rate 2000
+
+With --max-p99 the exit status is 1 when p99 latency goes over the bound,
+so the benchmark can gate changes.
+"""
+import argparse
+import asyncio
+import random
+import resource
+import sys
+import time
+import uuid
+
+from src.aio import AsyncClient
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def channel_of(i, channels, distribution):
+    """Channel of client i: round robin, or skewed so that channel k has ~1/(k+1) of the clients."""
+    if distribution == "zipf":
+        return f"#bench{random.choices(range(channels), weights=[1 / (k + 1) for k in range(channels)])[0]}"
+    return f"#bench{i % channels}"
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.run = uuid.uuid4().hex[:8]  #tells this run's messages from replayed history
+        self.latencies = []
+        self.delivered = 0
+        self.published = 0
+
+    async def open(self, i, limit):
+        async with limit:
+            client = AsyncClient(f"bench{i}", self.args.host, self.args.port, self.args.encoding, self.args.framing)
+            await client.connect()
+            await client.join(channel_of(i, self.args.channels, self.args.distribution))
+            return client
+
+    async def receive(self, client):
+        prefix = f"{self.run} "
+        async for msg in client.messages():
+            text = msg.message
+            if text.startswith(prefix):
+                self.latencies.append(time.perf_counter_ns() - int(text[len(prefix):].split(" ", 1)[0]))
+                self.delivered += 1
+
+    async def publish(self, client, rate, until):
+        padding = " " + "x" * self.args.size
+        interval = 1 / rate
+        next_send = time.perf_counter() + random.random() * interval  #spread the publishers
+        while next_send < until:
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+            await client.message(f"{self.run} {time.perf_counter_ns()}{padding}")
+            self.published += 1
+            next_send += interval
+
+    async def main(self):
+        args = self.args
+        limit = asyncio.Semaphore(args.concurrency)
+        start = time.perf_counter()
+        clients = await asyncio.gather(*(self.open(i, limit) for i in range(args.clients)))
+        setup = time.perf_counter() - start
+
+        readers = [asyncio.ensure_future(self.receive(c)) for c in clients]
+        await asyncio.sleep(args.settle)  #let the server process the joins
+
+        publishers = clients[:args.publishers]
+        start = time.perf_counter()
+        until = start + args.duration
+        await asyncio.gather(*(self.publish(c, args.rate / len(publishers), until) for c in publishers))
+        await asyncio.sleep(args.drain)
+        elapsed = time.perf_counter() - start
+
+        for r in readers:
+            r.cancel()
+        for c in clients:
+            c.writer.close()
+        return setup, elapsed
+
+    def report(self, setup, elapsed):
+        args = self.args
+        latencies = sorted(self.latencies)
+        p50, p99, p999 = (percentile(latencies, f) / 1e6 for f in (0.5, 0.99, 0.999))
+        print(f"connections      {args.clients} in {setup:.2f}s ({args.clients / setup:.0f}/s)")
+        print(f"published        {self.published} ({self.published / args.duration:.0f} msg/s)")
+        print(f"delivered        {self.delivered} ({self.delivered / elapsed:.0f} msg/s)")
+        print(f"latency (ms)     p50 {p50:.2f}  p99 {p99:.2f}  p999 {p999:.2f}  max {latencies[-1] / 1e6 if latencies else float('nan'):.2f}")
+        return p99
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, needed), hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform")
+    parser.add_argument("--publishers", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=500, help="messages per second over all publishers")
+    parser.add_argument("--size", type=int, default=32, help="bytes of padding per message")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--settle", type=float, default=1)
+    parser.add_argument("--drain", type=float, default=1)
+    parser.add_argument("--concurrency", type=int, default=100, help="connections opened at once")
+    parser.add_argument("--encoding", choices=["json", "binary"], default="json")
+    parser.add_argument("--framing", type=int, choices=[1, 2], default=1)
+    parser.add_argument("--uvloop", default=False, action="store_true")
+    parser.add_argument("--max-p99", type=float, help="fail when p99 latency (ms) is above this")
+    args = parser.parse_args()
+    args.publishers = max(1, min(args.publishers, args.clients))
+
+    raise_fd_limit(args.clients + 64)
+    if args.uvloop:
+        import uvloop
+        uvloop.install()
+
+    test = LoadTest(args)
+    p99 = test.report(*asyncio.run(test.main()))
+    if args.max_p99 is not None and not p99 <= args.max_p99:
+        sys.exit(f"p99 latency {p99:.2f}ms is above {args.max_p99}ms")
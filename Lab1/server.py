@@ -1,6 +1,39 @@
-from src.server import Server
+import argparse
+import signal
+
+from src.history import HISTORY_BYTES, HISTORY_LENGTH
+from src.server import COALESCE_BYTES, Server, SELECTORS
 
 if __name__ == "__main__":
-    s = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--uvloop", default=False, action="store_true", help="run the asyncio engine on uvloop")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--workers", type=int, default=1, help="server processes sharing the port (selectors engine)")
+    parser.add_argument("--history", type=int, default=HISTORY_LENGTH, help="messages replayed per channel on join")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES, help="bytes of frames kept per channel")
+    parser.add_argument("--selector", choices=sorted(SELECTORS), help="selectors implementation (default: the platform's best)")
+    parser.add_argument("--instrument", default=False, action="store_true", help="time the event loop; kill -USR1 logs the stats")
+    parser.add_argument("--coalesce-ms", type=float, help="gather frames for each client for up to this many ms (selectors engine)")
+    parser.add_argument("--coalesce-bytes", type=int, default=COALESCE_BYTES, help="send gathered frames once this many bytes wait")
+    args = parser.parse_args()
+    options = {"history": args.history, "history_bytes": args.history_bytes, "selector": args.selector, "instrument": args.instrument,
+               "coalesce_delay": None if args.coalesce_ms is None else args.coalesce_ms / 1000, "coalesce_bytes": args.coalesce_bytes}
+
+    if args.engine == "asyncio":
+        from src.aio import AsyncServer
+
+        if args.uvloop:
+            import uvloop
+            uvloop.install()
+        AsyncServer(args.host, args.port, history=args.history, history_bytes=args.history_bytes).loop()
+    elif args.workers > 1:
+        from src.cluster import run_cluster
+
+        run_cluster(args.workers, args.host, args.port, **options)
+    else:
+        s = Server(args.host, args.port, **options)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: s.report())  #kill -USR1 logs memory use (and loop stats) to server.log
 
-    s.loop()
+        s.loop()
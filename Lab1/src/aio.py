@@ -0,0 +1,214 @@
+"""CD Chat server and client on asyncio streams."""
+import asyncio
+import logging
+import sys
+
+from .history import ChannelHistory, HISTORY_BYTES, HISTORY_LENGTH
+from .protocol import CDProto, CDProtoBadFormat, FrameBuffer, MAX_FRAME, RECV_SIZE
+from .server import ChannelIndex, HIGH_WATER
+
+
+class Peer:
+    """A client connected to the AsyncServer."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = FrameBuffer(stream_threshold=MAX_FRAME)  #large frames are assembled, not streamed
+        self.encoding = "json"
+
+    @property
+    def framing(self) -> int:
+        return self.buffer.framing
+
+    def __repr__(self):
+        return f"Peer({self.writer.get_extra_info('peername')})"
+
+
+class AsyncServer(ChannelIndex):
+    """Chat Server on asyncio.start_server, with the semantics of Server.
+
+    Each client is served by its own task. After handling what it read, the
+    task awaits drain() on its own writer, so a client that does not read
+    its messages is not read from either. Broadcasts only write() to the
+    members; a member whose transport buffer goes past high_water is
+    disconnected, or with slow_policy="drop" misses the frame. Channel
+    history is replayed on join as in Server.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 5555, high_water: int = HIGH_WATER, slow_policy: str = "disconnect",
+                 history: int = HISTORY_LENGTH, history_bytes: int = HISTORY_BYTES):
+        if slow_policy not in ("disconnect", "drop"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_policy}")
+        super().__init__()
+        self.history = ChannelHistory(history, history_bytes)
+        self.host = host
+        self.port = port
+        self.high_water = high_water
+        self.slow_policy = slow_policy
+        self.server = None
+
+    async def start(self):
+        """Start listening; returns the asyncio Server."""
+        self.server = await asyncio.start_server(self.serve, self.host, self.port, backlog=100)
+        return self.server
+
+    async def serve(self, reader, writer):
+        """Serve one client until it disconnects."""
+        peer = Peer(reader, writer)
+        writer.transport.set_write_buffer_limits(high=self.high_water)
+        self.add(peer)
+        logging.debug("Client %s detected", peer)
+        try:
+            while peer in self.data:
+                chunk = await reader.read(RECV_SIZE)
+                if not chunk:
+                    break
+                peer.buffer.feed(chunk)
+                while peer.buffer.has_frame():
+                    try:
+                        data = CDProto.decode(peer.buffer.next_frame())
+                    except CDProtoBadFormat:
+                        logging.warning("Dropping badly formatted frame from %s", peer)
+                        continue
+                    if data is not None:
+                        self.handle(peer, data)
+                if peer in self.data:
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.disconnect(peer)
+
+    def handle(self, peer, data):
+        """Process one message received from peer."""
+        if data.command == "register":
+            peer.encoding = data.encoding
+        elif data.command == "join":
+            if data.channel not in self.data[peer]:
+                self.join(peer, data.channel)
+                frames = self.history.replay(data.channel, peer.encoding, peer.framing)
+                if frames:
+                    self.write(peer, frames)
+        elif data.command == "message":
+            self.broadcast(data)
+
+    def broadcast(self, msg):
+        """Send msg to every member of msg.channel, encoding it only once per wire encoding."""
+        frames = {}
+        for peer in tuple(self.members(msg.channel)):
+            wire = (peer.encoding, peer.framing)
+            frame = frames.get(wire)
+            if frame is None:
+                try:
+                    frame = frames[wire] = CDProto.encode_msg(msg, *wire)
+                except CDProtoBadFormat:  #too large for this peer's framing
+                    logging.warning("Message too large for %s", peer)
+                    continue
+            self.write(peer, frame)
+        self.history.record(msg, frames)
+
+    def write(self, peer, frame):
+        """Write an encoded frame to peer, applying the slow consumer policy."""
+        transport = peer.writer.transport
+        if transport.get_write_buffer_size() + len(frame) > self.high_water:
+            if self.slow_policy == "drop":
+                logging.warning("Dropping frame for slow consumer %s", peer)
+            else:
+                logging.warning("Disconnecting slow consumer %s", peer)
+                self.disconnect(peer)
+            return
+        peer.writer.write(frame)
+
+    def disconnect(self, peer):
+        """Forget peer and close its connection."""
+        if peer not in self.data:
+            return
+        self.remove(peer)
+        peer.writer.close()
+        logging.debug("%s logged out", peer)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def loop(self):
+        """Loop indefinetely."""
+        asyncio.run(self.serve_forever())
+
+
+class AsyncClient:
+    """Chat Client on asyncio streams, with the commands of Client."""
+
+    def __init__(self, name: str = "Foo", host: str = "localhost", port: int = 5555, encoding: str = "json", framing: int = 1):
+        self.name = name
+        self.encoding = encoding
+        self.framing = framing
+        self.host = host
+        self.port = port
+        self.channel = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """Connect to chat server and register."""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.framing != 1:
+            self.writer.write(CDProto.preamble(self.framing))
+        await self.send(CDProto.register(self.name, self.encoding))
+
+    async def send(self, msg):
+        self.writer.write(CDProto.encode_msg(msg, self.encoding, self.framing))
+        await self.writer.drain()
+
+    async def join(self, channel: str):
+        await self.send(CDProto.join(channel))
+        self.channel = channel
+
+    async def message(self, text: str):
+        await self.send(CDProto.message(text, self.channel))
+
+    async def messages(self):
+        """Yields every message received until the server closes the connection."""
+        buffer = FrameBuffer(stream_threshold=MAX_FRAME, framing=self.framing)
+        while True:
+            chunk = await self.reader.read(RECV_SIZE)
+            if not chunk:
+                return
+            buffer.feed(chunk)
+            for frame in iter(buffer.next_frame, None):
+                msg = CDProto.decode(frame)
+                if msg is not None:
+                    yield msg
+
+    async def read(self):
+        async for msg in self.messages():
+            print(f"\r< {msg.message}")
+
+    async def keyboard_input(self):
+        """Screening the input keyboard data."""
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            user_input = line.strip()
+            if not line or user_input == "exit":  #end of input or shutdown the client
+                return
+            if user_input.startswith("/join "):
+                await self.join(user_input[6:])
+                print(f"Joined to Channel: {self.channel}")
+            elif user_input:
+                await self.message(user_input)
+
+    async def run(self):
+        await self.connect()
+        reader = asyncio.ensure_future(self.read())
+        await self.keyboard_input()
+        reader.cancel()
+        self.writer.close()
+
+    def loop(self):
+        """Loop until the user leaves."""
+        asyncio.run(self.run())
+        sys.exit(f"Client {self.name} is leaving the chat!")
@@ -6,7 +6,8 @@ import selectors
 import fcntl
 import os
 
-from .protocol import CDProto, CDProtoBadFormat
+from .protocol import CDProto, CDProtoBadFormat, Coalescer, FrameBuffer, MAX_FRAME, RECV_SIZE
+from .stats import Histogram
 
 logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
 
@@ -14,9 +15,21 @@ logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
 class Client:
     """Chat Client process."""
 
-    def __init__(self, name: str = "Foo"):
-        """Initializes chat client."""
+    def __init__(self, name: str = "Foo", encoding: str = "json", coalesce_delay: float = None, coalesce_bytes: int = 16 * 1024, framing: int = 1):
+        """Initializes chat client.
+
+        With coalesce_delay (seconds) messages are gathered and sent together
+        once the delay passes or coalesce_bytes are waiting. framing 2 lets
+        messages (both ways) be larger than the 64 KiB of version 1 frames.
+        """
         self.name = name     #Registering the client name
+        self.encoding = encoding  #wire encoding asked for when registering
+        self.framing = framing
+        self.buffer = FrameBuffer(stream_threshold=MAX_FRAME, framing=framing)  #large frames are assembled, not streamed
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+        self.sends = Histogram()  #frames per sendmsg call when coalescing
+        self.out = None  #where messages are sent: the socket or its Coalescer
         self.channel = None  #Inicially the client starts on the main channel
         self.selector = selectors.DefaultSelector() # creating the selector
 
@@ -24,40 +37,56 @@ class Client:
         """Connect to chat server and setup stdin flags."""
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect(("localhost", 5555))
+        self.out = self.sock
+        if self.coalesce_delay is not None:
+            self.out = Coalescer(self.sock, self.coalesce_delay, self.coalesce_bytes, self.sends)
+        if self.framing != 1:
+            self.out.sendall(CDProto.preamble(self.framing))
+        CDProto.send_msg(self.out, CDProto.register(self.name, self.encoding), framing=self.framing)
         self.selector.register(self.sock, selectors.EVENT_READ, self.read) #Client waits for something to read
         
 
     def read(self, conn, mask):
-        recieved = CDProto.recv_msg(self.sock)  
-
-        if recieved:
-            print(f"\r< {recieved.message}")
-        else:
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
             self.selector.unregister(conn)
             conn.close()
+            return
+        self.buffer.feed(data)
+        for frame in iter(self.buffer.next_frame, None):
+            try:
+                recieved = CDProto.decode(frame)
+            except CDProtoBadFormat:
+                logging.warning("Dropping badly formatted frame")
+                continue
+            if recieved:
+                print(f"\r< {recieved.message}")
 
     def keyboard_input(self, stdin, mask):
         """Screening the input keyboard data. """
         user_input = stdin.read().strip()       # lê a mensagem do user e retira o \n do fim 
         
         if user_input == 'exit':  #shutdown the client
+            if self.out is not self.sock:
+                self.out.flush()
+                logging.info("Frames per send: %s", self.sends.summary())
             self.sock.close()
             sys.exit(f"Client {self.name} is leaving the chat!")
             
         elif user_input[0:6] == '/join ':
             user_input = user_input[6:]
             join_msg = CDProto.join(user_input)
-            CDProto.send_msg(self.sock, join_msg)
+            CDProto.send_msg(self.out, join_msg, self.encoding, self.framing)
             self.channel = user_input
             print(f"Joined to Channel: {self.channel}")
             
         else: #TextMessage
             if self.channel:
                 std_msg = CDProto.message(user_input, self.channel)
-                CDProto.send_msg(self.sock, std_msg)
+                CDProto.send_msg(self.out, std_msg, self.encoding, self.framing)
             else:
                 std_msg = CDProto.message(user_input)
-                CDProto.send_msg(self.sock, std_msg)
+                CDProto.send_msg(self.out, std_msg, self.encoding, self.framing)
 
     def loop(self):
         """Loop indefinetely."""
@@ -70,6 +99,9 @@ class Client:
             sys.stdout.write('-> ')
             sys.stdout.flush()
             
-            for key, mask in self.selector.select():
+            timeout = None if self.out is self.sock else self.out.timeout()
+            for key, mask in self.selector.select(timeout):
                 callback = key.data
-                callback(key.fileobj, mask)
\ No newline at end of file
+                callback(key.fileobj, mask)
+            if self.out is not self.sock:
+                self.out.poll()
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""Run the chat server as several processes sharing one port."""
+from collections import deque
+import logging
+import multiprocessing
+import os
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+
+from .server import Server
+
+#Datagrams that may wait for a busy peer; past this new broadcasts for it are dropped
+MAX_QUEUED = 10000
+
+#Bytes of a broadcast per datagram: larger ones are sent in fragments
+BUS_DATAGRAM = 64 * 1024
+
+#Head of every datagram: index of the worker sending it and whether more fragments of its broadcast follow
+FRAGMENT = struct.Struct(">H?")
+
+
+class Bus:
+    """Unix datagram bus between the server processes of a cluster.
+
+    Worker i owns the socket worker-i.sock in path, and sends to each peer on
+    a socket connected to that peer's. A broadcast is published to every peer
+    as the message in a binary CDProto payload, which carries the channel in
+    its header (CDProto.encode_bus puts names too long for it in front),
+    split in fragments of BUS_DATAGRAM bytes; the datagrams from one peer
+    arrive in order, so the fragments of each sender are simply joined back.
+
+    A peer whose socket is full (it takes net.unix.max_dgram_qlen datagrams)
+    gets its datagrams queued, in order, and sent when the selector given by
+    the Server reports the connected socket writable again.
+    """
+
+    def __init__(self, path: str, index: int, workers: int, max_queued: int = MAX_QUEUED):
+        self.peers = [os.path.join(path, f"worker-{i}.sock") for i in range(workers) if i != index]
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(os.path.join(path, f"worker-{index}.sock"))
+        self.sock.setblocking(False)
+        self.index = index
+        self.max_queued = max_queued
+        self.selector = None  #set by Server.attach(), to wait for busy peers
+        self.links = {}  #Dictorary: Key = peer, Value = socket connected to it
+        self.queues = {}  #Dictorary: Key = socket of a busy peer, Value = deque of the datagrams it did not take yet
+        self.partial = {}  #Dictorary: Key = index of a peer, Value = fragments of its broadcast received so far
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def link(self, peer):
+        """Socket connected to peer, connecting it the first time."""
+        sock = self.links.get(peer)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(peer)
+            except OSError:
+                sock.close()
+                raise
+            self.links[peer] = sock
+        return sock
+
+    def publish(self, payload: bytes):
+        """Send an encoded payload to every peer, queueing it for the busy ones."""
+        datagrams = [
+            FRAGMENT.pack(self.index, start + BUS_DATAGRAM < len(payload)) + payload[start:start + BUS_DATAGRAM]
+            for start in range(0, max(len(payload), 1), BUS_DATAGRAM)
+        ]
+        for peer in self.peers:
+            try:
+                sock = self.link(peer)
+            except (FileNotFoundError, ConnectionRefusedError):  #peer not up yet
+                logging.warning("Bus dropped a broadcast for %s", peer)
+                continue
+            queue = self.queues.get(sock)
+            if queue is not None:  #behind the ones already waiting
+                if len(queue) + len(datagrams) > self.max_queued:
+                    logging.warning("Bus dropped a broadcast for %s", peer)
+                else:
+                    queue.extend(datagrams)
+                continue
+            for sent, datagram in enumerate(datagrams):
+                try:
+                    sock.send(datagram)
+                except BlockingIOError:
+                    self.queues[sock] = deque(datagrams[sent:])
+                    self.selector.register(sock, selectors.EVENT_WRITE, self.flush)
+                    break
+                except ConnectionRefusedError:  #peer gone: connect again next time
+                    self.unlink(peer)
+                    logging.warning("Bus dropped a broadcast for %s", peer)
+                    break
+
+    def flush(self, sock, mask):
+        """Send the datagrams queued for a peer, as many as it takes."""
+        queue = self.queues[sock]
+        while queue:
+            try:
+                sock.send(queue[0])
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:  #peer gone
+                peer = next(peer for peer, link in self.links.items() if link is sock)
+                logging.warning("Bus dropped %d datagrams for %s", len(queue), peer)
+                self.unlink(peer)
+                return
+            queue.popleft()
+        del self.queues[sock]
+        self.selector.unregister(sock)
+
+    def unlink(self, peer):
+        """Forget the socket connected to peer, and whatever was queued for it."""
+        sock = self.links.pop(peer)
+        if self.queues.pop(sock, None) is not None:
+            self.selector.unregister(sock)
+        sock.close()
+
+    def receive(self):
+        """Yields the payload of every broadcast whose datagrams are all waiting on the bus."""
+        while True:
+            try:
+                datagram = self.sock.recv(FRAGMENT.size + BUS_DATAGRAM)
+            except BlockingIOError:
+                return
+            if len(datagram) < FRAGMENT.size:
+                continue
+            index, more = FRAGMENT.unpack_from(datagram)
+            fragments = self.partial.setdefault(index, [])
+            fragments.append(datagram[FRAGMENT.size:])
+            if not more:
+                del self.partial[index]
+                yield b"".join(fragments)
+
+    def close(self):
+        for peer in list(self.links):
+            self.unlink(peer)
+        self.sock.close()
+
+
+def worker(path: str, index: int, workers: int, host: str, port: int, options: dict):
+    """Serve clients in one process of the cluster."""
+    s = Server(host, port, reuse_port=True, **options)
+    s.attach(Bus(path, index, workers))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: s.report())
+    s.loop()
+
+
+def run_cluster(workers: int, host: str = "localhost", port: int = 5555, **options):
+    """Start workers server processes on the same port and wait for them.
+
+    options are passed on to every Server.
+    """
+    path = tempfile.mkdtemp(prefix="cdchat-")
+    processes = [
+        multiprocessing.Process(target=worker, args=(path, i, workers, host, port, options), daemon=True)
+        for i in range(workers)
+    ]
+    try:
+        for p in processes:
+            p.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  #still clean up the workers when terminated
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            p.terminate()
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,92 @@
+"""Recent messages of each channel, kept encoded for replay."""
+from collections import deque
+
+from .protocol import BinaryTextMessage, CDProto, CDProtoBadFormat
+
+#Messages and bytes of encoded frames kept per channel by default
+HISTORY_LENGTH = 20
+HISTORY_BYTES = 64 * 1024
+
+
+class ChannelHistory:
+    """Bounded ring of the last messages broadcast on each channel.
+
+    Each entry keeps the frames the broadcast already encoded, one per wire
+    (encoding, framing), so replaying it to a joining client only encodes a
+    message again when nobody with that wire was in the channel. A channel
+    keeps at most length messages and max_bytes bytes of frames, counting
+    those replay() adds and the text of messages kept without frames (always
+    at least its last message). A message larger than max_bytes by itself is
+    not recorded, and neither is the main channel 'None', since nobody joins
+    it.
+    """
+
+    def __init__(self, length: int = HISTORY_LENGTH, max_bytes: int = HISTORY_BYTES):
+        self.length = length
+        self.max_bytes = max_bytes
+        self.channels = {}  #Dictorary: Key = channel, Value = deque of [msg, frames, size]
+        self.sizes = {}     #Dictorary: Key = channel, Value = bytes of frames kept
+
+    def record(self, msg, frames: dict):
+        """Keep msg and its frames (Key = (encoding, framing), Value = frame)."""
+        channel = msg.channel
+        if not self.keeps(channel, min(map(len, frames.values())) if frames else raw_size(msg)):
+            return
+        if not frames:  #nobody got it: store it encoded for legacy clients anyway
+            try:
+                frames = {("json", 1): CDProto.encode_msg(msg)}
+            except CDProtoBadFormat:  #too large for them: kept as is, replay() encodes it for the wires that carry it
+                pass
+        ring = self.channels.get(channel)
+        if ring is None:
+            ring = self.channels[channel] = deque()
+            self.sizes[channel] = 0
+        size = sum(len(frame) for frame in frames.values()) if frames else raw_size(msg)
+        ring.append([msg, dict(frames), size])
+        self.sizes[channel] += size
+        self.evict(channel)
+
+    def keeps(self, channel, size: int) -> bool:
+        """Whether a message of size bytes on channel would be recorded."""
+        return self.length > 0 and channel is not None and size <= self.max_bytes
+
+    def evict(self, channel):
+        """Drop the oldest messages of channel while it keeps more than length messages or max_bytes bytes."""
+        ring = self.channels[channel]
+        while len(ring) > self.length or (self.sizes[channel] > self.max_bytes and len(ring) > 1):
+            self.sizes[channel] -= ring.popleft()[2]
+
+    def replay(self, channel, encoding: str = "json", framing: int = 1) -> bytes:
+        """The frames kept for channel, joined into one buffer for a single write."""
+        frames = []
+        grown = False
+        for entry in self.channels.get(channel, ()):
+            msg, cache = entry[0], entry[1]
+            frame = cache.get((encoding, framing))
+            if frame is None:
+                try:
+                    frame = cache[(encoding, framing)] = CDProto.encode_msg(msg, encoding, framing)
+                except CDProtoBadFormat:
+                    continue
+                entry[2] += len(frame)
+                self.sizes[channel] += len(frame)
+                grown = True
+            frames.append(frame)
+        if grown:  #the frames cached for this wire count against max_bytes too
+            self.evict(channel)
+        return b"".join(frames)
+
+    def report(self) -> dict:
+        """Messages and bytes kept per channel."""
+        return {channel: {"messages": len(ring), "bytes": self.sizes[channel]} for channel, ring in self.channels.items()}
+
+    def memory(self) -> int:
+        """Bytes of frames (or of messages kept without any) over all channels."""
+        return sum(self.sizes.values())
+
+
+def raw_size(msg) -> int:
+    """Bytes of the text a message kept without frames holds."""
+    if isinstance(msg, BinaryTextMessage):
+        return len(msg.payload)
+    return len(msg.message.encode("utf-8"))
@@ -1,14 +1,53 @@
 """Protocol for chat server - Computação Distribuida Assignment 1."""
 from email import message
+import codecs
 import json
+import struct
+import time
+from collections import deque
+from itertools import islice
 from datetime import datetime
 from socket import socket
 
+#Bytes asked from the socket on each buffered read
+RECV_SIZE = 64 * 1024
+
+#Framing versions: 1 is the 2-byte length prefix, 2 a varint length prefix.
+#A stream switches to version 2 by starting with PREAMBLE + the version byte,
+#an empty version 1 frame that no client ever sends.
+FRAMINGS = (1, 2)
+PREAMBLE = b"\x00\x00"
+VARINT_MAX = 5             #bytes of a version 2 length prefix (sizes below 2**35)
+MAX_FRAME = 16 * 1024**2   #largest version 2 frame accepted by default
+STREAM_THRESHOLD = 64 * 1024  #version 2 frames above this are handed out in chunks
+STREAM_HEAD = 512          #bytes buffered before the first chunk, enough for any binary header
+
+IOV_MAX = 512  #frames handed to one sendmsg call at most
+
+
+#Wire encodings a client can ask for when registering
+ENCODINGS = ("json", "binary")
+
+#Binary encoding: command byte, channel length byte, channel, uint32 ts and the UTF-8 payload
+BINARY_HEADER = struct.Struct(">BB")
+BINARY_TS = struct.Struct(">I")
+COMMANDS = {"register": 1, "join": 2, "message": 3, "error": 4}
+COMMAND_NAMES = {code: name for name, code in COMMANDS.items()}
+NO_CHANNEL = 0xFF  #channel length that stands for the main channel 'None'
+
+#Broadcasts between server processes: the binary payload, or for a channel name too long for its
+#length byte, LONG_CHANNEL (a marker no command uses and the name length), the name and the payload on no channel
+LONG_CHANNEL = struct.Struct(">BI")
+LONG_MARKER = 0xFF
+
 
 class Message:
     """Message Type."""
     def __init__(self, command):
         self.command = command
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self})"
     
 class JoinMessage(Message):
     """Message to join a chat channel."""
@@ -17,16 +56,19 @@ class JoinMessage(Message):
         self.channel = new_channel
     
     def __str__(self):
-        return f"{{\"command\": \"{self.command}\", \"channel\": \"{self.channel}\"}}"
+        return json.dumps({"command": self.command, "channel": self.channel}, ensure_ascii=False)
 
 class RegisterMessage(Message):
-    """Message to register username in the server."""
-    def __init__(self, command, user):
+    """Message to register username in the server, choosing the wire encoding."""
+    def __init__(self, command, user, encoding="json"):
         super().__init__(command)
         self.user = user
+        self.encoding = encoding
         
     def __str__(self):
-        return f"{{\"command\": \"{self.command}\", \"user\": \"{self.user}\"}}"
+        if self.encoding == "json":  #legacy clients never send the field
+            return json.dumps({"command": self.command, "user": self.user}, ensure_ascii=False)
+        return json.dumps({"command": self.command, "user": self.user, "encoding": self.encoding}, ensure_ascii=False)
     
 class TextMessage(Message):
     """Message to chat with other clients."""
@@ -34,20 +76,52 @@ class TextMessage(Message):
         super().__init__(command)
         self.message = message
         self.channel = channel
+        self.ts = int(datetime.now().timestamp())  #stamped once, so every encoding of the message agrees
     def __str__(self):
         if self.channel == None:
-            return f"{{\"command\": \"{self.command}\", \"message\": \"{self.message}\", \"ts\": {int(datetime.now().timestamp())}}}"
+            return json.dumps({"command": self.command, "message": self.message, "ts": self.ts}, ensure_ascii=False)
         else:
-            return f"{{\"command\": \"{self.command}\", \"message\": \"{self.message}\", \"channel\": \"{self.channel}\", \"ts\": {int(datetime.now().timestamp())}}}"
+            return json.dumps({"command": self.command, "message": self.message, "channel": self.channel, "ts": self.ts}, ensure_ascii=False)
+
+class ErrorMessage(Message):
+    """Message from the server telling a client what went wrong with what it sent."""
+    def __init__(self, command, message):
+        super().__init__(command)
+        self.message = message
+
+    def __str__(self):
+        return json.dumps({"command": self.command, "message": self.message}, ensure_ascii=False)
+
+class BinaryTextMessage(TextMessage):
+    """TextMessage decoded from a binary payload.
+
+    Only the header is parsed and the text checked to be UTF-8: the text is
+    decoded when first read, and the original payload is reused as is when
+    the message is encoded in binary again, so the server routes binary
+    messages without keeping a decoded copy of the text.
+    """
+    def __init__(self, channel, ts, payload, text_offset):
+        Message.__init__(self, "message")
+        self.channel = channel
+        self.ts = ts
+        self.payload = payload
+        self.text_offset = text_offset
+
+    @property
+    def message(self):
+        return self.payload[self.text_offset:].decode("utf-8")
+
+    def __repr__(self):  #without decoding the text, which may be large
+        return f"BinaryTextMessage(channel={self.channel!r}, ts={self.ts}, {len(self.payload) - self.text_offset} bytes of text)"
 
 
 class CDProto:
     """Computação Distribuida Protocol."""
 
     @classmethod
-    def register(cls, username: str) -> RegisterMessage:
+    def register(cls, username: str, encoding: str = "json") -> RegisterMessage:
         """Creates a RegisterMessage object."""
-        return RegisterMessage("register", username)
+        return RegisterMessage("register", username, encoding)
 
 
     @classmethod
@@ -61,13 +135,103 @@ class CDProto:
         return TextMessage("message", message, channel)
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
-        """Sends through a connection a Message object."""
-        data = bytes(msg.__str__(),encoding="utf-8") 
+    def error(cls, message: str) -> ErrorMessage:
+        """Creates an ErrorMessage object."""
+        return ErrorMessage("error", message)
+
+    @classmethod
+    def encode_payload(cls, msg: Message, encoding: str = "json") -> bytes:
+        """Encodes a Message object into a frame payload."""
+        if encoding == "json":
+            return bytes(msg.__str__(),encoding="utf-8") 
+        if isinstance(msg, BinaryTextMessage):
+            return msg.payload  #already in binary, nothing to re-encode
+        if msg.command == "register":
+            channel, ts, text = None, 0, msg.user
+        elif msg.command == "join":
+            channel, ts, text = msg.channel, 0, ""
+        elif msg.command == "error":
+            channel, ts, text = None, 0, msg.message
+        else:
+            channel, ts, text = msg.channel, msg.ts, msg.message
+        if channel is None:
+            name = b""
+            size = NO_CHANNEL
+        else:
+            name = channel.encode("utf-8")
+            size = len(name)
+            if size >= NO_CHANNEL: raise CDProtoBadFormat(name)
+        return BINARY_HEADER.pack(COMMANDS[msg.command], size) + name + BINARY_TS.pack(ts) + text.encode("utf-8")
+
+    @classmethod
+    def encode_bus(cls, msg: TextMessage) -> bytes:
+        """Encodes a broadcast for the other server processes, whatever the length of its channel name."""
+        try:
+            return cls.encode_payload(msg, "binary")
+        except CDProtoBadFormat:
+            name = msg.channel.encode("utf-8")
+        unnamed = cls.message(msg.message)
+        unnamed.ts = msg.ts
+        return LONG_CHANNEL.pack(LONG_MARKER, len(name)) + name + cls.encode_payload(unnamed, "binary")
+
+    @classmethod
+    def decode_bus(cls, payload: bytes) -> TextMessage:
+        """Decodes a broadcast encoded by encode_bus."""
+        if payload[:1] != bytes((LONG_MARKER,)):
+            return cls.decode(payload)
+        try:
+            _, size = LONG_CHANNEL.unpack_from(payload)
+            channel = payload[LONG_CHANNEL.size:LONG_CHANNEL.size + size].decode("utf-8")
+        except (struct.error, UnicodeDecodeError):
+            raise CDProtoBadFormat(payload)
+        unnamed = cls.decode_binary(payload[LONG_CHANNEL.size + size:])
+        if unnamed.command != "message":
+            raise CDProtoBadFormat(payload)
+        msg = cls.message(unnamed.message, channel)
+        msg.ts = unnamed.ts
+        return msg
+
+    @classmethod
+    def varint(cls, size: int) -> bytes:
+        """Encodes a frame size as a version 2 (LEB128) length prefix."""
+        header = bytearray()
+        while size >= 0x80:
+            header.append(size & 0x7F | 0x80)
+            size >>= 7
+        header.append(size)
+        return bytes(header)
+
+    @classmethod
+    def preamble(cls, framing: int) -> bytes:
+        """Bytes a client sends first to use a framing other than version 1."""
+        return PREAMBLE + bytes([framing])
+
+    @classmethod
+    def frame(cls, data: bytes, framing: int = 1) -> bytes:
+        """Prefixes a payload with its length: 2 bytes (version 1) or a varint (version 2)."""
+        if framing == 2:
+            if len(data) > MAX_FRAME: raise CDProtoBadFormat(data)
+            return cls.varint(len(data)) + data
+        if len(data) >= 2**16: raise CDProtoBadFormat(data)
         header = len(data)
         header = header.to_bytes(2, "big")
-        if len(data) >= 2**16: raise CDProtoBadFormat
-        connection.sendall(header + data)
+        return header + data
+
+    @classmethod
+    def encode_msg(cls, msg: Message, encoding: str = "json", framing: int = 1) -> bytes:
+        """Encodes a Message object into a frame: length prefix and payload."""
+        return cls.frame(cls.encode_payload(msg, encoding), framing)
+
+    @classmethod
+    def send_msg(cls, connection: socket, msg: Message, encoding: str = "json", framing: int = 1):
+        """Sends through a connection a Message object."""
+        payload = cls.encode_payload(msg, encoding)
+        if framing == 2 and len(payload) > STREAM_THRESHOLD:  #no copy of large payloads to glue the header on
+            if len(payload) > MAX_FRAME: raise CDProtoBadFormat(payload)
+            connection.sendall(cls.varint(len(payload)))
+            connection.sendall(payload)
+        else:
+            connection.sendall(cls.frame(payload, framing))
         # msgJSON=bytes(msg.__str__(),encoding="utf-8")
         # nrBytes=len(msgJSON).to_bytes(2,'big')
         # if(len(msgJSON)>pow(2,16)):
@@ -76,34 +240,389 @@ class CDProto:
 
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
+        """Receives a Message object from a connection.
+
+        A plain socket is read with two blocking recv calls. A Connection is
+        read through its FrameBuffer: the next buffered frame is decoded, and
+        only when none is complete a single recv of up to RECV_SIZE bytes is
+        made. None then means that no complete frame is available yet, and
+        ConnectionError that the peer closed the connection. Frames the buffer
+        streams are returned as undecoded FrameChunk objects.
+        """
+        if isinstance(connection, Connection):
+            buffer = connection.buffer
+            frame = buffer.next_frame()
+            if frame is None:
+                chunk = connection.recv(RECV_SIZE)
+                if not chunk:
+                    raise ConnectionResetError("connection closed by peer")
+                buffer.feed(chunk)
+                frame = buffer.next_frame()
+                if frame is None:
+                    return None
+            if isinstance(frame, FrameChunk):
+                return frame
+            return cls.decode(frame)
+
         header = int.from_bytes(connection.recv(2),"big")  #See if the header exists
         # if not head_tmp:
         #     raise ConnectionError()
-        recieved_message =  connection.recv(header).decode('utf-8') # recieving the message
+        return cls.decode(connection.recv(header)) # recieving the message
+
+    @classmethod
+    def decode(cls, payload: bytes) -> Message:
+        """Decodes the payload of one frame into a Message object.
+
+        JSON payloads always start with '{', which is no command byte, so both
+        encodings can arrive on the same connection.
+        """
+        if payload[:1] == b"{" or not payload:
+            return cls.decode_json(payload)
+        return cls.decode_binary(payload)
+
+    @classmethod
+    def peek(cls, payload: bytes):
+        """Reads (command, channel) from a binary payload without decoding the rest."""
+        try:
+            code, size = BINARY_HEADER.unpack_from(payload)
+            if size == NO_CHANNEL:
+                return COMMAND_NAMES[code], None
+            return COMMAND_NAMES[code], payload[2:2 + size].decode("utf-8")
+        except (struct.error, KeyError, UnicodeDecodeError):
+            raise CDProtoBadFormat(payload)
+
+    @classmethod
+    def decode_binary(cls, payload: bytes) -> Message:
+        command, channel = cls.peek(payload)
+        offset = 2 if channel is None else 2 + payload[1]
+        try:
+            ts, = BINARY_TS.unpack_from(payload, offset)
+            offset += BINARY_TS.size
+            if command == "message":
+                codecs.utf_8_decode(memoryview(payload)[offset:], "strict", True)  #only checked here, so reading the text later cannot fail
+                return BinaryTextMessage(channel, ts, payload, offset)
+            text = payload[offset:].decode("utf-8")
+        except (struct.error, UnicodeDecodeError):
+            raise CDProtoBadFormat(payload)
+        if command == "register":
+            return CDProto.register(text, "binary")
+        if command == "error":
+            return CDProto.error(text)
+        return CDProto.join(channel)
+
+    @classmethod
+    def decode_json(cls, payload: bytes) -> Message:
+        try:
+            recieved_message = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            raise CDProtoBadFormat(payload)
         if(recieved_message!=""):
             try:
                 message = json.loads(recieved_message)
             except json.decoder.JSONDecodeError:
-                raise CDProtoBadFormat
-
-            if message["command"] == "register":
-                #user = message["user"]
-                return CDProto.register(message["user"])
-                
-            elif message["command"] == "join":
-                #print(message)
-                #channel = message["channel"]
-                return CDProto.join(message["channel"])
-                
-            elif message["command"] == "message":
-                #recieved_msg = message["message"]
-                if "channel" in message:    #verify if the message is for the main channel or another
+                raise CDProtoBadFormat(payload)
+
+            try:
+                if message["command"] == "register":
+                    #user = message["user"]
+                    encoding = message.get("encoding", "json")
+                    if encoding not in ENCODINGS:
+                        raise CDProtoBadFormat(payload)
+                    return CDProto.register(message["user"], encoding)
+
+                elif message["command"] == "join":
+                    #print(message)
                     channel = message["channel"]
+                    if channel is not None and not isinstance(channel, str):  #e.g. a list, which no channel index can hold
+                        raise CDProtoBadFormat(payload)
+                    return CDProto.join(channel)
+
+                elif message["command"] == "message":
+                    #recieved_msg = message["message"]
+                    channel = message.get("channel")  #verify if the message is for the main channel or another
+                    if (channel is not None and not isinstance(channel, str)) or not isinstance(message["message"], str):
+                        raise CDProtoBadFormat(payload)
                     recieved_msg = CDProto.message(message["message"], channel)
                     return recieved_msg
-                else:
-                    recieved_msg = CDProto.message(message["message"])
-                    return recieved_msg
+
+                elif message["command"] == "error":
+                    if not isinstance(message["message"], str):
+                        raise CDProtoBadFormat(payload)
+                    return CDProto.error(message["message"])
+            except (KeyError, TypeError):
+                raise CDProtoBadFormat(payload)
+
+
+class FrameChunk:
+    """Part of a frame too large to be assembled in memory."""
+
+    def __init__(self, data: bytes, offset: int, size: int):
+        self.data = data
+        self.offset = offset  #position of data in the frame payload
+        self.size = size      #size of the whole frame payload
+
+    @property
+    def first(self) -> bool:
+        return self.offset == 0
+
+    @property
+    def last(self) -> bool:
+        return self.offset + len(self.data) == self.size
+
+
+class FrameBuffer:
+    """Receive buffer that splits a byte stream into frames.
+
+    Bytes are accumulated with feed() and every complete frame is pulled out
+    with next_frame(); a trailing partial frame stays buffered for the next
+    read. Consumed bytes are only discarded on the next feed(), so decoding
+    many frames from one read costs a single compaction.
+
+    Streams use version 1 framing unless they start with the preamble of
+    another version, or the framing is fixed up front (as clients do for
+    what the server sends them). In version 2 a frame above max_frame raises
+    CDProtoBadFormat and its bytes are skipped, and a frame above
+    stream_threshold comes out as FrameChunk objects as its bytes arrive.
+    A stream that cannot be split any further raises ConnectionAbortedError.
+    """
+
+    def __init__(self, max_frame: int = MAX_FRAME, stream_threshold: int = STREAM_THRESHOLD, framing: int = None):
+        self.buffer = bytearray()
+        self.start = 0  #offset of the first byte not yet consumed
+        self.framing = framing or 1
+        self.fresh = framing is None  #nothing consumed yet, a preamble may follow
+        self.max_frame = max_frame
+        self.stream_threshold = stream_threshold
+        self.stream = None  #[size, offset] of the frame being handed out in chunks
+        self.skip = 0       #bytes of a rejected frame still to discard
+
+    def feed(self, data: bytes):
+        """Appends data read from the connection."""
+        if self.start:
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
+        self.advance()
+
+    def advance(self):
+        """Consumes the preamble and the bytes of rejected frames."""
+        if self.skip:
+            dropped = min(self.skip, len(self))
+            self.start += dropped
+            self.skip -= dropped
+        if self.fresh and len(self) >= 2:
+            if self.buffer[self.start:self.start + 2] != PREAMBLE:
+                self.fresh = False
+            elif len(self) >= 3:
+                framing = self.buffer[self.start + 2]
+                if framing not in FRAMINGS:  #the rest of the stream cannot be split
+                    raise ConnectionAbortedError(f"unknown framing version {framing}")
+                self.framing = framing
+                self.start += 3
+                self.fresh = False
+
+    def header(self):
+        """(header length, payload size) of the next frame, or None if its header is incomplete."""
+        if self.fresh:
+            return None
+        available = len(self)
+        if self.framing == 1:
+            if available < 2:
+                return None
+            return 2, int.from_bytes(self.buffer[self.start:self.start + 2], "big")
+        size = shift = 0
+        for n in range(min(available, VARINT_MAX)):
+            byte = self.buffer[self.start + n]
+            size |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return n + 1, size
+            shift += 7
+        if available >= VARINT_MAX:
+            raise ConnectionAbortedError("frame length prefix too long")
+        return None
+
+    def frame_size(self) -> int:
+        """Size of the next frame payload, or None if its header is incomplete."""
+        header = self.header()
+        return header and header[1]
+
+    def has_frame(self) -> bool:
+        """Tells if a complete frame (or the next chunk of a large one) is buffered."""
+        if self.stream is not None:
+            return len(self) > 0
+        header = self.header()
+        if header is None:
+            return False
+        length, size = header
+        if self.framing == 2 and size > self.max_frame:
+            return True
+        if self.framing == 2 and size > self.stream_threshold:
+            return len(self) - length >= min(size, STREAM_HEAD)
+        return len(self) >= length + size
+
+    def next_frame(self):
+        """Pops the payload of the next complete frame (or a FrameChunk), or None."""
+        if not self.has_frame():
+            return None
+        if self.stream is None:
+            length, size = self.header()
+            self.start += length
+            if self.framing == 2 and size > self.max_frame:
+                self.skip = size
+                self.advance()
+                raise CDProtoBadFormat(b"frame of %d bytes" % size)
+            if self.framing == 1 or size <= self.stream_threshold:
+                begin = self.start
+                self.start += size
+                return bytes(self.buffer[begin:self.start])
+            self.stream = [size, 0]
+        size, offset = self.stream
+        begin = self.start
+        self.start += min(len(self), size - offset)
+        chunk = FrameChunk(bytes(self.buffer[begin:self.start]), offset, size)
+        self.stream[1] += len(chunk.data)
+        if chunk.last:
+            self.stream = None
+        return chunk
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+
+class Connection:
+    """A non-blocking socket together with the buffers of its stream.
+
+    Inbound bytes go through a FrameBuffer. Outbound frames are queued with
+    write() and sent with flush() as far as the socket accepts them, so one
+    slow reader never blocks the caller.
+    """
+
+    def __init__(self, sock: socket):
+        self.sock = sock
+        self.buffer = FrameBuffer()
+        self.queue = deque()  #outbound frames (or the unsent tail of the first one)
+        self.pending = 0      #bytes waiting in queue (and in held)
+        self.want_write = False  #registered for EVENT_WRITE
+        self.encoding = "json"   #chosen by the client when it registers
+        self.receiving = None    #connection whose large frame is being streamed to this one
+        self.held = deque()      #frames that wait for that stream to end
+        self.relay = None        #connections this one's large frame is streamed to
+        self.parts = None        #chunks of that frame so far, when anything needs it whole
+
+    @property
+    def framing(self) -> int:
+        """Framing version the client chose with its preamble."""
+        return self.buffer.framing
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+    def sendall(self, data: bytes):
+        self.sock.sendall(data)
+
+    def write(self, frame: bytes, stream: bool = False):
+        """Queues a frame to be sent by flush().
+
+        While a large frame is streamed to this connection only its chunks
+        (stream=True) are queued; other frames are held until end_stream().
+        """
+        if self.receiving is not None and not stream:
+            self.held.append(frame)
+        else:
+            self.queue.append(frame)
+        self.pending += len(frame)
+
+    def end_stream(self):
+        """Queues the frames held while a large frame was streamed."""
+        self.receiving = None
+        self.queue.extend(self.held)
+        self.held.clear()
+
+    def flush(self, sends=None) -> bool:
+        """Sends queued frames until the socket would block; True once drained.
+
+        Several queued frames go out in one sendmsg call; sends (a Histogram)
+        gets the number of frames handed to each call.
+        """
+        while self.queue:
+            frames = [self.queue[0]] if len(self.queue) == 1 else list(islice(self.queue, IOV_MAX))
+            try:
+                sent = self.sock.send(frames[0]) if len(frames) == 1 else self.sock.sendmsg(frames)
+            except BlockingIOError:
+                return False
+            if sends is not None:
+                sends.add(len(frames))
+            self.pending -= sent
+            for frame in frames:
+                if sent < len(frame):
+                    self.queue[0] = memoryview(frame)[sent:]  #keep the tail without copying it
+                    return False
+                sent -= len(frame)
+                self.queue.popleft()
+        return True
+
+    def close(self):
+        self.queue.clear()
+        self.held.clear()
+        self.receiving = None
+        self.parts = None
+        self.pending = 0
+        self.sock.close()
+
+    def __repr__(self):
+        return f"Connection({self.sock})"
+
+
+class Coalescer:
+    """Gathers the frames sent on a blocking socket and sends them together.
+
+    Frames passed to sendall() wait until delay seconds went by since the
+    first of them or until max_bytes are waiting, and then go out in one
+    sendmsg call. The owner's loop calls poll() and waits at most timeout().
+    """
+
+    def __init__(self, sock: socket, delay: float, max_bytes: int, sends=None):
+        self.sock = sock
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.sends = sends  #Histogram of frames per sendmsg call
+        self.frames = []
+        self.pending = 0
+        self.deadline = None
+
+    def sendall(self, data: bytes):
+        if not self.frames:
+            self.deadline = time.monotonic() + self.delay
+        self.frames.append(data)
+        self.pending += len(data)
+        if self.pending >= self.max_bytes or len(self.frames) >= IOV_MAX:
+            self.flush()
+
+    def timeout(self) -> float:
+        """Seconds until frames are due, None when nothing waits."""
+        if not self.frames:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def poll(self):
+        """Sends the frames that are due."""
+        if self.frames and time.monotonic() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        if not self.frames:
+            return
+        sent = self.sock.sendmsg(self.frames)
+        if sent < self.pending:  #a blocking socket may still take a vector in parts
+            self.sock.sendall(b"".join(self.frames)[sent:])
+        if self.sends is not None:
+            self.sends.add(len(self.frames))
+        self.frames = []
+        self.pending = 0
+        self.deadline = None
 
 
 class CDProtoBadFormat(Exception):
@@ -3,74 +3,372 @@ import logging
 import selectors
 import socket
 import sys
+import time
 import fcntl
 import os
 
-from src.protocol import CDProto
+from src.history import ChannelHistory, HISTORY_BYTES, HISTORY_LENGTH
+from src.protocol import CDProto, CDProtoBadFormat, Connection, FrameChunk
+from src.stats import Histogram, LoopStats
 
 logging.basicConfig(filename="server.log", level=logging.DEBUG)
 
 
-class Server:
-    """Chat Server process."""
+#Bytes that may wait in a client's outbound queue before it is a slow consumer
+HIGH_WATER = 1024 * 1024
+
+#Bytes gathered for a client before they are sent, when coalescing
+COALESCE_BYTES = 16 * 1024
+
+#Selector implementations that can be asked for by name
+SELECTORS = {
+    name: getattr(selectors, cls)
+    for name, cls in (("epoll", "EpollSelector"), ("poll", "PollSelector"), ("select", "SelectSelector"), ("kqueue", "KqueueSelector"), ("devpoll", "DevpollSelector"))
+    if hasattr(selectors, cls)
+}
+
+
+class ChannelIndex:
+    """Channel membership of the connected clients, indexed both ways."""
     def __init__(self):
-        self.data = {}
-        self.selector = selectors.DefaultSelector()
+        self.data = {}      #Dictorary: Key = conn, Value = channels
+        self.channels = {}  #Dictorary: Key = channel, Value = set of conns (members)
+
+    def add(self, conn):
+        """Every client starts on the main channel 'None'."""
+        self.data[conn] = [None]
+        self.channels.setdefault(None, set()).add(conn)
+
+    def join(self, conn, channel):
+        """Add conn to channel, leaving the main channel on the first join."""
+        channelList = self.data[conn]  #channelList: list of all the channels for a certain conn
+        if channel in channelList:
+            return
+        channelList.append(channel)
+        self.channels.setdefault(channel, set()).add(conn)
+        if None in channelList:    #remove from channelList the inicial channel 'None'
+            channelList.remove(None)
+            self.leave(conn, None)
+
+    def leave(self, conn, channel):
+        """Remove conn from the members of channel."""
+        members = self.channels.get(channel)
+        if members is None:
+            return
+        members.discard(conn)
+        if not members:
+            del self.channels[channel]  #drop empty channels so the index does not grow forever
+
+    def remove(self, conn):
+        """Remove conn from dictorary and from every channel it was in."""
+        for channel in self.data.pop(conn, ()):
+            self.leave(conn, channel)
+
+    def members(self, channel):
+        """Connections currently in channel."""
+        return self.channels.get(channel, ())
+
+
+class Server(ChannelIndex):
+    """Chat Server process.
+
+    Frames for a client are queued on its Connection and flushed when the
+    selector reports the socket writable. A client whose queue goes past
+    high_water is disconnected, or with slow_policy="drop" misses the frames
+    that do not fit.
+
+    The last history messages of each channel (up to history_bytes of frames)
+    are replayed to a client when it joins the channel.
+
+    selector names the selectors implementation (see SELECTORS) instead of
+    the platform default. With instrument=True the loop keeps LoopStats.
+
+    With coalesce_delay (seconds) frames for a client are not sent right
+    away but gathered until the delay passes or coalesce_bytes are waiting,
+    and then sent in one sendmsg call. sends counts the frames per call.
+    """
+    def __init__(self, host: str = "localhost", port: int = 5555, high_water: int = HIGH_WATER, slow_policy: str = "disconnect", reuse_port: bool = False,
+                 history: int = HISTORY_LENGTH, history_bytes: int = HISTORY_BYTES, selector: str = None, instrument: bool = False,
+                 coalesce_delay: float = None, coalesce_bytes: int = COALESCE_BYTES):
+        if slow_policy not in ("disconnect", "drop"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_policy}")
+        if selector is not None and selector not in SELECTORS:
+            raise ValueError(f"Unknown selector: {selector}")
+        super().__init__()
+        self.history = ChannelHistory(history, history_bytes)
+        self.high_water = high_water
+        self.slow_policy = slow_policy
+        self.bus = None  #set by attach() when other server processes share the port
+        self.stats = LoopStats() if instrument else None
+        self.sends = Histogram()  #frames handed to each send/sendmsg call
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+        self.due = {}  #Dictorary: Key = conn, Value = when its gathered frames must go (in deadline order)
+        self.selector = selectors.DefaultSelector() if selector is None else SELECTORS[selector]()
         self.sock = socket.socket()
-        self.sock.bind(('localhost', 5555))
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:  #several processes accept on the same port and the kernel spreads the connections
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((host, port))
         self.sock.listen(100)
         self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
 
+    def attach(self, bus):
+        """Share broadcasts with the other server processes on bus."""
+        self.bus = bus
+        bus.selector = self.selector  #to wait for the peers too busy to take a broadcast
+        self.selector.register(bus, selectors.EVENT_READ, self.deliver)
+
     def accept(self, sock, mask):
         conn, addr = sock.accept()
         print(f"Client {conn} with address {addr} detected")
         conn.setblocking(False)
-        self.selector.register(conn, selectors.EVENT_READ, self.read) #The Server will always be looking for some new reading/writing event
+        conn = Connection(conn)  #keeps the bytes read so far until a whole frame arrives
+        self.selector.register(conn, selectors.EVENT_READ, self.ready) #The Server will always be looking for some new reading event, and for writing ones while its queue is not empty
+        self.add(conn)
 
-        self.data[conn] = [None] #Dictorary: Key = conn, Value = channels
-    
-    def read(self, conn, mask):
+    def broadcast(self, msg, sender=None, streamed=()):
+        """Send msg from sender to every member of msg.channel (but those it was streamed to), encoding it only once per wire encoding."""
+        self.fanout(msg, sender, streamed)
+        if self.bus is not None:
+            self.bus.publish(CDProto.encode_bus(msg))
+
+    def fanout(self, msg, sender=None, streamed=()):
+        """Queue msg for the local members of its channel, telling sender of the members whose framing cannot carry it."""
+        frames = {}  #the same bytes (and ts) go to every member using an encoding and framing
+        missed = 0
+        for conn in tuple(self.members(msg.channel)):  #slow members may be disconnected on the way
+            if conn in streamed:
+                continue
+            wire = (conn.encoding, conn.framing)
+            frame = frames.get(wire)
+            if frame is None:
+                try:
+                    frame = CDProto.encode_msg(msg, *wire)
+                except CDProtoBadFormat:  #too large for this member's framing
+                    frame = b""
+                frames[wire] = frame
+            if not frame:
+                missed += 1
+                continue
+            self.write(conn, frame)
+        if missed:
+            logging.warning("Message too large for %d members of %s", missed, msg.channel)
+            if sender in self.data:
+                self.send(sender, CDProto.error(f"Message not delivered to {missed} members of {msg.channel}: too large for their framing"))
+        self.history.record(msg, {wire: frame for wire, frame in frames.items() if frame})
+
+    def replay(self, conn, channel):
+        """Send conn the history of channel in one write."""
+        frames = self.history.replay(channel, conn.encoding, conn.framing)
+        if frames:
+            self.write(conn, frames)
+
+    def report(self):
+        """Log the memory used by the channel histories and the loop stats."""
+        logging.info("History: %d bytes %s", self.history.memory(), self.history.report())
+        if self.stats is not None:
+            logging.info("Loop (%s): %s", type(self.selector).__name__, self.stats.dump())
+        logging.info("Frames per send: %s", self.sends.summary())
+
+    def relay(self, conn, chunk):
+        """Pass on a chunk of a large frame from conn.
+
+        A binary message is streamed as it arrives, being routed on its
+        header, to the members using binary encoding and version 2 framing
+        that are not receiving another stream; other frames sent to those
+        meanwhile are held until the stream ends. The frame is only assembled
+        when something needs the whole payload: another member, the other
+        server processes or the channel history. Once complete, it is handled
+        as any other frame: a message goes to the rest of the members, and its
+        sender hears of the members whose framing cannot carry it.
+        """
+        if chunk.first:
+            conn.relay, conn.parts = [], []
+            try:
+                command, channel = CDProto.peek(chunk.data)
+            except CDProtoBadFormat:  #JSON (or garbage) cannot be routed before it is complete
+                command = None
+            if command == "message":
+                header = CDProto.varint(chunk.size)
+                members = tuple(self.members(channel))
+                for member in members:
+                    if member.encoding != "binary" or member.framing != 2 or member.receiving is not None:
+                        continue
+                    member.receiving = conn
+                    conn.relay.append(member)
+                    self.write(member, header, stream=True)
+                if len(conn.relay) == len(members) and self.bus is None and not self.history.keeps(channel, chunk.size):
+                    conn.parts = None  #streamed to everyone: nothing to assemble
+        if conn.parts is not None:
+            conn.parts.append(chunk.data)
+        for member in conn.relay:
+            if member.receiving is conn:  #still connected
+                self.write(member, chunk.data, stream=True)
+        if not chunk.last:
+            return
+        streamed, parts = conn.relay, conn.parts
+        conn.relay = conn.parts = None
+        for member in streamed:
+            if member.receiving is conn:
+                member.end_stream()
+                self.flush(member)
+        if parts is None:
+            return
         try:
-            data = CDProto.recv_msg(conn)
-            print("Data Pos recieved: ",data)
-            if data == None:
-                print('closing', conn)
-                self.selector.unregister(conn) 
-                self.data.pop(conn)  #remove conn from dictorary
-                conn.close()
-                print(f"{conn} logged out")
+            msg = CDProto.decode(b"".join(parts))
+        except CDProtoBadFormat:
+            logging.warning("Dropping badly formatted frame from %s", conn)
+            return
+        if streamed:
+            self.broadcast(msg, conn, set(streamed))
+        elif msg is not None:
+            self.handle(conn, msg)
+
+    def deliver(self, bus, mask):
+        """Fan out the broadcasts other server processes published on bus."""
+        for payload in bus.receive():
+            try:
+                self.fanout(CDProto.decode_bus(payload))
+            except CDProtoBadFormat:
+                logging.warning("Dropping badly formatted broadcast from the bus")
+
+    def send(self, conn, msg):
+        """Queue msg for conn."""
+        self.write(conn, CDProto.encode_msg(msg, conn.encoding, conn.framing))
+
+    def write(self, conn, frame, stream=False):
+        """Queue an encoded frame (or a chunk of a streamed one) for conn, flushing right away when nothing is waiting."""
+        if conn.pending + len(frame) > self.high_water:
+            if self.slow_policy == "drop" and not stream:  #a streamed frame cannot lose a chunk
+                logging.warning("Dropping frame for slow consumer %s", conn)
             else:
-                if data.command ==  "register":
-
-                    pass
-                elif (data.command == "join" ):
-                    channelList = self.data[conn]  #channelList: list of all the channels for a certain conn
-                    if data.channel not in channelList:
-                        channelList.append(data.channel)
-                        if(None in channelList):    #remove from channelList the inicial channel 'None'
-                            channelList.remove(None)
-                            self.data[conn] = channelList
-                elif(data.command == "message"):    
-                    for k,v in self.data.items():    #run all the elements of the dictorary
-                        for channel in v:
-                            if data.channel == channel:  #compare the values of the dictorary (channelList), with the channel from data
-                                CDProto.send_msg(k, data)   #send a message to the data.channel
-                        
-        except ConnectionError: #this runs something else broke the above code
-            print('closing', conn)
-            self.selector.unregister(conn) 
-            self.data.pop(conn)  #remove conn from dictorary
-            conn.close()
-            print(f"{conn} logged out")
+                logging.warning("Disconnecting slow consumer %s", conn)
+                self.disconnect(conn)
+            return
+        idle = not conn.queue  #otherwise a flush is already due or waiting for EVENT_WRITE
+        conn.write(frame, stream)
+        if self.coalesce_delay is None:
+            if idle:
+                self.flush(conn)
+        elif conn.pending >= self.coalesce_bytes and not conn.want_write:
+            self.flush(conn)
+        elif idle and conn not in self.due:
+            self.due[conn] = time.monotonic() + self.coalesce_delay
+
+    def timeout(self):
+        """Seconds select() may block before gathered frames are due."""
+        if not self.due:
+            return None
+        return max(0, next(iter(self.due.values())) - time.monotonic())
+
+    def flush_due(self):
+        """Flush the connections whose gathered frames are due."""
+        now = time.monotonic()
+        while self.due:
+            conn, deadline = next(iter(self.due.items()))
+            if deadline > now:
+                break
+            self.flush(conn)
+
+    def flush(self, conn):
+        """Send what the socket takes and watch for EVENT_WRITE only while something is left."""
+        self.due.pop(conn, None)
+        try:
+            drained = conn.flush(self.sends)
+        except ConnectionError:
+            self.disconnect(conn)
+            return
+        if conn.want_write == drained:
+            conn.want_write = not drained
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.want_write else selectors.EVENT_READ
+            self.selector.modify(conn, events, self.ready)
 
+    def disconnect(self, conn):
+        """Forget conn and close it."""
+        if conn not in self.data:  #already gone (e.g. dropped while broadcasting)
+            return
+        print('closing', conn)
+        if conn.relay:  #the members it was streaming to will never get the rest of that frame
+            for member in conn.relay:
+                if member.receiving is conn:
+                    self.disconnect(member)
+            conn.relay = None
+        self.selector.unregister(conn)
+        self.due.pop(conn, None)
+        self.remove(conn)
+        conn.close()
+        print(f"{conn} logged out")
 
+    def handle(self, conn, data):
+        """Process one message received from conn."""
+        if isinstance(data, FrameChunk):
+            self.relay(conn, data)
+            return
+        logging.debug("Received from %s: %r", conn, data)
+        if data.command ==  "register":
+            conn.encoding = data.encoding  #later frames for this client use the encoding it asked for
+        elif (data.command == "join" ):
+            if data.channel not in self.data[conn]:
+                self.join(conn, data.channel)
+                self.replay(conn, data.channel)  #catch up with what was said before
+        elif(data.command == "message"):
+            self.broadcast(data, conn)   #send a message to the data.channel
+
+    def read(self, conn, mask):
+        """Read once from conn and process every complete message received."""
+        try:
+            while True:
+                try:
+                    data = CDProto.recv_msg(conn)
+                except CDProtoBadFormat:
+                    logging.warning("Dropping badly formatted frame from %s", conn)
+                    data = None
+                if data is not None:
+                    self.handle(conn, data)
+                if conn not in self.data or not conn.buffer.has_frame():  #disconnected, or the rest (if any) is a partial frame
+                    break
+
+        except ConnectionError: #this runs something else broke the above code
+            self.disconnect(conn)
+
+    def ready(self, conn, mask):
+        """Dispatch the selector events of a client connection."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ and conn in self.data:
+            self.read(conn, mask)
 
     def loop(self):
         """Loop indefinetely."""
+        if self.stats is not None:
+            return self.instrumented_loop()
         while True:
-            events = self.selector.select()
-            for key, mask in events:               
+            events = self.selector.select(self.timeout())
+            for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+            if self.due:
+                self.flush_due()
 
+    def instrumented_loop(self):
+        """Loop indefinetely, timing every callback into self.stats."""
+        clock = time.perf_counter_ns
+        stats = self.stats
+        while True:
+            start = clock()
+            events = self.selector.select(self.timeout())
+            ready = clock()
+            for key, mask in events:
+                callback = key.data
+                kind = callback.__name__
+                if kind == "ready":
+                    kind = "read" if mask & selectors.EVENT_READ else "write"
+                before = clock()
+                callback(key.fileobj, mask)
+                stats.callback(kind, (clock() - before) // 1000)
+            if self.due:
+                before = clock()
+                self.flush_due()
+                stats.callback("coalesced", (clock() - before) // 1000)
+            stats.loop(len(events), (ready - start) // 1000, (clock() - ready) // 1000)
@@ -0,0 +1,78 @@
+"""Counters and histograms for the server event loop."""
+from collections import Counter
+
+
+class Histogram:
+    """Histogram with power-of-two buckets, cheap enough to update per event."""
+
+    def __init__(self):
+        self.buckets = [0] * 64  #bucket b counts values in [2**(b-1), 2**b)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value: int):
+        self.buckets[min(int(value).bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        """Upper bound of the bucket holding the given fraction of the values."""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** bucket, self.max)
+        return 0
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class LoopStats:
+    """What Server.loop did: iterations, callbacks and the time they took.
+
+    Times are in microseconds. wait is the time blocked in select(),
+    iteration the time spent dispatching the events it returned, and batch
+    the number of events per select().
+    """
+
+    def __init__(self):
+        self.iterations = 0
+        self.callbacks = Counter()  #Key = callback kind (accept, read, write, deliver)
+        self.times = {}             #Key = callback kind, Value = Histogram
+        self.batch = Histogram()
+        self.wait = Histogram()
+        self.iteration = Histogram()
+
+    def callback(self, kind: str, elapsed: int):
+        self.callbacks[kind] += 1
+        histogram = self.times.get(kind)
+        if histogram is None:
+            histogram = self.times[kind] = Histogram()
+        histogram.add(elapsed)
+
+    def loop(self, events: int, wait: int, elapsed: int):
+        self.iterations += 1
+        self.batch.add(events)
+        self.wait.add(wait)
+        self.iteration.add(elapsed)
+
+    def dump(self) -> dict:
+        return {
+            "iterations": self.iterations,
+            "callbacks": dict(self.callbacks),
+            "callback_us": {kind: h.summary() for kind, h in self.times.items()},
+            "batch": self.batch.summary(),
+            "wait_us": self.wait.summary(),
+            "iteration_us": self.iteration.summary(),
+        }
@@ -0,0 +1,58 @@
+"""Tests for the asyncio engine."""
+import asyncio
+
+from src.aio import AsyncServer, AsyncClient
+
+
+async def exchange():
+    server = AsyncServer(port=0)
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+
+    foo, bar, baz = (AsyncClient(name, port=port) for name in ("Foo", "Bar", "Baz"))
+    for c in (foo, bar, baz):
+        await c.connect()
+    await foo.join("#cd")
+    await bar.join("#cd")
+    await asyncio.sleep(0.1)
+    await foo.message("Hello World")
+
+    received = await asyncio.wait_for(bar.messages().__anext__(), 2)
+    assert received.message == "Hello World"
+    assert received.channel == "#cd"
+    assert len(server.members(None)) == 1
+    assert len(server.members("#cd")) == 2
+
+    for c in (foo, bar, baz):
+        c.writer.close()
+    server.server.close()
+    await server.server.wait_closed()
+
+
+def test_exchange():
+    asyncio.run(exchange())
+
+
+async def large_message():
+    server = AsyncServer(port=0)
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+
+    foo = AsyncClient("Foo", port=port, framing=2)
+    bar = AsyncClient("Bar", port=port, encoding="binary", framing=2)
+    for c in (foo, bar):
+        await c.connect()
+    await asyncio.sleep(0.1)
+    await foo.message("x" * 200000)
+
+    received = await asyncio.wait_for(bar.messages().__anext__(), 2)
+    assert received.message == "x" * 200000
+
+    for c in (foo, bar):
+        c.writer.close()
+    server.server.close()
+    await server.server.wait_closed()
+
+
+def test_large_message():
+    asyncio.run(large_message())
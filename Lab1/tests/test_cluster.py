@@ -0,0 +1,62 @@
+"""Tests for the bus between server processes."""
+import selectors
+from src.cluster import Bus
+from src.protocol import CDProto
+
+
+def test_bus(tmp_path):
+    a = Bus(str(tmp_path), 0, 3)
+    b = Bus(str(tmp_path), 1, 3)
+    payload = CDProto.encode_payload(CDProto.message("Hello World", "#cd"), "binary")
+
+    a.publish(payload)  #worker-2 is not up: dropped for it only
+    a.publish(payload)
+
+    assert list(b.receive()) == [payload, payload]
+    assert list(a.receive()) == []
+    a.close()
+    b.close()
+
+
+def test_bus_busy_peer(tmp_path):
+    """broadcasts a peer cannot take yet are queued and sent once it reads"""
+    a = Bus(str(tmp_path), 0, 2)
+    b = Bus(str(tmp_path), 1, 2)
+    a.selector = selectors.DefaultSelector()
+    payloads = [CDProto.encode_payload(CDProto.message(f"Hello {i}", "#cd"), "binary") for i in range(50)]
+    for payload in payloads:
+        a.publish(payload)
+    assert a.queues  #more than the socket of b holds
+
+    received = []
+    for _ in range(100):
+        received.extend(b.receive())
+        if len(received) == len(payloads):
+            break
+        for key, mask in a.selector.select(1):
+            key.data(key.fileobj, mask)
+    assert received == payloads and not a.queues
+    a.close()
+    b.close()
+
+
+def test_bus_fragments(tmp_path):
+    """broadcasts larger than a datagram are split and joined back"""
+    a = Bus(str(tmp_path), 0, 2)
+    b = Bus(str(tmp_path), 1, 2)
+    a.selector = selectors.DefaultSelector()
+    small = CDProto.encode_payload(CDProto.message("Hello", "#cd"), "binary")
+    large = CDProto.encode_payload(CDProto.message("x" * 300000, "#cd"), "binary")
+    a.publish(large)
+    a.publish(small)
+
+    received = []
+    for _ in range(100):
+        received.extend(b.receive())
+        if len(received) == 2:
+            break
+        for key, mask in a.selector.select(1):
+            key.data(key.fileobj, mask)
+    assert received == [large, small]
+    a.close()
+    b.close()
@@ -0,0 +1,64 @@
+"""Tests for the channel history."""
+from src.history import ChannelHistory
+from src.protocol import CDProto
+
+
+def test_ring():
+    h = ChannelHistory(length=3, max_bytes=10000)
+    for i in range(5):
+        msg = CDProto.message(f"m{i}", "#cd")
+        h.record(msg, {("json", 1): CDProto.encode_msg(msg)})
+    h.record(CDProto.message("main channel"), {})
+
+    replayed = h.replay("#cd")
+    assert [m.message for m in decode_all(replayed)] == ["m2", "m3", "m4"]
+    assert h.report() == {"#cd": {"messages": 3, "bytes": len(replayed)}}
+    assert h.replay("#empty") == b""
+
+
+def test_bytes_limit_and_wires():
+    msg = CDProto.message("x" * 100, "#cd")
+    frame = CDProto.encode_msg(msg)
+    h = ChannelHistory(length=10, max_bytes=2 * len(frame))
+    for _ in range(3):
+        h.record(msg, {("json", 1): frame})
+    assert h.report()["#cd"]["messages"] == 2
+
+    binary = h.replay("#cd", "binary")
+    assert [m.message for m in decode_all(binary)] == [msg.message] * 2
+    assert h.report()["#cd"]["messages"] == 1  #the binary frames count too: the oldest message went
+    assert h.memory() == len(frame) + len(binary) // 2 <= 2 * len(frame)
+    assert h.replay("#cd") == frame
+
+
+def test_too_large_for_legacy():
+    msg = CDProto.message("\x01" * 20000, "#cd")  #escaped, past the 64 KiB of a json frame
+    h = ChannelHistory()
+    h.record(msg, {})
+    assert h.replay("#cd") == b""
+    assert h.replay("#cd", "binary", 2) == CDProto.encode_msg(msg, "binary", 2)
+
+
+def test_large_messages_bounded():
+    msg = CDProto.message("\x01" * 20000, "#cd")  #too large for a json frame, so kept without frames
+    h = ChannelHistory(max_bytes=64 * 1024)
+    for _ in range(20):
+        h.record(msg, {})
+    assert h.report()["#cd"]["messages"] == 3
+    assert h.memory() == 3 * len(msg.message)
+    h.record(CDProto.message("x" * 1024**2, "#big"), {})  #larger than the whole bound
+    assert h.replay("#big", "binary", 2) == b"" and "#big" not in h.report()
+
+    h = ChannelHistory(max_bytes=64 * 1024)
+    for i in range(20):
+        h.record(CDProto.message(f"{i}" * 1000, "#cd"), {})
+    for wire in (("binary", 1), ("json", 2), ("binary", 2)):
+        h.replay("#cd", *wire)
+        assert h.memory() <= 64 * 1024
+
+
+def decode_all(frames):
+    while frames:
+        size = int.from_bytes(frames[:2], "big")
+        yield CDProto.decode(frames[2:2 + size])
+        frames = frames[2 + size:]
@@ -6,6 +6,10 @@ from src.protocol import (
     JoinMessage,
     RegisterMessage,
     CDProtoBadFormat,
+    Coalescer,
+    Connection,
+    FrameBuffer,
+    FrameChunk,
 )
 
 from freezegun import freeze_time
@@ -59,3 +63,204 @@ def test_recv():
 
     with pytest.raises(CDProtoBadFormat):
         CDProto.recv_msg(mock_socket(b"Hello World"))
+
+
+class chunk_socket:
+    """Non-blocking socket returning the stream in arbitrary chunks."""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, n):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def frame(content):
+    return len(content).to_bytes(2, "big") + content
+
+
+def test_recv_buffered():
+    join = frame(b'{"command": "join", "channel": "#cd"}')
+    text = frame(b'{"command": "message", "message": "Hello World", "channel": "#cd", "ts": 1615852800}')
+    conn = Connection(chunk_socket(join + text + text[:5], text[5:]))
+
+    assert isinstance(CDProto.recv_msg(conn), JoinMessage)
+    assert conn.buffer.has_frame()
+    assert CDProto.recv_msg(conn).message == "Hello World"
+    assert not conn.buffer.has_frame()
+    assert len(conn.buffer) == 5
+
+    assert CDProto.recv_msg(conn).channel == "#cd"
+    assert len(conn.buffer) == 0
+
+    with pytest.raises(ConnectionError):
+        CDProto.recv_msg(conn)
+
+
+def test_recv_partial_header():
+    conn = Connection(chunk_socket(b"\x00", b"\x02{}"[:2]))
+
+    assert CDProto.recv_msg(conn) is None
+    assert CDProto.recv_msg(conn) is None
+    assert conn.buffer.frame_size() == 2
+
+
+@freeze_time("Mar 16th, 2021")
+def test_binary():
+    p = CDProto()
+
+    register = p.decode(p.encode_payload(p.register("student", "binary"), "binary"))
+    assert isinstance(register, RegisterMessage)
+    assert register.user == "student"
+    assert register.encoding == "binary"
+
+    join = p.decode(p.encode_payload(p.join("#cd"), "binary"))
+    assert isinstance(join, JoinMessage)
+    assert join.channel == "#cd"
+
+    payload = p.encode_payload(p.message("Olá \"Mundo\"", "#cd"), "binary")
+    assert payload == b"\x03\x03#cd" + (1615852800).to_bytes(4, "big") + "Olá \"Mundo\"".encode()
+    assert p.peek(payload) == ("message", "#cd")
+    text = p.decode(payload)
+    assert isinstance(text, TextMessage)
+    assert (text.message, text.channel, text.ts) == ("Olá \"Mundo\"", "#cd", 1615852800)
+    assert p.encode_payload(text, "binary") is payload
+    assert repr(text) == "BinaryTextMessage(channel='#cd', ts=1615852800, 12 bytes of text)"  #the text is not decoded to log it
+
+    assert p.decode(p.encode_payload(p.message("Hello World"), "binary")).channel is None
+
+    with pytest.raises(CDProtoBadFormat):
+        p.decode(b"\x09\x00")
+    for text in (b"\xff\xfe", "Olá".encode()[:-1]):  #not UTF-8, or cut in the middle of a character
+        with pytest.raises(CDProtoBadFormat):
+            p.decode(b"\x03\x03#cd" + bytes(4) + text)
+
+
+def test_bus_long_channel():
+    """Test that broadcasts on channels too long for a binary header still cross the bus."""
+    p = CDProto()
+    short = p.message("Hello", "#cd")
+    assert p.encode_bus(short) == p.encode_payload(short, "binary")
+    channel = "#" + "x" * 300
+    msg = p.message("Olá", channel)
+    with pytest.raises(CDProtoBadFormat):
+        p.encode_payload(msg, "binary")
+    received = p.decode_bus(p.encode_bus(msg))
+    assert (received.message, received.channel, received.ts) == ("Olá", channel, msg.ts)
+    with pytest.raises(CDProtoBadFormat):
+        p.decode_bus(p.encode_bus(msg)[:10])
+
+
+@freeze_time("Mar 16th, 2021")
+def test_json_escaping():
+    p = CDProto()
+
+    assert str(p.register("student", "binary")) == '{"command": "register", "user": "student", "encoding": "binary"}'
+    assert p.decode(str(p.register("student", "binary")).encode()).encoding == "binary"
+
+    text = p.decode(str(p.message('say "hi"', "#cd")).encode())
+    assert text.message == 'say "hi"'
+
+    with pytest.raises(CDProtoBadFormat):
+        p.decode(b'{"command": "join"}')
+    for bad in (b'{"command": "join", "channel": ["x"]}', b'{"command": "message", "message": "hi", "channel": {}}', b'{"command": "message", "message": 5}'):
+        with pytest.raises(CDProtoBadFormat):
+            p.decode(bad)
+    assert p.decode(b'{"command": "join", "channel": null}').channel is None
+
+    for encoding in ("json", "binary"):
+        error = p.decode(p.encode_payload(p.error("too large"), encoding))
+        assert (error.command, error.message) == ("error", "too large")
+
+
+def test_varint_framing():
+    p = CDProto()
+    assert p.varint(0) == b"\x00"
+    assert p.varint(300) == b"\xac\x02"
+
+    big = b"x" * 70000
+    b = FrameBuffer()
+    b.feed(p.preamble(2) + p.frame(b"{}", 2) + p.frame(big, 2)[:100])
+    assert b.framing == 2
+    assert b.next_frame() == b"{}"
+    assert b.next_frame() is None
+
+    b = FrameBuffer(stream_threshold=1 << 20)
+    b.feed(p.preamble(2) + p.frame(big, 2))
+    assert b.next_frame() == big
+
+    with pytest.raises(CDProtoBadFormat):
+        p.frame(big)
+
+
+def test_large_frames():
+    p = CDProto()
+    big = b"x" * 2000
+
+    b = FrameBuffer(max_frame=1000, stream_threshold=600)
+    b.feed(p.preamble(2) + p.frame(big, 2)[:1000])
+    with pytest.raises(CDProtoBadFormat):
+        b.next_frame()
+    b.feed(big[:1002] + p.frame(b"{}", 2))  #the rest of the rejected frame
+    assert b.next_frame() == b"{}"
+
+    b.feed(p.frame(big[:800], 2)[:300])
+    assert b.next_frame() is None  #not enough for the first chunk yet
+    b.feed(b"x" * 300)
+    first = b.next_frame()
+    assert isinstance(first, FrameChunk)
+    assert (first.first, first.last, first.size) == (True, False, 800)
+    b.feed(b"x" * 300)
+    last = b.next_frame()
+    assert (last.offset, last.last) == (len(first.data), True)
+    assert len(first.data) + len(last.data) == 800
+    assert b.next_frame() is None
+
+    with pytest.raises(ConnectionError):
+        FrameBuffer().feed(b"\x00\x00\x07")
+
+
+def test_coalescer():
+    """Test that frames wait for the delay or the size bound and then go out in one sendmsg."""
+    from unittest.mock import MagicMock
+    from src.stats import Histogram
+
+    sock = MagicMock()
+    sock.sendmsg.side_effect = lambda frames: sum(len(f) for f in frames)
+    sends = Histogram()
+    out = Coalescer(sock, delay=60, max_bytes=100, sends=sends)
+    assert out.timeout() is None
+
+    CDProto.send_msg(out, CDProto.join("#cd"))
+    CDProto.send_msg(out, CDProto.join("#c"))
+    assert not sock.sendmsg.called
+    assert 0 < out.timeout() <= 60
+    out.poll()
+    assert not sock.sendmsg.called
+
+    out.flush()
+    sock.sendmsg.assert_called_once_with([CDProto.encode_msg(CDProto.join("#cd")), CDProto.encode_msg(CDProto.join("#c"))])
+    assert out.timeout() is None
+
+    CDProto.send_msg(out, CDProto.message("x" * 100))  #past max_bytes: sent right away
+    assert sock.sendmsg.call_count == 2
+    assert sends.count == 2
+
+
+def test_connection_sendmsg():
+    """Test that queued frames are flushed with one sendmsg and a partial send keeps the tail."""
+    from unittest.mock import MagicMock
+
+    sock = MagicMock()
+    sock.sendmsg.return_value = 5
+    c = Connection(sock)
+    c.write(b"abc")
+    c.write(b"defg")
+    assert not c.flush()
+    sock.sendmsg.assert_called_once_with([b"abc", b"defg"])
+    assert bytes(c.queue[0]) == b"fg" and len(c.queue) == 1
+    assert c.pending == 2
+
+    sock.send.return_value = 2
+    assert c.flush()
+    assert not c.queue
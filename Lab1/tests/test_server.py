@@ -1,8 +1,10 @@
+import selectors
 import pytest
 from unittest.mock import patch
 from mock import MagicMock
 from mockselector.selector import MockSocket, ListenSocket, MockSelector
 
+from src.protocol import CDProto, Connection
 from src.server import Server
 
 
@@ -10,6 +12,29 @@ class CDProtoException(Exception):
     pass
 
 
+@pytest.fixture()
+def server():
+    """Make Servers on free ports with a mock selector, closing them after the test."""
+    servers = []
+
+    def make(**settings):
+        s = Server(port=0, **settings)
+        s.selector = MagicMock()
+        servers.append(s)
+        return s
+
+    yield make
+    for s in servers:
+        s.sock.close()
+
+
+def blocked_connection():
+    """A Connection whose socket would block on every send, so its frames stay queued."""
+    sock = MagicMock()
+    sock.send.side_effect = sock.sendmsg.side_effect = BlockingIOError
+    return Connection(sock)
+
+
 def test_server():
     """Test that the server used CDProto methods."""
     c1 = MockSocket([b""])
@@ -31,3 +56,242 @@ def test_server():
 
             with pytest.raises(CDProtoException):
                 s.loop()
+
+
+def test_channel_index(server):
+    """Test that channel membership is indexed on join and disconnect."""
+    s = server()
+    c1, c2 = MagicMock(), MagicMock()
+    for c in (c1, c2):
+        s.data[c] = [None]
+        s.channels.setdefault(None, set()).add(c)
+
+    s.join(c1, "#cd")
+    assert s.members(None) == {c2}
+    assert s.members("#cd") == {c1}
+
+    s.join(c2, "#cd")
+    s.join(c2, "#c2")
+    assert s.members("#cd") == {c1, c2}
+    assert None not in s.channels
+
+    s.disconnect(c2)
+    assert s.members("#cd") == {c1}
+    assert "#c2" not in s.channels
+
+
+def test_slow_consumer(server):
+    """Test that frames queue up for a blocked client and past the high-water mark it is dropped."""
+    s = server(high_water=200)
+    c = blocked_connection()
+    sock = c.sock
+    s.data[c] = [None]
+    s.channels.setdefault(None, set()).add(c)
+
+    msg = CDProto.message("Hello World")
+    s.broadcast(msg)
+    assert c.want_write
+    assert c.pending == len(CDProto.encode_msg(msg))
+
+    sock.send.side_effect = lambda data: 3
+    s.ready(c, selectors.EVENT_WRITE)
+    assert c.pending == len(CDProto.encode_msg(msg)) - 3
+
+    sock.send.side_effect = BlockingIOError
+    for _ in range(5):
+        s.broadcast(msg)
+    assert c not in s.data
+    assert sock.close.called
+
+
+def test_broadcast_encodes_once(server):
+    """Test that every member of a channel gets the same encoded frame."""
+    s = server()
+    conns = []
+    for _ in range(3):
+        c = blocked_connection()
+        s.data[c] = [None]
+        s.join(c, "#cd")
+        conns.append(c)
+
+    with patch("src.protocol.CDProto.encode_msg", wraps=CDProto.encode_msg) as encode:
+        s.broadcast(CDProto.message("Hello World", "#cd"))
+    assert encode.call_count == 1
+    assert conns[0].queue[0] is conns[1].queue[0] is conns[2].queue[0]
+
+
+def test_broadcast_per_encoding(server):
+    """Test that members get the broadcast in the encoding they registered with."""
+    s = server()
+    conns = []
+    for encoding in ("json", "binary", "binary"):
+        c = blocked_connection()
+        s.add(c)
+        s.handle(c, CDProto.register("student", encoding))
+        s.join(c, "#cd")
+        conns.append(c)
+
+    s.broadcast(CDProto.message("Hello World", "#cd"))
+    json_frame, binary_frame, other = (c.queue[0] for c in conns)
+    assert binary_frame is other
+    assert CDProto.decode(json_frame[2:]).message == "Hello World"
+    assert CDProto.decode(binary_frame[2:]).message == "Hello World"
+    assert binary_frame[2] == 3
+
+
+def test_bad_binary_text(server):
+    """Test that a binary message whose text is not UTF-8 is dropped instead of breaking the JSON members' fanout."""
+    s = server()
+    conns = []
+    for encoding in ("binary", "json"):
+        c = blocked_connection()
+        s.add(c)
+        s.handle(c, CDProto.register("student", encoding))
+        s.join(c, "#cd")
+        conns.append(c)
+    sender, member = conns
+
+    sender.sock.recv.return_value = CDProto.frame(b"\x03\x03#cd" + bytes(4) + b"\xff\xfe")
+    s.read(sender, selectors.EVENT_READ)
+    assert sender in s.data and not member.queue
+
+
+def test_long_channel_on_bus(server):
+    """Test that a message on a channel too long for the binary header is still published to the other processes."""
+    s = server()
+    s.bus = MagicMock()
+    c = blocked_connection()
+    s.add(c)
+    channel = "#" + "x" * 300
+    s.handle(c, CDProto.join(channel))
+    s.handle(c, CDProto.message("Hello", channel))
+    published = CDProto.decode_bus(s.bus.publish.call_args[0][0])
+    assert (published.message, published.channel) == ("Hello", channel)
+
+
+def test_relay_large_frame(server):
+    """Test that a large binary message is streamed to version 2 binary members and assembled for the rest."""
+    s = server()
+    s.bus = MagicMock()
+    conns = []
+    for encoding, framing in (("binary", 2), ("binary", 2), ("json", 2), ("binary", 1), ("binary", 2)):
+        c = blocked_connection()
+        c.buffer.framing = framing
+        s.add(c)
+        s.handle(c, CDProto.register("student", encoding))
+        s.join(c, "#cd")
+        conns.append(c)
+    sender, streamed, json_member, old_member, busy = conns
+    busy.receiving = MagicMock()  #another member's large frame is being streamed to it
+
+    payload = CDProto.encode_payload(CDProto.message("x" * 100000, "#cd"), "binary")
+    sender.sock.recv.return_value = CDProto.frame(payload, 2)
+    s.read(sender, selectors.EVENT_READ)
+    assert streamed.receiving is None  #whole frame arrived in one read
+
+    received = b"".join(bytes(f) for f in streamed.queue)
+    assert received == CDProto.frame(payload, 2)
+    assert CDProto.decode(json_member.queue[0][3:]).message == "x" * 100000
+    assert not old_member.queue  #no version 1 frame holds it: the sender is told
+    assert CDProto.decode(bytes(sender.queue[-1])[1:]).command == "error"
+    assert list(busy.held) == [CDProto.frame(payload, 2)]
+    s.bus.publish.assert_called_once_with(payload)
+
+
+def test_relay_streamed_only(server):
+    """Test that a large binary frame streamed to every member is not assembled."""
+    s = server()
+    conns = []
+    for _ in range(3):
+        c = blocked_connection()
+        c.buffer.framing = 2
+        s.add(c)
+        s.handle(c, CDProto.register("student", "binary"))
+        s.join(c, "#cd")
+        conns.append(c)
+    sender = conns[0]
+
+    payload = CDProto.encode_payload(CDProto.message("x" * 100000, "#cd"), "binary")  #past the history bound as well
+    frame = CDProto.frame(payload, 2)
+    sender.sock.recv.return_value = frame[:70000]
+    s.read(sender, selectors.EVENT_READ)
+    assert sender.relay and sender.parts is None
+    sender.sock.recv.return_value = frame[70000:]
+    s.read(sender, selectors.EVENT_READ)
+    for c in conns:
+        assert b"".join(bytes(f) for f in c.queue) == frame
+    assert s.history.report() == {}
+
+
+def test_relay_large_json_frame(server):
+    """Test that a large JSON frame is assembled and broadcast."""
+    s = server()
+    conns = []
+    for encoding in ("json", "binary"):
+        c = blocked_connection()
+        c.buffer.framing = 2
+        s.add(c)
+        s.handle(c, CDProto.register("student", encoding))
+        s.join(c, "#cd")
+        conns.append(c)
+    sender, member = conns
+
+    payload = CDProto.encode_payload(CDProto.message("y" * 100000, "#cd"), "json")
+    sender.sock.recv.return_value = CDProto.frame(payload, 2)
+    s.read(sender, selectors.EVENT_READ)
+    assert CDProto.decode(bytes(member.queue[0])[3:]).message == "y" * 100000
+    assert CDProto.decode(bytes(sender.queue[0])[3:]).message == "y" * 100000
+
+
+def test_replay_on_join(server):
+    """Test that joining a channel replays its history in one write."""
+    s = server(history=2)
+    conns = [blocked_connection(), blocked_connection()]
+    for c in conns:
+        s.add(c)
+    s.join(conns[0], "#cd")
+    for text in ("one", "two", "three"):
+        s.broadcast(CDProto.message(text, "#cd"))
+
+    s.handle(conns[1], CDProto.join("#cd"))
+    assert len(conns[1].queue) == 1
+    assert conns[1].queue[0] == b"".join(list(conns[0].queue)[1:])
+
+
+def test_selector_choice():
+    """Test that the selector implementation can be chosen by name."""
+    s = Server(port=0, selector="poll", instrument=True)
+    assert isinstance(s.selector, selectors.PollSelector)
+    assert s.stats is not None
+    s.sock.close()
+
+    with pytest.raises(ValueError):
+        Server(port=0, selector="nope")
+
+
+def test_coalescing(server):
+    """Test that with coalescing frames wait until due and then go out together."""
+    s = server(coalesce_delay=60, coalesce_bytes=1000)
+    sock = MagicMock()
+    sock.send.side_effect = len
+    sock.sendmsg.side_effect = lambda frames: sum(len(f) for f in frames)
+    c = Connection(sock)
+    s.data[c] = [None]
+    s.channels.setdefault(None, set()).add(c)
+
+    msg = CDProto.message("Hello World")
+    s.broadcast(msg)
+    s.broadcast(msg)
+    assert c in s.due and 0 < s.timeout() <= 60
+    s.flush_due()
+    assert not sock.sendmsg.called and not sock.send.called
+
+    s.due[c] = 0  #as if the delay went by
+    s.flush_due()
+    sock.sendmsg.assert_called_once()
+    assert not c.queue and not s.due and s.timeout() is None
+    assert s.sends.count == 1
+
+    big = CDProto.message("x" * 1000)
+    s.broadcast(big)  #past coalesce_bytes: sent right away
+    assert not c.queue and not s.due
@@ -0,0 +1,29 @@
+"""Tests for the event loop stats."""
+from src.stats import Histogram, LoopStats
+
+
+def test_histogram():
+    h = Histogram()
+    for value in [1] * 98 + [100, 1000]:
+        h.add(value)
+
+    assert h.count == 100
+    assert h.max == 1000
+    assert h.percentile(0.5) == 2
+    assert h.percentile(0.99) == 128
+    assert h.percentile(1) == 1000
+    assert h.summary()["mean"] == (98 + 100 + 1000) / 100
+
+
+def test_loop_stats():
+    s = LoopStats()
+    s.callback("read", 10)
+    s.callback("read", 30)
+    s.callback("accept", 5)
+    s.loop(3, 1000, 45)
+
+    dump = s.dump()
+    assert dump["iterations"] == 1
+    assert dump["callbacks"] == {"read": 2, "accept": 1}
+    assert dump["callback_us"]["read"]["max"] == 30
+    assert dump["batch"]["max"] == 3
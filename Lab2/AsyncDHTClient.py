@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import logging
+import math
+import socket
+from codec import CODECS, Chunker, CodecError
+from utils import M_BITS, RECV_BUFFER, hash_many, key_hash, split_batch
+from DHTClient import ROUND_KEYS
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    """ Hands every reply to whoever waits for its request id. """
+
+    def __init__(self, chunker):
+        self.chunker = chunker
+        self.transport = None
+        self.timer = None  # Handle of the next check for missing chunks, while a large reply comes in
+        self.waiting = {}  # Dictorary: Key = req, Value = function called with each reply to it
+        self.logger = logging.getLogger("AsyncDHTClient")
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def datagram_received(self, data, addr):
+        try:
+            out = self.chunker.message(data, addr)
+        except CodecError as error:
+            self.logger.warning("Dropping datagram from %s: %s", addr, error)
+            return
+        if out is None:  # more chunks to come
+            if self.timer is None:
+                self.check_chunks()
+            return
+        waiter = self.waiting.get(out.get("req"))
+        if waiter is not None:  # otherwise a late reply to a request already answered or given up
+            waiter(out)
+
+    def error_received(self, exc):
+        self.logger.debug("Error received: %s", exc)  # the request is retried when it times out
+
+    def check_chunks(self):
+        """ Ask again for the chunks still missing, as long as a transfer waits for some. """
+        wake = self.chunker.tick()
+        self.timer = None if wake == math.inf else asyncio.get_running_loop().call_later(max(wake - self.chunker.clock(), 0), self.check_chunks)
+
+
+class AsyncDHTClient:
+    """ DHTClient for asyncio, with the same messages on the wire.
+
+    put/get can be awaited together (e.g. with asyncio.gather); at most window
+    of them are in flight, and each is resent after timeout seconds up to
+    retries times.
+    """
+
+    def __init__(self, address, m_bits=M_BITS, algorithm="fnv", timeout=1, retries=3, window=32, codec="pickle", read="owner"):
+        self.dht_addr = address
+        self.m_bits = m_bits
+        self.algorithm = algorithm
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.nearest = read == "nearest"  # whether replicas may answer gets, as in DHTClient
+        self.chunker = Chunker(CODECS[codec], self.transmit)
+        self.transport = None
+        self.protocol = None
+        self.slots = None  # Semaphore limiting the requests in flight
+        self.hops = None  # node to node forwards taken by the last reply
+        self.requests = itertools.count(1)
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        # not connected to dht_addr: replies come from whichever node owns the key
+        self.transport, self.protocol = await loop.create_datagram_endpoint(lambda: ClientProtocol(self.chunker), local_addr=("0.0.0.0", 0))
+        self.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        self.slots = asyncio.Semaphore(self.window)
+
+    def close(self):
+        self.transport.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def send(self, msg):
+        self.chunker.send(msg, self.dht_addr)
+
+    def transmit(self, payload, address):
+        self.transport.sendto(payload, address)
+
+    async def request(self, method, args):
+        """ Send a request until it is answered; returns the reply, or None after the last retry."""
+        req = args["req"] = next(self.requests)
+        msg = {"method": method, "args": args}
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            for _ in range(self.retries + 1):
+                reply = loop.create_future()
+                self.protocol.waiting[req] = lambda out: reply.done() or reply.set_result(out)
+                self.send(msg)
+                try:
+                    out = await asyncio.wait_for(reply, self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+                finally:
+                    del self.protocol.waiting[req]
+                self.hops = out.get("hops")
+                return out
+        self.protocol.logger.error("No reply to %s %s", method, args["key"])
+        return None
+
+    async def put(self, key, value):
+        """ Store value to key in the DHT."""
+        out = await self.request("PUT", {"key": key, "value": value, "id": key_hash(key, self.m_bits, self.algorithm)})
+        return out is not None and out["method"] == "ACK"
+
+    async def get(self, key):
+        """ Retrieve key from DHT."""
+        args = {"key": key, "id": key_hash(key, self.m_bits, self.algorithm)}
+        if self.nearest:
+            args["nearest"] = True
+        out = await self.request("GET", args)
+        if out is None or out["method"] != "ACK":
+            return None
+        return out["args"]
+
+    async def put_many(self, items, timeout=5):
+        """ Store many key/value pairs (a dict) in the DHT with PUT_MANY; True once every key was acked."""
+        acked = await self.many("PUT_MANY", [(key, items[key]) for key in items], timeout)
+        return len(acked) == len(items)
+
+    async def get_many(self, keys, timeout=5):
+        """ Retrieve many keys from the DHT with GET_MANY; returns a dict with every key (None if not stored or never answered)."""
+        answers = await self.many("GET_MANY", [(key,) for key in keys], timeout)
+        return {key: answers.get(key) for key in keys}
+
+    async def many(self, method, items, timeout):
+        """ As DHTClient.many, a round of ROUND_KEYS keys at a time, its keys still waiting after timeout seconds sent again up to retries times."""
+        answers = {}
+        for first in range(0, len(items), ROUND_KEYS):
+            chunk = items[first:first + ROUND_KEYS]
+            ids = hash_many([item[0] for item in chunk], self.m_bits, self.algorithm)
+            waiting = {key: (key, key_id, *rest) for (key, *rest), key_id in zip(chunk, ids)}  # Dictorary: Key = key, Value = its item in the batch
+            req = next(self.requests)
+            replied = asyncio.Event()
+
+            def collect(out):
+                answered = out["args"]["values"] if "values" in out["args"] else dict.fromkeys(out["args"]["keys"], True)
+                for key in answered:
+                    if waiting.pop(key, None) is not None:
+                        answers[key] = answered[key]
+                replied.set()
+
+            self.protocol.waiting[req] = collect
+            try:
+                for _ in range(self.retries + 1):
+                    for batch in split_batch(list(waiting.values())):
+                        args = {"items": batch, "req": req}
+                        if method == "GET_MANY" and self.nearest:
+                            args["nearest"] = True
+                        self.send({"method": method, "args": args})
+                    while waiting:  # until timeout seconds pass without a reply
+                        replied.clear()
+                        try:
+                            await asyncio.wait_for(replied.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    if not waiting:
+                        break
+            finally:
+                del self.protocol.waiting[req]
+            if waiting:
+                self.protocol.logger.error("%d keys of %s were not answered", len(waiting), method)
+        return answers
+
+
+async def main():
+    async with AsyncDHTClient(("localhost", 5000)) as client:
+        # add objects to DHT, one stored in the first node and the other remote
+        print(await asyncio.gather(client.put("A", [0, 1, 2]), client.put("2", "xpto")))
+        # retrieve both at once
+        print(await asyncio.gather(client.get("A"), client.get("2")))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,18 +2,46 @@ import logging
 import time
 import sys
 import argparse
+import os
 from DHTNode import DHTNode
+from codec import CODECS
+from runtime import Runtime
+from storage import LogStore
+from utils import HASHES, M_BITS
 
 
-def main(number_nodes, timeout):
+def main(number_nodes, timeout, m_bits=M_BITS, algorithm="fnv", codec="pickle", directory=None, cache=0, replication=1, runtime="threads"):
     """ Script to launch several DHT nodes. """
 
+    def store(port):
+        # keystore of the node on port: in memory, or a log in directory kept across restarts
+        if directory is None:
+            return None
+        return LogStore(os.path.join(directory, f"node-{port}.log"), cache)
+
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
     # logger for the main
     logger = logging.getLogger("DHT")
+    # all the nodes on one thread, instead of a thread each
+    loop = Runtime() if runtime == "loop" else None
     # list with all the nodes
     dht = []
     # initial node on DHT
-    node = DHTNode(("localhost", 5000))
+    node = DHTNode(("localhost", 5000), m_bits=m_bits, algorithm=algorithm, codec=codec, store=store(5000), replication=replication)
+    if loop is not None:
+        loop.add(node)
+        dht.append(node)
+        logger.info(node)
+        for i in range(number_nodes - 1):
+            node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout, m_bits, algorithm, codec, store(5001 + i), replication)
+            loop.add(node, delay=0.2 * (i + 1))
+            dht.append(node)
+            logger.info(node)
+        # Run until every node has stopped
+        loop.run()
+        return
     node.start()
     dht.append(node)
     logger.info(node)
@@ -21,7 +49,7 @@ def main(number_nodes, timeout):
     for i in range(number_nodes - 1):
         time.sleep(0.2)
         # Create DHT_Node threads on ports 5001++ and with initial DHT_Node on port 5000
-        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout)
+        node = DHTNode(("localhost", 5001 + i), ("localhost", 5000), timeout, m_bits, algorithm, codec, store(5001 + i), replication)
         node.start()
         dht.append(node)
         logger.info(node)
@@ -41,6 +69,13 @@ if __name__ == "__main__":
     parser.add_argument("--savelog", default=False, action="store_true")
     parser.add_argument("--nodes", type=int, default=5)
     parser.add_argument("--timeout", type=int, default=3)
+    parser.add_argument("--bits", type=int, default=M_BITS, help="width of the identifier space")
+    parser.add_argument("--hash", choices=sorted(HASHES), default="fnv")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="pickle", help="message encoding (binary never runs code from the network)")
+    parser.add_argument("--store", metavar="DIR", help="keep each node's keys in a log in DIR instead of in memory")
+    parser.add_argument("--cache", type=int, default=0, help="values cached in memory per node with --store")
+    parser.add_argument("--replicas", type=int, default=1, help="copies of each key, on its owner and the nodes after it")
+    parser.add_argument("--runtime", choices=["threads", "loop"], default="threads", help="a thread per node, or all nodes on one event loop")
     args = parser.parse_args()
 
     logfile = {}
@@ -55,4 +90,4 @@ if __name__ == "__main__":
         )
 
 
-    main(args.nodes, timeout=args.timeout)
+    main(args.nodes, timeout=args.timeout, m_bits=args.bits, algorithm=args.hash, codec=args.codec, directory=args.store, cache=args.cache, replication=args.replicas, runtime=args.runtime)
@@ -1,38 +1,188 @@
 import socket
-import pickle
 import logging
+import itertools
+import time
+from codec import CODECS, Chunker, CodecError
+from utils import M_BITS, RECV_BUFFER, RECV_SIZE, hash_many, key_hash, split_batch
+
+ROUND_KEYS = 4096  # keys of put_many/get_many sent before waiting for their answers
 
 
 class DHTClient:
-    def __init__(self, address):
-        """ Initialize client."""
+    def __init__(self, address, m_bits=M_BITS, algorithm="fnv", timeout=1, retries=3, window=32, codec="pickle", read="owner"):
+        """ Initialize client for a ring of 2 ** m_bits ids hashed with algorithm, speaking codec.
+
+        A request not answered within timeout seconds is sent again, up to
+        retries times. pipeline() keeps up to window requests in flight.
+        Gets are answered by the owner of each key, or with read="nearest"
+        by the first of its replicas on the way.
+        """
         self.dht_addr = address
+        self.m_bits = m_bits
+        self.algorithm = algorithm
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.nearest = read == "nearest"
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        self.chunker = Chunker(CODECS[codec], self.socket.sendto)
         self.logger = logging.getLogger("DHTClient")
+        self.hops = None  # node to node forwards taken by the last request
+        self.requests = itertools.count(1)  # ids matching replies to requests
 
     def put(self, key, value):
         """ Store value to key in the DHT."""
-        msg = {"method": "PUT", "args": {"key": key, "value": value}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
-            self.logger.error("Invalid msg: %s", out)
-            return False
-        return True
+        return self.pipeline([("put", key, value)])[0]
 
     def get(self, key):
         """ Retrieve key from DHT."""
-        msg = {"method": "GET", "args": {"key": key}}
-        pickled_msg = pickle.dumps(msg)
-        self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
-        out = pickle.loads(pickled_msg)
-        if out["method"] != "ACK":
-            self.logger.error("Invalid msg: %s", out)
+        return self.pipeline([("get", key)])[0]
+
+    def request(self, operation):
+        """ Message for a ("put", key, value) or ("get", key) operation."""
+        key = operation[1]
+        args = {"key": key, "id": key_hash(key, self.m_bits, self.algorithm), "req": next(self.requests)}
+        if operation[0] == "put":
+            args["value"] = operation[2]
+            return {"method": "PUT", "args": args}
+        if self.nearest:
+            args["nearest"] = True
+        return {"method": "GET", "args": args}
+
+    def pipeline(self, operations, window=None):
+        """ Run ("put", key, value) and ("get", key) operations with up to window of them in flight.
+
+        Returns their results in order: True/False for puts, the value (or None) for gets.
+        """
+        operations = list(operations)
+        window = window or self.window
+        results = [None] * len(operations)
+        pending = {}  # Dictorary: Key = req, Value = [index, request, deadline, attempts]
+        upcoming = iter(enumerate(operations))
+
+        def submit(index, operation):
+            msg = self.request(operation)
+            pending[msg["args"]["req"]] = [index, msg, time.monotonic() + self.timeout, 1]
+            self.send(msg)
+
+        for index, operation in itertools.islice(upcoming, window):
+            submit(index, operation)
+        while pending:
+            now = time.monotonic()
+            for req, entry in list(pending.items()):
+                if entry[2] > now:
+                    continue
+                if entry[3] > self.retries:
+                    self.logger.error("No reply to %s", operations[entry[0]])
+                    del pending[req]
+                    results[entry[0]] = False if operations[entry[0]][0] == "put" else None
+                    for index, operation in itertools.islice(upcoming, 1):
+                        submit(index, operation)
+                    continue
+                entry[2], entry[3] = now + self.timeout, entry[3] + 1
+                self.send(entry[1])
+            if not pending:
+                break
+            self.socket.settimeout(max(min(self.chunker.tick(), *(entry[2] for entry in pending.values())) - now, 0.001))  # 0 would make it non-blocking
+            try:
+                out = self.receive()
+            except (socket.timeout, ConnectionRefusedError):  # nothing listening is retried like a lost datagram
+                continue
+            if out is None:
+                continue
+            entry = pending.pop(out.get("req"), None)
+            if entry is None:  # a late reply to a request already answered or given up
+                continue
+            self.hops = out.get("hops")
+            if out["method"] == "ACK":
+                results[entry[0]] = True if operations[entry[0]][0] == "put" else out.get("args")
+            elif out["method"] == "NACK":
+                results[entry[0]] = False if operations[entry[0]][0] == "put" else None
+            else:
+                self.logger.error("Invalid msg: %s", out)
+            for index, operation in itertools.islice(upcoming, 1):
+                submit(index, operation)
+        return results
+
+    def send(self, msg):
+        """ Send a request to the DHT node."""
+        self.chunker.send(msg, self.dht_addr)
+
+    def receive(self):
+        """ Next reply, or None for a chunk of one still incomplete or a datagram that does not decode."""
+        payload, addr = self.socket.recvfrom(RECV_SIZE)
+        try:
+            return self.chunker.message(payload, addr)
+        except CodecError as error:
+            self.logger.warning("Dropping datagram from %s: %s", addr, error)
             return None
-        return out["args"]
+
+    def put_many(self, items, timeout=5):
+        """ Store many key/value pairs (a dict) in the DHT; True once every key was acked."""
+        acked = self.many("PUT_MANY", [(key, items[key]) for key in items], timeout)
+        if len(acked) < len(items):
+            self.logger.error("%d of %d keys were not acked", len(items) - len(acked), len(items))
+            return False
+        return True
+
+    def get_many(self, keys, timeout=5):
+        """ Retrieve many keys from the DHT; returns a dict with every key (None if not stored or never answered)."""
+        answers = self.many("GET_MANY", [(key,) for key in keys], timeout)
+        return {key: answers.get(key) for key in keys}
+
+    def many(self, method, items, timeout):
+        """ Send (key, ...) items for method in rounds of ROUND_KEYS keys and collect the answers by key.
+
+        The nodes split each batch by owner and every owner answers the keys it
+        holds, so a round is over once all its keys were answered. Once timeout
+        seconds pass without a reply, the keys still waiting are sent again, up
+        to retries times. Rounds keep the datagrams in flight within what the
+        sockets buffer.
+        """
+        answers = {}
+        for first in range(0, len(items), ROUND_KEYS):
+            chunk = items[first:first + ROUND_KEYS]
+            ids = hash_many([item[0] for item in chunk], self.m_bits, self.algorithm)
+            waiting = {key: (key, key_id, *rest) for (key, *rest), key_id in zip(chunk, ids)}  # Dictorary: Key = key, Value = its item in the batch
+            req = next(self.requests)
+            for _ in range(self.retries + 1):
+                for batch in split_batch(list(waiting.values())):
+                    args = {"items": batch, "req": req}
+                    if method == "GET_MANY" and self.nearest:
+                        args["nearest"] = True
+                    self.send({"method": method, "args": args})
+                for out in self.replies(req, timeout):
+                    answered = out["args"]["values"] if "values" in out["args"] else dict.fromkeys(out["args"]["keys"], True)
+                    for key in answered:
+                        if waiting.pop(key, None) is not None:
+                            answers[key] = answered[key]
+                    if not waiting:
+                        break
+                if not waiting:
+                    break
+            if waiting:
+                self.logger.error("%d keys of %s were not answered", len(waiting), method)
+        return answers
+
+    def replies(self, req, timeout):
+        """ Yield the ACK_MANY replies to req that arrive until timeout seconds pass without one."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.socket.settimeout(max(min(self.chunker.tick(), deadline) - time.monotonic(), 0.001))
+            try:
+                out = self.receive()
+            except socket.timeout:
+                continue
+            if out is None:
+                continue
+            if out.get("req") != req:  # late reply to an earlier request
+                continue
+            if out["method"] != "ACK_MANY":
+                self.logger.error("Invalid msg: %s", out)
+                continue
+            deadline = time.monotonic() + timeout
+            yield out
 
 
 if __name__ == "__main__":
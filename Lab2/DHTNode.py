@@ -2,65 +2,90 @@
 import socket
 import threading
 import logging
-import pickle
-from utils import dht_hash, contains
+import itertools
+import random
+import time
+from bisect import bisect_left, insort
+from collections import deque
+from codec import CODECS, Chunker, CodecError
+from storage import MemoryStore
+from utils import M_BITS, RECV_BUFFER, RECV_SIZE, contains, hash_many, key_hash, split_batch
+
+MIGRATE_KEYS = 256  # keys handed to another node at a time
+MIGRATE_DELAY = 0.02  # seconds between two handoff batches, leaving the node to its requests
+MIGRATE_RETRY = 5  # seconds before keys handed off but not acked are sent again
+LEAVE_TIMEOUT = 10  # seconds a leaving node waits for its keys to be acked
+WRITE_WINDOW = 30  # seconds a key put on a node wins over copies of it handed off to that node
+BACKOFF = 1.5  # growth of the stabilize and fix_fingers intervals on every tick while nothing changes
 
 
 class FingerTable:
     """Finger Table."""
 
-    def __init__(self, node_id, node_addr, m_bits=10):
+    def __init__(self, node_id, node_addr, m_bits=M_BITS):
         """ Initialize Finger Table."""
         self.node_id = node_id
         self.node_addr = node_addr
         self.m_bits = m_bits
+        self.size = 2 ** m_bits
         self.fingerTable = []
         self.Idx_Table = []
         [self.fingerTable.append((node_id, node_addr)) for bit in range(self.m_bits)]  # Appending nodes to the fingertable
         [self.Idx_Table.append((bit + 1, (self.node_id + 2 ** bit) % 2 ** self.m_bits)) for bit in range(self.m_bits)]  # Creating the Idx tables for the Finger Tables
+        self.Idx_By_Id = {start: index for index, start in self.Idx_Table}  # Dictorary: Key = finger start id, Value = finger index
+        self.ring = [self.entry(node_id, node_addr)] * self.m_bits  # fingers as (clockwise offset from this node, addr), kept sorted
+
+    def entry(self, node_id, node_addr):
+        """ Key under which a finger is kept in the sorted ring. """
+        return ((node_id - self.node_id) % self.size, node_addr)
 
     def fill(self, node_id, node_addr):
         """ Fill all entries of finger_table with node_id, node_addr."""
 
         for bit in range(self.m_bits):
             self.fingerTable[bit] = (node_id, node_addr)
-        # [self.fingerTable[bit] = ((node_id, node_addr)) for bit in range(self.m_bits)]
+        self.ring = [self.entry(node_id, node_addr)] * self.m_bits
 
     def update(self, index, node_id, node_addr):
-        """Update index of table with node_id and node_addr."""
-
-        if len(self.fingerTable) > index - 1:
-            self.fingerTable.pop(index-1)
-        self.fingerTable.insert(index - 1, (node_id, node_addr))
-
+        """Update index of table with node_id and node_addr; returns whether the entry changed."""
+
+        if self.fingerTable[index - 1] == (node_id, node_addr):
+            return False
+        old = self.entry(*self.fingerTable[index - 1])
+        self.fingerTable[index - 1] = (node_id, node_addr)
+        del self.ring[bisect_left(self.ring, old)]
+        insort(self.ring, self.entry(node_id, node_addr))
+        return True
+
+    def replace(self, node_id, new_id, new_addr):
+        """Point the fingers at node_id to new_id and new_addr instead; returns whether there were any."""
+        changed = False
+        for index, (finger_id, _) in enumerate(self.fingerTable):
+            if finger_id == node_id:
+                changed = self.update(index + 1, new_id, new_addr) or changed
+        return changed
 
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
-        sorted_table = sorted(self.fingerTable)
-
-        for node in range(len(sorted_table)):
-            if (sorted_table[node][0] == identification) and (node == 0):
-                # print(self.fingerTable[node -1])
-                correct_node = sorted_table[node][1]
-                return correct_node  # return the node address that correspond to the correct key
-            elif sorted_table[node][0] >= identification:
-                correct_node = sorted_table[node - 1][1]
-                return correct_node
-        correct_node = sorted_table[-1][1]
-        return correct_node  # return the address of the last node in the finger table
+        distance = (identification - self.node_id) % self.size  # distances are measured clockwise from this node
+        position = bisect_left(self.ring, (distance,))  # first finger at or past identification
+        if position == 0 or self.ring[position - 1][0] == 0:
+            return self.fingerTable[0][1]  # with no finger before identification, it belongs to the successor
+        return self.ring[position - 1][1]
 
     def refresh(self):
         """ Retrieve finger table entries."""
         refreshed_table = []
-        [refreshed_table.append((node + 1, (self.node_id + pow(2, node)) % pow(2, self.m_bits), self.fingerTable[node][1])) for node in range(len(self.fingerTable))]
+        [refreshed_table.append(self.refresh_entry(node)) for node in range(len(self.fingerTable))]
         return refreshed_table
 
+    def refresh_entry(self, node):
+        """ (index, start id, current node address) of the entry at list index node."""
+        return node + 1, (self.node_id + pow(2, node)) % pow(2, self.m_bits), self.fingerTable[node][1]
+
     def getIdxFromId(self, id):
         """ Return index in the finger table by id """
-
-        for index in self.Idx_Table:
-            if index[1] == id:
-                return index[0]
+        return self.Idx_By_Id.get(id)
 
     def __repr__(self):
         return str(self.fingerTable)
@@ -78,17 +103,27 @@ class FingerTable:
 class DHTNode(threading.Thread):
     """ DHT Node Agent. """
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    def __init__(self, address, dht_address=None, timeout=3, m_bits=M_BITS, algorithm="fnv", codec="pickle", store=None, replication=1):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
             timeout: impacts how often stabilize algorithm is carried out
+            m_bits: width of the identifier space (every node of a ring must agree)
+            algorithm: name of the hash function in utils.HASHES (idem)
+            codec: name of the message encoding in codec.CODECS (idem)
+            store: keystore to use, one of storage.py (a MemoryStore if None)
+            replication: copies of each key, on its owner and the replication - 1 nodes after it
         """
         threading.Thread.__init__(self)
         self.done = False
-        self.identification = dht_hash(address.__str__())
+        self.m_bits = m_bits
+        self.algorithm = algorithm
+        self.chunker = Chunker(CODECS[codec], self.transmit)
+        if m_bits > getattr(self.chunker.codec, "id_bits", m_bits):
+            raise ValueError(f"the {codec} codec carries ids of {self.chunker.codec.id_bits} bits at most")
+        self.identification = self.hash(address.__str__())
         self.addr = address  # My address
         self.dht_address = dht_address  # Address of the initial Node
         if dht_address is None:
@@ -105,22 +140,55 @@ class DHTNode(threading.Thread):
             self.predecessor_id = None
             self.predecessor_addr = None
 
-        self.finger_table = FingerTable(self.identification, self.addr)
-
-        self.keystore = {}  # Where all data is stored
+        self.finger_table = FingerTable(self.identification, self.addr, m_bits)
+        self.replication = replication
+        self.successors = []  # (id, addr) of the next replication nodes in the ring, successor first
+        self.predecessors = []  # (id, addr) of the replication nodes before this one, predecessor first
+
+        self.keystore = MemoryStore() if store is None else store  # Where all data is stored
+        self.replicas = MemoryStore()  # Copies of the keys of the nodes before this one
+        self.migrations = deque()  # (key, address, method) of the keys to hand off (or replicate) to another node, in order
+        self.moving = {}  # Dictorary: Key = key handed off, Value = (address, deadline to send it again unless acked)
+        self.written = {}  # Dictorary: Key = key put here by a client, Value = clock() of the put, oldest first
+        self.next_migration = 0  # clock() when the next handoff batch may go
+        self.timeout = timeout
+        # Successors are checked every timeout / 4 seconds after a change, backing off to every 2 * timeout;
+        # one finger is fixed every timeout / m_bits seconds (a round per timeout), backing off to a round per 4 * timeout
+        self.stabilize_min, self.stabilize_max = timeout / 4, 2 * timeout
+        self.fix_min, self.fix_max = timeout / m_bits, 4 * timeout / m_bits
+        self.stabilize_interval, self.fix_interval = self.stabilize_min, self.fix_min
+        self.next_stabilize = self.next_fix = 0  # clock() of the next successor check / finger fix
+        self.next_join = 0  # clock() to send JOIN_REQ again, until joined
+        self.leave_deadline = None  # clock() to give up handing off keys, once leaving
+        self.clock = time.monotonic  # time the timers run on, a simulated one in a Runtime
+        self.next_finger = 0  # list index of the finger fixed next, round-robin
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
         self.socket.settimeout(timeout)
         self.logger = logging.getLogger("Node {}".format(self.identification))
 
+    def hash(self, key):
+        """ Identifier of key in this ring. """
+        return key_hash(key, self.m_bits, self.algorithm)
+
     def send(self, address, msg):
-        """ Send msg to address. """
-        payload = pickle.dumps(msg)
-        self.socket.sendto(payload, address)
+        """ Send msg to address, in chunks if it is large. """
+        try:
+            self.chunker.send(msg, address)
+        except CodecError as error:
+            self.logger.error("Cannot send to %s: %s", address, error)
+
+    def transmit(self, payload, address):
+        """ Send one datagram to address. """
+        try:
+            self.socket.sendto(payload, address)
+        except OSError as error:  # e.g. an address from the network that does not resolve
+            self.logger.error("Cannot send to %s: %s", address, error)
 
     def recv(self):
         """ Retrieve msg payload and from address."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            payload, addr = self.socket.recvfrom(RECV_SIZE)
         except socket.timeout:
             return None, None
 
@@ -128,6 +196,14 @@ class DHTNode(threading.Thread):
             return None, addr
         return payload, addr
 
+    def decode(self, payload, addr):
+        """ Message in payload, None if it is a chunk of one not yet complete (or, with a warning, not one of this ring's codec)."""
+        try:
+            return self.chunker.message(payload, addr)
+        except CodecError as error:
+            self.logger.warning("Dropping datagram from %s: %s", addr, error)
+            return None
+
     def node_join(self, args):
         """Process JOIN_REQ message.
 
@@ -136,6 +212,9 @@ class DHTNode(threading.Thread):
         """
 
         self.logger.debug("Node join: %s", args)
+        if (args.get("m_bits", M_BITS), args.get("hash", "fnv")) != (self.m_bits, self.algorithm):
+            self.logger.error("Refusing %s: it hashes into another identifier space", args["addr"])
+            return
         addr = args["addr"]
         identification = args["id"]
         if self.identification == self.successor_id:  # I'm the only node in the DHT
@@ -143,6 +222,7 @@ class DHTNode(threading.Thread):
             self.successor_addr = addr
 
             self.finger_table.update(1, self.successor_id, self.successor_addr)
+            self.set_successors([(identification, addr)])
 
             args = {"successor_id": self.identification, "successor_addr": self.addr}
             self.send(addr, {"method": "JOIN_REP", "args": args})
@@ -155,6 +235,7 @@ class DHTNode(threading.Thread):
             self.successor_addr = addr
 
             self.finger_table.update(1, self.successor_id, self.successor_addr)
+            self.set_successors([(identification, addr)] + self.successors)
 
             self.send(addr, {"method": "JOIN_REP", "args": args})
         else:
@@ -174,10 +255,10 @@ class DHTNode(threading.Thread):
         if contains(self.identification, self.successor_id, args["id"]):
             self.send(args["from"], {"method": "SUCCESSOR_REP",
                                      "args": {"req_id": args["id"], "successor_id": self.successor_id,
-                                              "successor_addr": self.successor_addr}})
+                                              "successor_addr": self.successor_addr, "hops": args.get("hops", 0)}})
         else:
             self.send(self.finger_table.find(args["id"]),
-                      {"method": "SUCCESSOR", "args": {"id": args["id"], "from": args["from"]}})
+                      {"method": "SUCCESSOR", "args": {"id": args["id"], "from": args["from"], "hops": args.get("hops", 0) + 1}})
 
     def notify(self, args):
         """Process NOTIFY message.
@@ -191,129 +272,507 @@ class DHTNode(threading.Thread):
         if self.predecessor_id is None or contains(
                 self.predecessor_id, self.identification, args["predecessor_id"]
         ):
+            changed = args["predecessor_id"] != self.predecessor_id
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
+            if changed:
+                self.churn()
+            if changed and self.predecessor_id != self.identification:
+                # keys up to the new predecessor are its own now
+                keys = list(self.keystore)
+                self.migrate([key for key, key_id in zip(keys, hash_many(keys, self.m_bits, self.algorithm))
+                              if not contains(self.predecessor_id, self.identification, key_id)], self.predecessor_addr)
+        if args["predecessor_id"] == self.predecessor_id:
+            self.set_predecessors([(self.predecessor_id, self.predecessor_addr)] + [tuple(node) for node in args.get("predecessors", ())])
+        self.logger.info(self)
+
+    def node_leave(self, args):
+        """Process LEAVE message: a node left the ring.
+
+        The neighbours of the node update their pointers to it; every node
+        pointing fingers at it points them to its successor instead. Besides
+        its neighbours, a leaving node tells the last node at or before
+        each id whose finger may be the node (as Chord's update_others),
+        and every node that had such fingers tells its own predecessor.
+
+        Parameters:
+            args (dict): id of the node leaving, and its predecessor and successor;
+                target: id whose last node at or before it the message is for, routed there
+        """
+
+        self.logger.debug("Node leave: %s", args)
+        self.churn()
+        if self.predecessor_id == args["id"]:
+            self.predecessor_id = args.get("predecessor_id")
+            self.predecessor_addr = args.get("predecessor_addr")
+        changed = self.finger_table.replace(args["id"], args["successor_id"], args["successor_addr"])
+        if self.successor_id == args["id"]:
+            self.successor_id = args["successor_id"]
+            self.successor_addr = args["successor_addr"]
+            changed = self.finger_table.update(1, self.successor_id, self.successor_addr) or changed
+        if any(node_id == args["id"] for node_id, _ in self.successors):
+            self.set_successors([(self.successor_id, self.successor_addr)] + [node for node in self.successors if node[0] != args["id"]])
+        if changed and self.predecessor_addr is not None:
+            self.send(self.predecessor_addr, {"method": "LEAVE", "args": dict(args, target=self.predecessor_id, hops=0)})
+        target = args.get("target")
+        if target is not None and not self.last_before(target):
+            self.send(self.finger_table.find(target), {"method": "LEAVE", "args": dict(args, hops=args.get("hops", 0) + 1)})
         self.logger.info(self)
 
-    def stabilize(self, from_id, addr):
+    def last_before(self, identification):
+        """Whether this node is the last one at or before identification."""
+        return identification == self.identification or (
+            contains(self.identification, self.successor_id, identification) and identification != self.successor_id)
+
+    def migrate(self, keys, address, method="HANDOFF"):
+        """Queue keys to be handed off (or copied, with method REPLICATE) to the node at address, MIGRATE_KEYS every MIGRATE_DELAY seconds."""
+        if keys:
+            self.logger.info("%s of %d keys to %s", method, len(keys), address)
+            self.migrations.extend((key, address, method) for key in keys)
+
+    def migrate_step(self):
+        """Send the next batch of keys to hand off, and again those sent too long ago without an ack."""
+        now = self.clock()
+        self.next_migration = now + MIGRATE_DELAY
+        for key, (address, deadline) in list(self.moving.items()):
+            if deadline < now:
+                del self.moving[key]
+                self.migrations.append((key, address, "HANDOFF"))
+        batches = {}
+        for _ in range(min(MIGRATE_KEYS, len(self.migrations))):
+            key, address, method = self.migrations.popleft()
+            if key not in self.keystore or key in self.moving:
+                continue
+            key_id = self.hash(key)
+            if method == "HANDOFF":
+                if not self.done and self.next_hop(key_id) is None:  # mine again, e.g. the new predecessor left
+                    continue
+                self.moving[key] = (address, now + MIGRATE_RETRY)
+            batches.setdefault((address, method), []).append((key, key_id, self.keystore[key]))
+        for (address, method), items in batches.items():
+            for batch in split_batch(items):
+                self.send(address, {"method": method, "args": {"items": batch, "from": self.addr}})
+
+    def handed_off(self, keys):
+        """Process the ACK_MANY of a handoff: the keys are stored by their owner, so they go from here."""
+        for key in keys:
+            if self.moving.pop(key, None) is not None and key in self.keystore:
+                if self.done or self.next_hop(self.hash(key)) is not None:
+                    if self.replication > 1:  # still a replica, as one of the next nodes of its owner
+                        self.replicas[key] = self.keystore[key]
+                    del self.keystore[key]
+                    self.written.pop(key, None)  # should the key come back, its owner then has the newer value
+
+    def handoff(self, items, address, hops=0):
+        """Store keys handed off by another node, over older copies but not over values put here since.
+
+        Parameters:
+        items: (key, key_hash, value) tuples
+        address: address of the node handing the keys off, where the acks go
+        hops: times the handoff was forwarded between nodes so far
+        """
+        if self.predecessor_id is None:  # just joined: the keys are mine as far as the sender knows, keep them
+            local, forward = items, {}
+        else:
+            local, forward = self.route_many(items)
+        for hop, batch in forward.items():
+            self.send(hop, {"method": "HANDOFF", "args": {"items": batch, "from": address, "hops": hops + 1}})
+        # a handed off copy replaces whatever is here, unless a client put the key here since
+        since = self.clock() - WRITE_WINDOW
+        new = [item for item in local if self.written.get(item[0], since) <= since]
+        self.keystore.update((key, value) for key, _, value in new)
+        self.replicate(new)
+        for keys in split_batch([key for key, _, _ in local]):
+            self.send(address, {"method": "ACK_MANY", "args": {"keys": keys}, "hops": hops})
+
+    def leave(self):
+        """Start leaving the ring: tell the neighbours and queue every key to hand to the successor."""
+        self.leave_deadline = self.clock() + LEAVE_TIMEOUT
+        if not self.inside_dht or self.successor_id == self.identification:
+            return
+        args = {"id": self.identification, "predecessor_id": self.predecessor_id, "predecessor_addr": self.predecessor_addr,
+                "successor_id": self.successor_id, "successor_addr": self.successor_addr}
+        self.send(self.successor_addr, {"method": "LEAVE", "args": args})
+        if self.predecessor_addr is not None:
+            self.send(self.predecessor_addr, {"method": "LEAVE", "args": args})
+        for bit in range(self.m_bits):
+            # the last node at or before id - 2 ** bit may have this node as finger bit + 1
+            target = (self.identification - 2 ** bit) % self.finger_table.size
+            if self.predecessor_id is None or not contains(self.predecessor_id, self.identification, target):  # else the predecessor, told already
+                self.send(self.finger_table.find(target), {"method": "LEAVE", "args": dict(args, target=target, hops=0)})
+        self.migrations.clear()
+        self.moving.clear()
+        self.replication = 1  # the successor copies the keys to its own successors
+        self.migrate(list(self.keystore), self.successor_addr)
+
+    def leaving(self):
+        """Whether the node, once left, still waits for its keys to be acked."""
+        return bool(self.migrations or self.moving) and self.clock() < self.leave_deadline
+
+    def close(self):
+        """Stop for good, once left."""
+        if self.migrations or self.moving:
+            self.logger.warning("Left with %d keys not handed off", len({key for key, *_ in self.migrations} | set(self.moving)))
+        self.keystore.close()
+        self.socket.close()
+
+    def stabilize(self, from_id, addr, from_addr=None, successors=()):
         """Process STABILIZE protocol.
             Updates all successor pointers.
 
         Parameters:
             from_id: id of the predecessor of node with address addr
             addr: address of the node sending stabilize message
+            from_addr: address of that predecessor (addr if not given)
+            successors: successor list of the node sending stabilize message
         """
 
         self.logger.debug("Stabilize: %s %s", from_id, addr)
+        nodes = [(self.successor_id, self.successor_addr)] + [tuple(node) for node in successors]
         if from_id is not None and contains(
                 self.identification, self.successor_id, from_id
         ):
             # Update our successor
+            if from_id != self.successor_id:
+                self.churn()
             self.successor_id = from_id
-            self.successor_addr = addr
+            self.successor_addr = addr if from_addr is None else from_addr
             self.finger_table.fill(self.successor_id, self.successor_addr)
+            nodes.insert(0, (self.successor_id, self.successor_addr))
+        self.set_successors(nodes)
 
         # notify successor of our existence, so it can update its predecessor record
         args = {"predecessor_id": self.identification, "predecessor_addr": self.addr}
+        if self.replication > 1:  # and of the nodes before us, whose keys it may hold copies of
+            args["predecessors"] = self.predecessors[:self.replication - 1]
         self.send(self.successor_addr, {"method": "NOTIFY", "args": args})
 
-        [(self.send(node[2], {"method": "SUCCESSOR", "args": {"id": node[1], "from": self.addr}})) for node in self.finger_table.refresh()]
-
-    def put(self, key, value, address):
+    def check_successor(self):
+        """Timer: ask the successor for its predecessor, starting the stabilize protocol."""
+        self.send(self.successor_addr, {"method": "PREDECESSOR"})
+        self.next_stabilize = self.clock() + self.stabilize_interval
+        self.stabilize_interval = min(self.stabilize_interval * BACKOFF, self.stabilize_max)
+
+    def fix_finger(self):
+        """Timer: look the next finger up again, one per tick as in Chord's fix_fingers."""
+        _, start, _ = self.finger_table.refresh_entry(self.next_finger)
+        # resolved from here, not asked of the finger itself: it may have left the ring
+        self.get_successor({"id": start, "from": self.addr})
+        self.next_finger = (self.next_finger + 1) % self.m_bits
+        self.next_fix = self.clock() + self.fix_interval
+        self.fix_interval = min(self.fix_interval * BACKOFF, self.fix_max)
+
+    def churn(self):
+        """The neighbourhood of this node changed: check successor and fingers often again."""
+        self.stabilize_interval, self.fix_interval = self.stabilize_min, self.fix_min
+        self.next_stabilize = min(self.next_stabilize, self.clock() + self.stabilize_min)
+        self.next_fix = min(self.next_fix, self.clock() + self.fix_min)
+
+    def set_successors(self, nodes):
+        """Keep the first replication nodes (id, addr) other than self as successor list, copying the keys to new replicas."""
+        successors = []
+        for node_id, node_addr in nodes:
+            if node_id == self.identification or len(successors) == self.replication:
+                break
+            if all(node_id != known for known, _ in successors):
+                successors.append((node_id, tuple(node_addr)))
+        replicas = set(successors[:self.replication - 1]) - set(self.successors[:self.replication - 1])
+        if successors != self.successors:
+            self.churn()
+        self.successors = successors
+        for _, node_addr in replicas:
+            self.migrate(list(self.keystore), node_addr, "REPLICATE")
+
+    def set_predecessors(self, nodes):
+        """Keep the first replication nodes (id, addr) other than self as predecessor list, dropping the copies no longer kept here.
+
+        The replication - 1 nodes before this one list it among their
+        successors and copy their keys here; the keys of any node before
+        them are replicated elsewhere now, so their copies here would only
+        go stale.
+        """
+        predecessors = []
+        for node_id, node_addr in nodes:
+            if node_id == self.identification or len(predecessors) == self.replication:
+                break
+            if all(node_id != known for known, _ in predecessors):
+                predecessors.append((node_id, tuple(node_addr)))
+        if predecessors == self.predecessors:
+            return
+        self.predecessors = predecessors
+        if len(predecessors) < self.replication:  # a ring this small has copies of every key on every node
+            return
+        first, last = predecessors[-1][0], predecessors[0][0]  # the copies here are of the keys in (first, last]
+        keys = list(self.replicas)
+        stale = [key for key, key_id in zip(keys, hash_many(keys, self.m_bits, self.algorithm)) if not contains(first, last, key_id)]
+        if stale:
+            self.logger.info("Dropping %d copies of keys no longer replicated here", len(stale))
+        for key in stale:
+            del self.replicas[key]
+
+    def replicate(self, items):
+        """Copy (key, key_hash, value) items stored here to the next replication - 1 nodes."""
+        if not items:
+            return
+        for _, node_addr in self.successors[:self.replication - 1]:
+            for batch in split_batch(items):
+                self.send(node_addr, {"method": "REPLICATE", "args": {"items": batch, "from": self.addr}})
+
+    def next_hop(self, key_hash):
+        """Address to forward a request for key_hash to, None when it is stored here."""
+        if self.successor_id == self.identification:  # I'm the only node in the DHT
+            return None
+        if self.predecessor_id is not None and contains(self.predecessor_id, self.identification, key_hash):
+            return None
+        if contains(self.identification, self.successor_id, key_hash):
+            return self.successor_addr
+        return self.finger_table.find(key_hash)
+
+    def put(self, key, value, address, hops=0, key_id=None, req=None):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        hops: times the request was forwarded between nodes so far
+        key_id: hash of key, when already known
+        req: id the client gave the request, echoed in the reply
         """
-        key_hash = dht_hash(key)
+        key_hash = self.hash(key) if key_id is None else key_id
         self.logger.debug("Put: %s %s", key, key_hash)
 
-        if contains(self.predecessor_id, self.identification, key_hash):
+        put_message = {"method": "PUT", "args": {"key": key, "value": value, "from": address, "hops": hops + 1, "id": key_hash, "req": req}}
+
+        hop = self.next_hop(key_hash)
+        if hop is None:
             self.keystore[key] = value
-            self.send(address, {"method": "ACK"})
-        elif contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "PUT", "args": {"key": key, "value": value, "from": address}})
+            self.wrote([key])
+            self.replicate([(key, key_hash, value)])
+            self.send(address, {"method": "ACK", "hops": hops, "req": req})
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "PUT", "args": {"key": key, "value": value, "from": address}})
+            self.send(hop, put_message)
 
-    def get(self, key, address):
+    def get(self, key, address, hops=0, key_id=None, req=None, nearest=False):
         """Retrieve value from DHT.
 
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        hops: times the request was forwarded between nodes so far
+        key_id: hash of key, when already known
+        req: id the client gave the request, echoed in the reply
+        nearest: whether a replica may answer instead of the owner
         """
-        key_hash = dht_hash(key)
+        key_hash = self.hash(key) if key_id is None else key_id
         self.logger.debug("Get: %s %s", key, key_hash)
 
-        get_message = {"method": "GET", "args": {"key": key, "from": address}}
-
-        if contains(self.predecessor_id, self.identification, key_hash):
-            self.send(address, {"method": "ACK", "args": self.keystore[key]})
-        elif contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "GET", "args": {"key": key, "from": address}})
+        get_message = {"method": "GET", "args": {"key": key, "from": address, "hops": hops + 1, "id": key_hash, "req": req}}
+
+        hop = self.next_hop(key_hash)
+        if hop is None and key not in self.keystore:
+            self.send(address, {"method": "NACK", "hops": hops, "req": req})
+        elif hop is None:
+            self.send(address, {"method": "ACK", "args": self.keystore[key], "hops": hops, "req": req})
+        elif nearest and key in self.replicas:
+            self.send(address, {"method": "ACK", "args": self.replicas[key], "hops": hops, "req": req})
+        elif nearest and self.successors and contains(self.identification, self.successor_id, key_hash):
+            # the owner is the successor: any of the replicas from here on can answer, which spreads a hot key
+            get_message["args"]["nearest"] = True
+            self.send(random.choice(self.successors)[1], get_message)
+        elif nearest and self.replica_owner(key_hash) is not None:
+            # a replica missing the key (not copied yet): straight to its owner, as an owner read
+            self.send(self.replica_owner(key_hash), get_message)
         else:
-            self.send(self.finger_table.find(self.successor_id), {"method": "GET", "args": {"key": key, "from": address}})
-
-    def run(self):
-        self.socket.bind(self.addr)
+            if nearest:
+                get_message["args"]["nearest"] = True
+            self.send(hop, get_message)
+
+    def replica_owner(self, key_hash):
+        """Address of the predecessor owning key_hash when this node keeps a copy of its keys, else None."""
+        for (node_id, node_addr), (before_id, _) in zip(self.predecessors, self.predecessors[1:]):
+            if contains(before_id, node_id, key_hash):
+                return node_addr
+        return None
+
+    def route_many(self, items):
+        """Split (key, key_hash, ...) items into the local ones and one list per next hop."""
+        local, forward = [], {}
+        for item in items:
+            hop = self.next_hop(item[1])
+            if hop is None:
+                local.append(item)
+            else:
+                forward.setdefault(hop, []).append(item)
+        return local, forward
+
+    def put_many(self, items, address, hops=0, req=None):
+        """Store many values in DHT.
 
-        # Loop until joining the DHT
-        while not self.inside_dht:
-            join_msg = {
-                "method": "JOIN_REQ",
-                "args": {"addr": self.addr, "id": self.identification},
-            }
-            self.send(self.dht_address, join_msg)
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.debug("O: %s", output)
-                if output["method"] == "JOIN_REP":
-                    args = output["args"]
-                    self.successor_id = args["successor_id"]
-                    self.successor_addr = args["successor_addr"]
-
-                    self.finger_table.fill(self.successor_id, self.successor_addr)
+        Parameters:
+        items: (key, key_hash, value) tuples
+        address: address where to send the ack with the stored keys
+        hops: times the request was forwarded between nodes so far
+        req: id the client gave the request, echoed in the replies
+        """
+        local, forward = self.route_many(items)
+        self.logger.debug("Put many: %d here, %d forwarded", len(local), len(items) - len(local))
+        for hop, batch in forward.items():
+            self.send(hop, {"method": "PUT_MANY", "args": {"items": batch, "from": address, "hops": hops + 1, "req": req}})
+        self.keystore.update((key, value) for key, _, value in local)
+        self.wrote([key for key, _, _ in local])
+        self.replicate(local)
+        for keys in split_batch([key for key, _, _ in local]):
+            self.send(address, {"method": "ACK_MANY", "args": {"keys": keys}, "hops": hops, "req": req})
+
+    def wrote(self, keys):
+        """Remember keys were put here just now, forgetting the puts older than WRITE_WINDOW."""
+        now = self.clock()
+        for key in keys:
+            self.written.pop(key, None)
+            self.written[key] = now
+        for key, when in list(itertools.islice(self.written.items(), len(keys))):
+            if when > now - WRITE_WINDOW:
+                break
+            del self.written[key]
+
+    def get_many(self, items, address, hops=0, req=None, nearest=False):
+        """Retrieve many values from DHT.
 
-                    self.inside_dht = True
-                    self.logger.info(self)
+        Parameters:
+        items: (key, key_hash) tuples
+        address: address where to send the found values (None for missing keys)
+        hops: times the request was forwarded between nodes so far
+        req: id the client gave the request, echoed in the replies
+        nearest: whether replicas may answer instead of the owners
+        """
+        local, forward = self.route_many(items)
+        self.logger.debug("Get many: %d here, %d forwarded", len(local), len(items) - len(local))
+        values = [(key, self.keystore.get(key)) for key, _ in local]
+        for hop, batch in forward.items():
+            if nearest:
+                values.extend((key, self.replicas[key]) for key, _ in batch if key in self.replicas)
+                batch = [item for item in batch if item[0] not in self.replicas]
+                if not batch:
+                    continue
+            args = {"items": batch, "from": address, "hops": hops + 1, "req": req}
+            if nearest:
+                args["nearest"] = True
+            self.send(hop, {"method": "GET_MANY", "args": args})
+        for values in split_batch(values):
+            self.send(address, {"method": "ACK_MANY", "args": {"values": dict(values)}, "hops": hops, "req": req})
+
+    def tick(self):
+        """Run the timers that are due; returns the clock() at which the next one is."""
+        now = self.clock()
+        chunks = self.chunker.tick()  # chunks of large messages to ask for again
+        if not self.inside_dht:
+            if now >= self.next_join:
+                # Until joining the DHT
+                join_msg = {
+                    "method": "JOIN_REQ",
+                    "args": {"addr": self.addr, "id": self.identification, "m_bits": self.m_bits, "hash": self.algorithm},
+                }
+                self.send(self.dht_address, join_msg)
+                self.next_join = now + self.timeout
+            return min(self.next_join, chunks)
+        wake = now + self.timeout
+        if self.leave_deadline is None:
+            if now >= self.next_stabilize:
+                self.check_successor()
+            if now >= self.next_fix:
+                self.fix_finger()
+            wake = min(self.next_stabilize, self.next_fix)
+        if self.migrations or self.moving:
+            if now >= self.next_migration:
+                self.migrate_step()
+            wake = min(wake, self.next_migration)
+        return min(wake, chunks)
+
+    def receive(self, payload, addr):
+        """Process a datagram from addr."""
+        output = self.decode(payload, addr)
+        if output is None:
+            return
+        if not self.inside_dht:
+            self.logger.debug("O: %s", output)
+            if output["method"] == "JOIN_REP":
+                args = output["args"]
+                self.successor_id = args["successor_id"]
+                self.successor_addr = args["successor_addr"]
+
+                self.finger_table.fill(self.successor_id, self.successor_addr)
+                self.set_successors([(self.successor_id, self.successor_addr)])
+
+                self.inside_dht = True
+                self.logger.info(self)
+            return
+        if self.leave_deadline is not None:  # left: only the acks of the keys handed off matter, and other nodes leaving too
+            if output["method"] == "ACK_MANY":
+                self.handed_off(output["args"].get("keys", []))
+            elif output["method"] == "LEAVE":
+                self.node_leave(output["args"])  # to pass it on to the nodes before this one
+            return
+        self.logger.info("O: %s", output)
+        if output["method"] == "JOIN_REQ":
+            self.node_join(output["args"])
+        elif output["method"] == "NOTIFY":
+            self.notify(output["args"])
+        elif output["method"] == "PUT":
+            self.put(
+                output["args"]["key"],
+                output["args"]["value"],
+                output["args"].get("from", addr),
+                output["args"].get("hops", 0),
+                output["args"].get("id"),
+                output["args"].get("req"),
+            )
+        elif output["method"] == "GET":
+            self.get(output["args"]["key"], output["args"].get("from", addr), output["args"].get("hops", 0), output["args"].get("id"), output["args"].get("req"), output["args"].get("nearest", False))
+        elif output["method"] == "PUT_MANY":
+            self.put_many(output["args"]["items"], output["args"].get("from", addr), output["args"].get("hops", 0), output["args"].get("req"))
+        elif output["method"] == "GET_MANY":
+            self.get_many(output["args"]["items"], output["args"].get("from", addr), output["args"].get("hops", 0), output["args"].get("req"), output["args"].get("nearest", False))
+        elif output["method"] == "PREDECESSOR":
+            # Reply with predecessor id
+            self.send(
+                addr, {"method": "STABILIZE", "args": self.predecessor_id, "addr": self.predecessor_addr, "successors": self.successors}
+            )
+        elif output["method"] == "SUCCESSOR":
+            # Reply with successor of id
+            self.get_successor(output["args"])
+        elif output["method"] == "STABILIZE":
+            # Initiate stabilize protocol
+            self.stabilize(output["args"], addr, output.get("addr"), output.get("successors", ()))
+        elif output["method"] == "SUCCESSOR_REP":
+            index = self.finger_table.getIdxFromId(output["args"]["req_id"])
+            if index is not None and self.finger_table.update(index, output["args"]["successor_id"], output["args"]["successor_addr"]):
+                self.churn()
+        elif output["method"] == "REPLICATE":
+            self.replicas.update((key, value) for key, _, value in output["args"]["items"])
+        elif output["method"] == "HANDOFF":
+            self.handoff(output["args"]["items"], output["args"].get("from", addr), output["args"].get("hops", 0))
+        elif output["method"] == "ACK_MANY":
+            self.handed_off(output["args"].get("keys", []))
+        elif output["method"] == "LEAVE":
+            self.node_leave(output["args"])
+
+    def step(self):
+        """Run due timers, then wait for a datagram until the next one (the thread's blocking loop)."""
+        wake = self.tick()
+        self.socket.settimeout(max(wake - self.clock(), 0.001))
+        payload, addr = self.recv()
+        if payload is not None:
+            self.receive(payload, addr)
 
+    def run(self):
+        self.socket.bind(self.addr)
         while not self.done:
-            payload, addr = self.recv()
-            if payload is not None:
-                output = pickle.loads(payload)
-                self.logger.info("O: %s", output)
-                if output["method"] == "JOIN_REQ":
-                    self.node_join(output["args"])
-                elif output["method"] == "NOTIFY":
-                    self.notify(output["args"])
-                elif output["method"] == "PUT":
-                    self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
-                    )
-                elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
-                elif output["method"] == "PREDECESSOR":
-                    # Reply with predecessor id
-                    self.send(
-                        addr, {"method": "STABILIZE", "args": self.predecessor_id}
-                    )
-                elif output["method"] == "SUCCESSOR":
-                    # Reply with successor of id
-                    self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
-                    # Initiate stabilize protocol
-                    self.stabilize(output["args"], addr)
-                elif output["method"] == "SUCCESSOR_REP":
-                    self.finger_table.update(self.finger_table.getIdxFromId(output["args"]["req_id"]), output["args"]["successor_id"], output["args"]["successor_addr"])
-            else:  # timeout occurred, lets run the stabilize algorithm
-                # Ask successor for predecessor, to start the stabilize process
-                self.send(self.successor_addr, {"method": "PREDECESSOR"})
+            self.step()
+        self.leave()
+        while self.leaving():
+            self.step()
+        self.close()
 
     def __str__(self):
         return "Node ID: {}; DHT: {}; Successor: {}; Predecessor: {}; FingerTable: {}".format(
@@ -0,0 +1,52 @@
+"""Benchmark bulk loading a running DHT key by key, pipelined and with put_many/get_many.
+
+Start a ring first (python3 DHT.py), then run from the Lab2 directory:
+
+    $ python3 -m bench.bulk --keys 100000
+"""
+import argparse
+import time
+
+from DHTClient import DHTClient
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(address, keys, single, window):
+    client = DHTClient(address)
+    items = {f"bulk-{i}": i for i in range(keys)}
+
+    ok, elapsed = timed(client.put_many, items)
+    print(f"put_many  {keys:>7} keys in {elapsed:7.2f}s ({keys / elapsed:8.0f} keys/s) {'ok' if ok else 'INCOMPLETE'}")
+    values, elapsed = timed(client.get_many, list(items))
+    correct = sum(values.get(key) == value for key, value in items.items())
+    print(f"get_many  {keys:>7} keys in {elapsed:7.2f}s ({keys / elapsed:8.0f} keys/s) {correct} correct")
+
+    sample = list(items)[:single]
+    _, elapsed = timed(lambda: [client.put(key, items[key]) for key in sample])
+    print(f"put       {single:>7} keys in {elapsed:7.2f}s ({single / elapsed:8.0f} keys/s)")
+    _, elapsed = timed(lambda: [client.get(key) for key in sample])
+    print(f"get       {single:>7} keys in {elapsed:7.2f}s ({single / elapsed:8.0f} keys/s)")
+
+    sample = list(items)[:single * 10]
+    results, elapsed = timed(client.pipeline, [("put", key, items[key]) for key in sample], window)
+    print(f"pipelined {len(sample):>7} puts in {elapsed:7.2f}s ({len(sample) / elapsed:8.0f} keys/s) window {window}, {results.count(True)} acked")
+    results, elapsed = timed(client.pipeline, [("get", key) for key in sample], window)
+    correct = sum(value == items[key] for key, value in zip(sample, results))
+    print(f"pipelined {len(sample):>7} gets in {elapsed:7.2f}s ({len(sample) / elapsed:8.0f} keys/s) window {window}, {correct} correct")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--single", type=int, default=2000, help="keys sent one request at a time, for comparison")
+    parser.add_argument("--window", type=int, default=32, help="requests in flight when pipelining")
+    args = parser.parse_args()
+
+    main((args.host, args.port), args.keys, args.single, args.window)
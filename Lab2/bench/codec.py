@@ -0,0 +1,47 @@
+"""Microbenchmark of the message codecs: encode/decode time and datagram size.
+
+Run from the Lab2 directory:
+
+    $ python3 -m bench.codec
+"""
+import argparse
+import timeit
+
+from codec import CODECS
+
+ADDR = ("localhost", 5003)
+
+MESSAGES = {
+    "JOIN_REQ": {"method": "JOIN_REQ", "args": {"addr": ADDR, "id": 257, "m_bits": 10, "hash": "fnv"}},
+    "NOTIFY": {"method": "NOTIFY", "args": {"predecessor_id": 257, "predecessor_addr": ADDR}},
+    "STABILIZE": {"method": "STABILIZE", "args": 654},
+    "SUCCESSOR": {"method": "SUCCESSOR", "args": {"id": 386, "from": ADDR, "hops": 2}},
+    "SUCCESSOR_REP": {"method": "SUCCESSOR_REP", "args": {"req_id": 386, "successor_id": 654, "successor_addr": ADDR, "hops": 2}},
+    "PUT": {"method": "PUT", "args": {"key": "user:1234", "id": 921, "value": [0, 1, 2], "req": 17, "from": ("127.0.0.1", 40123), "hops": 1}},
+    "GET": {"method": "GET", "args": {"key": "user:1234", "id": 921, "req": 18, "from": ("127.0.0.1", 40123), "hops": 1}},
+    "ACK (get)": {"method": "ACK", "args": {"name": "Aveiro", "tags": ["a", "b"], "score": 3.5}, "hops": 2, "req": 18},
+    "PUT_MANY (100)": {"method": "PUT_MANY", "args": {"items": [(f"key-{i}", i * 7 % 1024, i) for i in range(100)], "req": 19, "hops": 0}},
+}
+
+
+def main(number):
+    names = sorted(CODECS)
+    print(f"{'message':<15}" + "".join(f"{name + ' B':>10}{'enc us':>9}{'dec us':>9}" for name in names))
+    for label, msg in MESSAGES.items():
+        row = f"{label:<15}"
+        for name in names:
+            codec = CODECS[name]
+            payload = codec.encode(msg)
+            assert codec.decode(payload) == msg, (name, label)
+            encode = timeit.timeit(lambda: codec.encode(msg), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(payload), number=number) / number * 1e6
+            row += f"{len(payload):>10}{encode:>9.2f}{decode:>9.2f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="timed repetitions per message")
+    args = parser.parse_args()
+
+    main(args.number)
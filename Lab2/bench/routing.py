@@ -0,0 +1,163 @@
+"""Benchmark Chord lookup path length against ring size.
+
+Starts a ring of DHTNode threads on this machine, waits for the finger
+tables to settle and then counts the hops taken by PUT and GET requests.
+Run from the Lab2 directory:
+
+    $ python3 -m bench.routing --nodes 4 8 16
+
+With --runtime loop the nodes run on a single thread (runtime.Runtime),
+and with --runtime simulated also over an in-process network, in
+simulated time, which takes rings of hundreds of nodes:
+
+    $ python3 -m bench.routing --runtime simulated --nodes 64 256 1024 --bits 16
+"""
+import argparse
+import math
+import random
+import socket
+import statistics
+import time
+
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from runtime import Runtime
+from utils import HASHES, M_BITS, key_hash
+
+
+def ring_ports(base, count, bits=M_BITS, algorithm="fnv"):
+    """Ports from base on whose node ids do not collide."""
+    ports, ids = [], set()
+    port = base
+    while len(ports) < count:
+        identification = key_hash(("localhost", port).__str__(), bits, algorithm)
+        if identification not in ids:
+            ids.add(identification)
+            ports.append(port)
+        port += 1
+    return ports
+
+
+def start_ring(ports, timeout, bits=M_BITS, algorithm="fnv"):
+    """Start one node per port, all joining through the first."""
+    first = ("localhost", ports[0])
+    ring = [DHTNode(first, timeout=timeout, m_bits=bits, algorithm=algorithm)]
+    ring[0].start()
+    for port in ports[1:]:
+        time.sleep(0.2)  # as DHT.py does, joins through one node are not concurrent-safe
+        node = DHTNode(("localhost", port), first, timeout, bits, algorithm)
+        node.start()
+        ring.append(node)
+    return ring
+
+
+def converged(ring):
+    """True once every successor, predecessor and finger points where it should."""
+    ids = sorted(node.identification for node in ring)
+
+    def successor(identification):
+        return next((i for i in ids if i >= identification), ids[0])
+
+    for node in ring:
+        index = ids.index(node.identification)
+        if node.successor_id != ids[(index + 1) % len(ids)] or node.predecessor_id != ids[index - 1]:
+            return False
+        if [finger[0] for finger in node.finger_table.as_list] != [successor(start) for _, start, _ in node.finger_table.refresh()]:
+            return False
+    return True
+
+
+def start_runtime(ports, timeout, bits=M_BITS, algorithm="fnv", simulated=False, **settings):
+    """Host one node per port on a Runtime, all joining through the first (settings go to each DHTNode)."""
+    runtime = Runtime(simulated=simulated)
+    first = ("localhost", ports[0])
+    for i, port in enumerate(ports):
+        runtime.add(DHTNode(("localhost", port), None if i == 0 else first, timeout, bits, algorithm, **settings), delay=0.2 * i)
+    return runtime
+
+
+def measure_runtime(runtime, keys):
+    """As measure, with the requests sent by the runtime."""
+    hops, lost = [], 0
+    for key in keys:
+        for method in ("PUT", "GET"):
+            node = random.choice(runtime.nodes)
+            args = {"key": key, "id": key_hash(key, node.m_bits, node.algorithm)}
+            if method == "PUT":
+                args["value"] = key
+            out = runtime.request(node.addr, method, args)
+            if out is None:
+                lost += 1
+            else:
+                hops.append(out["hops"])
+    return hops, lost
+
+
+def stop_ring(ring):
+    for node in ring:
+        node.done = True
+    for node in ring:
+        node.join()
+
+
+def measure(ring, keys):
+    """Hops of a PUT and a GET of each key, each sent to a random node."""
+    hops, lost = [], 0
+    for key in keys:
+        for request in ("put", "get"):
+            node = random.choice(ring)
+            client = DHTClient(node.addr, node.m_bits, node.algorithm)
+            client.socket.settimeout(2)
+            try:
+                if request == "put":
+                    client.put(key, key)
+                else:
+                    client.get(key)
+                hops.append(client.hops)
+            except socket.timeout:
+                lost += 1
+            client.socket.close()
+    return hops, lost
+
+
+def main(sizes, keys, settle, timeout, base, bits=M_BITS, algorithm="fnv", runtime="threads"):
+    print(f"{'nodes':>6} {'mean hops':>10} {'max':>5} {'log2(N)/2':>10} {'lost':>5} {'settled s':>10}")
+    for size in sizes:
+        ports = ring_ports(base, size, bits, algorithm)
+        if runtime == "threads":
+            ring = start_ring(ports, timeout, bits, algorithm)
+            clock, wait = time.monotonic, lambda: time.sleep(0.5)
+        else:
+            host = start_runtime(ports, timeout, bits, algorithm, runtime == "simulated")
+            ring = list(host.nodes)
+            clock, wait = host.clock, lambda: host.run(0.5)
+        try:
+            start = clock()
+            while not converged(ring) and clock() - start < settle:
+                wait()
+            if not converged(ring):
+                print(f"{size:>6} ring did not converge in {settle}s")
+                continue
+            settled = clock() - start
+            keys_used = [f"key-{i}" for i in range(keys)]
+            hops, lost = measure(ring, keys_used) if runtime == "threads" else measure_runtime(host, keys_used)
+        finally:
+            stop_ring(ring) if runtime == "threads" else host.stop()
+            base += 2 * size  # a fresh set of ports for the next ring
+        mean = statistics.mean(hops) if hops else float("nan")
+        print(f"{size:>6} {mean:>10.2f} {max(hops, default=0):>5} {math.log2(size) / 2:>10.2f} {lost:>5} {settled:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--settle", type=float, default=60, help="seconds the finger tables get to converge")
+    parser.add_argument("--timeout", type=float, default=0.5, help="node timeout, i.e. the stabilize interval")
+    parser.add_argument("--base-port", type=int, default=7000)
+    parser.add_argument("--bits", type=int, default=M_BITS, help="width of the identifier space")
+    parser.add_argument("--hash", choices=sorted(HASHES), default="fnv")
+    parser.add_argument("--runtime", choices=["threads", "loop", "simulated"], default="threads", help="a thread per node, or all nodes on one loop (over UDP or simulated)")
+    args = parser.parse_args()
+
+    main(args.nodes, args.keys, args.settle, args.timeout, args.base_port, args.bits, args.hash, args.runtime)
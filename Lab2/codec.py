@@ -0,0 +1,550 @@
+""" Encodings of the DHT messages on the wire. """
+import itertools
+import math
+import pickle
+import struct
+import time
+
+
+class CodecError(ValueError):
+    """ Datagram that is not a message of the codec. """
+
+
+class PickleCodec:
+    """ The original encoding: the pickled message dict. Only for trusted rings, unpickling runs code. """
+
+    name = "pickle"
+
+    def encode(self, msg):
+        return pickle.dumps(msg)
+
+    def decode(self, payload):
+        try:
+            return pickle.loads(payload)
+        except Exception as error:
+            raise CodecError(error) from error
+
+
+# Fields of each message, as (path in the message dict, type, presence): required fields are always there;
+# an optional one missing from the dict (or None) is left out, a nullable one decodes to None then
+SCHEMAS = {
+    "JOIN_REQ": [(("args", "addr"), "addr", "required"), (("args", "id"), "id", "required"), (("args", "m_bits"), "int", "optional"), (("args", "hash"), "str", "optional")],
+    "JOIN_REP": [(("args", "successor_id"), "id", "required"), (("args", "successor_addr"), "addr", "required")],
+    "NOTIFY": [(("args", "predecessor_id"), "id", "required"), (("args", "predecessor_addr"), "addr", "required"), (("args", "predecessors"), "nodes", "optional")],
+    "PREDECESSOR": [],
+    "STABILIZE": [(("args",), "id", "nullable"), (("addr",), "addr", "optional"), (("successors",), "nodes", "optional")],  # args is the predecessor id
+    "SUCCESSOR": [(("args", "id"), "id", "required"), (("args", "from"), "addr", "required"), (("args", "hops"), "int", "optional")],
+    "SUCCESSOR_REP": [(("args", "req_id"), "id", "required"), (("args", "successor_id"), "id", "required"), (("args", "successor_addr"), "addr", "required"),
+                      (("args", "hops"), "int", "optional")],
+    "PUT": [(("args", "key"), "str", "required"), (("args", "id"), "id", "optional"), (("args", "value"), "value", "required"), (("args", "req"), "id", "optional"),
+            (("args", "from"), "addr", "optional"), (("args", "hops"), "int", "optional")],
+    "GET": [(("args", "key"), "str", "required"), (("args", "id"), "id", "optional"), (("args", "req"), "id", "optional"), (("args", "from"), "addr", "optional"),
+            (("args", "hops"), "int", "optional"), (("args", "nearest"), "flag", "optional")],
+    "PUT_MANY": [(("args", "items"), "entries", "required"), (("args", "req"), "id", "optional"), (("args", "from"), "addr", "optional"), (("args", "hops"), "int", "optional")],
+    "GET_MANY": [(("args", "items"), "keys", "required"), (("args", "req"), "id", "optional"), (("args", "from"), "addr", "optional"), (("args", "hops"), "int", "optional"),
+                 (("args", "nearest"), "flag", "optional")],
+    "ACK": [(("args",), "value", "optional"), (("hops",), "int", "optional"), (("req",), "id", "optional")],
+    "NACK": [(("hops",), "int", "optional"), (("req",), "id", "optional")],
+    "ACK_MANY": [(("args", "keys"), "names", "optional"), (("args", "values"), "values", "optional"), (("hops",), "int", "optional"), (("req",), "id", "optional")],
+    "CHUNK": [(("args", "id"), "id", "required"), (("args", "seq"), "int", "required"), (("args", "total"), "int", "required"), (("args", "data"), "bytes", "required")],
+    "HANDOFF": [(("args", "items"), "entries", "required"), (("args", "from"), "addr", "optional"), (("args", "hops"), "int", "optional")],
+    "LEAVE": [(("args", "id"), "id", "required"), (("args", "predecessor_id"), "id", "optional"), (("args", "predecessor_addr"), "addr", "optional"),
+              (("args", "successor_id"), "id", "required"), (("args", "successor_addr"), "addr", "required"), (("args", "target"), "id", "optional"),
+              (("args", "hops"), "int", "optional")],
+    "REPLICATE": [(("args", "items"), "entries", "required"), (("args", "from"), "addr", "optional")],
+    "RESEND": [(("args", "id"), "id", "required"), (("args", "seqs"), "value", "required")],  # CHUNKs asked (again) of a transfer
+}
+METHODS = list(SCHEMAS)  # method codes are the positions in this list
+MAGIC = 0xD8  # first byte of every binary message (0xD7 was the varint encoding before); a pickle starts with 0x80
+ID_BITS = 32  # ids (and request ids) are carried as unsigned 32 bit ints
+MAX_DEPTH = 32  # nesting of values accepted when decoding
+COLUMN_ITEMS = 8  # items of a batch or container from which ints or strs alike are packed together
+CHUNK_BYTES = 60 * 1024  # encoded messages larger than this are sent as CHUNKs of this size, within a UDP datagram
+MAX_CHUNKS = 64  # CHUNKs of the largest message accepted (about 3.75 MiB)
+CHUNK_WINDOW = 4  # CHUNKs of a transfer in flight at once, well within a stock socket receive buffer
+CHUNK_GAP = 0.1  # seconds without a CHUNK of the window asked before asking for the missing ones again
+
+# Types of the fields, and the part each takes in the fixed struct of its message (the rest follows it)
+ID, INT, FLAG, STR, BYTES, ADDR, VALUE, ENTRIES, KEYS, NAMES, VALUES, NODES = range(12)
+KINDS = {"id": (ID, "I"), "int": (INT, "H"), "flag": (FLAG, "?"), "str": (STR, "H"), "bytes": (BYTES, "I"), "addr": (ADDR, "HH"),  # host length and port
+         "value": (VALUE, ""), "entries": (ENTRIES, "I"), "keys": (KEYS, "I"), "names": (NAMES, "I"), "values": (VALUES, "I"), "nodes": (NODES, "I")}  # counts
+MIN_SIZES = {ENTRIES: 7, KEYS: 6, NAMES: 2, VALUES: 3, NODES: 8}  # bytes taken at least by each item, to refuse absurd counts early
+
+
+class Layout:
+    """ Binary form of the messages of one method.
+
+    MAGIC, the method code and a bitmap of the optional fields present,
+    then one struct with the fixed part of every field (ints, and the
+    lengths and counts of the others, zeros when a field is left out) and
+    after it the variable parts, in field order.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.code = METHODS.index(method)
+        self.nested = any(len(path) > 1 for path, _, _ in SCHEMAS[method])  # whether the message has an args dict
+        self.fields = []  # (inside args, name, kind, bit if not required, nullable, blank fixed part)
+        formats, bit = [">BBB"], 1
+        for path, kind, presence in SCHEMAS[method]:
+            code, fixed = KINDS[kind]
+            self.fields.append((len(path) > 1, path[-1], code, None if presence == "required" else bit, presence == "nullable", (0,) * len(fixed)))
+            formats.append(fixed)
+            if presence != "required":
+                bit <<= 1
+        assert bit <= 256, f"{method} has more than 8 optional fields"
+        self.struct = struct.Struct("".join(formats))
+
+    def encode(self, msg):
+        args = msg.get("args") if self.nested else None
+        if self.nested and not isinstance(args, dict):
+            raise CodecError(f"{self.method} without args")
+        fixed, tail, present = [MAGIC, self.code, 0], [], 0
+        for inside, name, kind, bit, _, blank in self.fields:
+            source = args if inside else msg
+            if kind == VALUE:
+                found = name in source
+                value = source.get(name)
+            else:
+                value = source.get(name)
+                found = value is not None
+            if not found:
+                if bit is None:
+                    raise CodecError(f"{self.method} without {name}")
+                fixed += blank
+                continue
+            if bit is not None:
+                present |= bit
+            if kind == ID or kind == INT or kind == FLAG:
+                fixed.append(value)
+            elif kind == STR:
+                data = value.encode("utf-8")
+                fixed.append(len(data))
+                tail.append(data)
+            elif kind == ADDR:
+                host, port = value
+                data = host.encode("utf-8")
+                fixed += (len(data), port)
+                tail.append(data)
+            elif kind == VALUE:
+                tail.append(encode_value(value))
+            elif kind == BYTES:
+                fixed.append(len(value))
+                tail.append(bytes(value))
+            else:
+                fixed.append(len(value))
+                tail.append(WRITERS[kind](value))
+        fixed[2] = present
+        tail.insert(0, self.struct.pack(*fixed))
+        return b"".join(tail)
+
+    def decode(self, payload):
+        fixed = self.struct.unpack_from(payload)
+        present, position, offset = fixed[2], 3, self.struct.size
+        msg = {"method": self.method}
+        args = None
+        if self.nested:
+            args = msg["args"] = {}
+        for inside, name, kind, bit, nullable, blank in self.fields:
+            target = args if inside else msg
+            if bit is not None and not present & bit:
+                if nullable:
+                    target[name] = None
+                position += len(blank)
+                continue
+            if kind == ID or kind == INT or kind == FLAG:
+                target[name] = fixed[position]
+                position += 1
+            elif kind == VALUE:
+                target[name], offset = decode_value(payload, offset)
+            elif kind == ADDR:
+                end = offset + fixed[position]
+                target[name] = (text(payload, offset, end), fixed[position + 1])
+                offset = end
+                position += 2
+            else:
+                size = fixed[position]
+                position += 1
+                if kind == STR:
+                    target[name] = text(payload, offset, offset + size)
+                    offset += size
+                elif kind == BYTES:
+                    target[name] = data(payload, offset, offset + size)
+                    offset += size
+                else:
+                    if size * MIN_SIZES[kind] > len(payload) - offset:
+                        raise CodecError(f"{size} items cannot fit in {self.method}")
+                    target[name], offset = READERS[kind](payload, offset, size)
+        if offset != len(payload):
+            raise CodecError(f"Trailing bytes after {self.method}")
+        return msg
+
+
+class BinaryCodec:
+    """ Compact encoding of the fixed message set that decodes to plain data only.
+
+    Each method has its own Layout: required fields must be there, and
+    anything else (a missing or foreign field, a truncated datagram, a
+    value of the wrong type) is a CodecError. Ids are at most ID_BITS
+    wide. Values (keys, stored data, ...) are tagged by type and can be
+    None, bool, int, float, str, bytes, list, tuple and dict.
+    """
+
+    name = "binary"
+    id_bits = ID_BITS
+
+    def __init__(self):
+        self.layouts = [Layout(method) for method in METHODS]
+        self.by_method = {layout.method: layout for layout in self.layouts}
+
+    def encode(self, msg):
+        layout = self.by_method.get(msg.get("method"))
+        if layout is None:
+            raise CodecError(f"Unknown method {msg.get('method')}")
+        try:
+            return layout.encode(msg)
+        except (TypeError, ValueError, AttributeError, struct.error) as error:  # wrong types, ints out of range, unencodable text
+            raise CodecError(f"Cannot encode {layout.method}: {error}") from error
+
+    def decode(self, payload):
+        if len(payload) < 3 or payload[0] != MAGIC or payload[1] >= len(self.layouts):
+            raise CodecError("Not a binary DHT message")
+        layout = self.layouts[payload[1]]
+        try:
+            return layout.decode(payload)
+        except (IndexError, UnicodeDecodeError, struct.error) as error:
+            raise CodecError(f"Truncated or malformed {layout.method}") from error
+
+
+class Chunker:
+    """ Turns messages into datagrams of codec and back, splitting those over CHUNK_BYTES.
+
+    The CHUNKs of a message carry its transfer id, their position and their
+    total; the message is decoded once all of them arrived from the same
+    address. Only the first CHUNK_WINDOW chunks are sent at once: the
+    receiver asks for the next window with a RESEND once it has them all,
+    and for the chunks of its window still missing after CHUNK_GAP seconds
+    (see tick()), so a large message never floods the socket buffers and a
+    lost chunk is sent again by itself. Chunks are only ever sent to the
+    address their transfer went to. A transfer missing chunks after expiry
+    seconds is dropped: the client sends the whole request again when it
+    times out.
+
+    Datagrams are sent with send(payload, address), given by the owner of
+    the socket.
+    """
+
+    def __init__(self, codec, send=None, expiry=10):
+        self.codec = codec
+        self.sendto = send
+        self.expiry = expiry
+        self.clock = time.monotonic
+        self.transfers = itertools.count(1)
+        self.partial = {}  # Dictorary: Key = (address, transfer id), Value = [deadline, chunks received (None if not yet), seqs asked for, clock() to ask again]
+        self.outgoing = {}  # Dictorary: Key = transfer id, Value = [deadline, address, chunks]
+
+    def datagrams(self, msg, address=None):
+        """ Encoded msg: a single datagram unless it is larger than CHUNK_BYTES (then kept to be resent if going to address). """
+        payload = self.codec.encode(msg)
+        if len(payload) <= CHUNK_BYTES:
+            return [payload]
+        total = -(-len(payload) // CHUNK_BYTES)
+        if total > MAX_CHUNKS:
+            raise CodecError(f"{msg['method']} takes {len(payload)} bytes, more than {MAX_CHUNKS} chunks")
+        transfer = next(self.transfers)
+        chunks = [
+            self.codec.encode({"method": "CHUNK", "args": {"id": transfer, "seq": seq, "total": total, "data": payload[seq * CHUNK_BYTES:(seq + 1) * CHUNK_BYTES]}})
+            for seq in range(total)
+        ]
+        if address is not None:
+            self.outgoing[transfer] = [self.clock() + self.expiry, address, chunks]
+        return chunks
+
+    def send(self, msg, address):
+        """ Send msg to address: at once if it fits a datagram, else its first window of chunks (the rest when asked)."""
+        for payload in self.datagrams(msg, address)[:CHUNK_WINDOW]:
+            self.sendto(payload, address)
+
+    def message(self, payload, addr):
+        """ Message in the datagram payload from addr, or None while it waits for the rest of its chunks (or for a RESEND, answered here). """
+        msg = self.codec.decode(payload)
+        if msg.get("method") == "RESEND":
+            self.resend(msg.get("args"))
+            return None
+        if msg.get("method") != "CHUNK":
+            return msg
+        try:
+            transfer, seq, total, data = (msg["args"][name] for name in ("id", "seq", "total", "data"))
+        except (KeyError, TypeError) as error:
+            raise CodecError("Incomplete CHUNK") from error
+        if not (0 < total <= MAX_CHUNKS and 0 <= seq < total) or not isinstance(data, bytes):
+            raise CodecError(f"Invalid CHUNK {seq}/{total}")
+        now = self.clock()
+        self.expire(now)
+        entry = self.partial.get((addr, transfer))
+        if entry is None:  # the sender sent the first window of its own accord
+            entry = self.partial[(addr, transfer)] = [now + self.expiry, [None] * total, set(range(min(total, CHUNK_WINDOW))), 0]
+        if len(entry[1]) != total:
+            del self.partial[(addr, transfer)]
+            raise CodecError(f"CHUNK total changed within transfer {transfer}")
+        entry[1][seq] = data
+        entry[2].discard(seq)
+        entry[3] = now + CHUNK_GAP
+        if None in entry[1]:
+            if not entry[2]:  # the window asked for is complete: ask for the next one
+                entry[2].update([seq for seq, data in enumerate(entry[1]) if data is None][:CHUNK_WINDOW])
+                self.ask(addr, transfer, entry[2])
+            return None
+        del self.partial[(addr, transfer)]
+        return self.codec.decode(b"".join(entry[1]))
+
+    def resend(self, args):
+        """ Send the chunks a RESEND asks for again, to where their transfer went."""
+        try:
+            entry = self.outgoing.get(args["id"])
+            seqs = list(args["seqs"])
+        except (KeyError, TypeError) as error:
+            raise CodecError("Incomplete RESEND") from error
+        if entry is None:  # expired, or never sent from here
+            return
+        for seq in seqs[:CHUNK_WINDOW]:
+            if type(seq) is not int or not 0 <= seq < len(entry[2]):
+                raise CodecError(f"Invalid RESEND of chunk {seq}")
+            self.sendto(entry[2][seq], entry[1])
+
+    def ask(self, addr, transfer, seqs):
+        self.sendto(self.codec.encode({"method": "RESEND", "args": {"id": transfer, "seqs": sorted(seqs)}}), addr)
+
+    def expire(self, now):
+        for key in [key for key, entry in self.partial.items() if entry[0] < now]:
+            del self.partial[key]
+        for key in [key for key, entry in self.outgoing.items() if entry[0] < now]:
+            del self.outgoing[key]
+
+    def tick(self):
+        """ Ask again for the chunks missing after CHUNK_GAP seconds; returns the clock() of the next such check (inf if none)."""
+        now = self.clock()
+        self.expire(now)
+        wake = math.inf
+        for (addr, transfer), entry in self.partial.items():
+            if entry[3] <= now:
+                entry[3] = now + CHUNK_GAP
+                self.ask(addr, transfer, entry[2])
+            wake = min(wake, entry[3])
+        return wake
+
+
+def text(payload, start, end):
+    if end > len(payload):
+        raise IndexError("string past the end of the datagram")
+    return payload[start:end].decode("utf-8")
+
+
+def data(payload, start, end):
+    if end > len(payload):
+        raise IndexError("bytes past the end of the datagram")
+    return bytes(payload[start:end])
+
+
+def texts(payload, offset, sizes):
+    """ Strings of the given sizes, one after the other from offset; returns them and where they end. """
+    ends = list(itertools.accumulate(sizes, initial=offset))
+    region = payload[offset:ends[-1]]
+    if len(region) != ends[-1] - offset:
+        raise IndexError("strings past the end of the datagram")
+    if region.isascii():  # then characters are bytes: decode once and cut
+        whole = region.decode("ascii")
+        return [whole[start - offset:end - offset] for start, end in zip(ends, ends[1:])], ends[-1]
+    return [region[start - offset:end - offset].decode("utf-8") for start, end in zip(ends, ends[1:])], ends[-1]
+
+
+def write_column(values, depth=0):
+    """ Values of many items (or of a container): packed at once when they are all ints or all str, else tagged one by one. """
+    count = len(values)
+    if count < COLUMN_ITEMS:  # not worth a column: the values follow one another, with no tag for the column
+        return b"".join([encode_value(value, depth) for value in values])
+    if all(type(value) is int for value in values):
+        low, high = min(values), max(values)
+        for bounds, width in INT_WIDTHS:
+            if low in bounds and high in bounds:
+                return bytes((INT_TAG, width)) + struct.pack(f">{count}{chr(width)}", *values)
+    if all(type(value) is str for value in values):
+        encoded = [value.encode("utf-8") for value in values]
+        return b"".join([bytes((STR_TAG,)), struct.pack(f">{count}I", *map(len, encoded)), *encoded])
+    return b"".join([ANY_BYTE, *[encode_value(value, depth) for value in values]])
+
+
+def read_column(payload, offset, count, depth=0):
+    tag = ANY
+    if count >= COLUMN_ITEMS:
+        tag = payload[offset]
+        offset += 1
+    if tag == INT_TAG:
+        width = payload[offset]
+        if width not in WIDTH_SIZES:
+            raise CodecError(f"Unknown int width {width}")
+        return list(struct.unpack_from(f">{count}{chr(width)}", payload, offset + 1)), offset + 1 + WIDTH_SIZES[width] * count
+    if tag == STR_TAG:
+        return texts(payload, offset + 4 * count, struct.unpack_from(f">{count}I", payload, offset))
+    if tag != ANY:
+        raise CodecError(f"Unknown column tag {tag}")
+    values = []
+    for _ in range(count):
+        value, offset = decode_value(payload, offset, depth)
+        values.append(value)
+    return values, offset
+
+
+def write_entries(items):
+    """ (key, id, value) items of PUT_MANY: key lengths and ids, keys, then the values. """
+    keys, ids, values = zip(*items) if items else ((), (), ())
+    keys = [key.encode("utf-8") for key in keys]
+    count = len(keys)
+    return b"".join([struct.pack(f">{count}H{count}I", *map(len, keys), *ids), *keys, write_column(values)])
+
+
+def read_entries(payload, offset, count):
+    fixed = struct.unpack_from(f">{count}H{count}I", payload, offset)
+    keys, offset = texts(payload, offset + 6 * count, fixed[:count])
+    values, offset = read_column(payload, offset, count)
+    return list(zip(keys, fixed[count:], values)), offset
+
+
+def write_keys(items):
+    """ (key, id) items of GET_MANY. """
+    keys, ids = zip(*items) if items else ((), ())
+    keys = [key.encode("utf-8") for key in keys]
+    count = len(keys)
+    return b"".join([struct.pack(f">{count}H{count}I", *map(len, keys), *ids), *keys])
+
+
+def read_keys(payload, offset, count):
+    fixed = struct.unpack_from(f">{count}H{count}I", payload, offset)
+    keys, offset = texts(payload, offset + 6 * count, fixed[:count])
+    return list(zip(keys, fixed[count:])), offset
+
+
+def write_names(keys):
+    """ Keys acked by ACK_MANY. """
+    keys = [key.encode("utf-8") for key in keys]
+    return b"".join([struct.pack(f">{len(keys)}H", *map(len, keys)), *keys])
+
+
+def read_names(payload, offset, count):
+    sizes = struct.unpack_from(f">{count}H", payload, offset)
+    return texts(payload, offset + 2 * count, sizes)
+
+
+def write_values(values):
+    """ Key to value dict answered by ACK_MANY. """
+    return write_names(values) + write_column(list(values.values()))
+
+
+def read_values(payload, offset, count):
+    keys, offset = read_names(payload, offset, count)
+    values, offset = read_column(payload, offset, count)
+    return dict(zip(keys, values)), offset
+
+
+def write_nodes(nodes):
+    """ (id, addr) nodes of a successor list. """
+    hosts = [host.encode("utf-8") for _, (host, _) in nodes]
+    count = len(nodes)
+    return b"".join([struct.pack(f">{count}I{count}H{count}H", *[node_id for node_id, _ in nodes], *map(len, hosts), *[port for _, (_, port) in nodes]), *hosts])
+
+
+def read_nodes(payload, offset, count):
+    fixed = struct.unpack_from(f">{count}I{count}H{count}H", payload, offset)
+    hosts, offset = texts(payload, offset + 8 * count, fixed[count:2 * count])
+    return [(node_id, (host, port)) for node_id, host, port in zip(fixed[:count], hosts, fixed[2 * count:])], offset
+
+
+WRITERS = {ENTRIES: write_entries, KEYS: write_keys, NAMES: write_names, VALUES: write_values, NODES: write_nodes}
+READERS = {ENTRIES: read_entries, KEYS: read_keys, NAMES: read_names, VALUES: read_values, NODES: read_nodes}
+
+# Tags of values, one byte each
+NONE, TRUE, FALSE, BYTE, INT_TAG, BIG, FLOAT_TAG, STR_TAG, BYTES_TAG, LIST, TUPLE, DICT = b"NTFciIfsbltd"
+ANY = ord("a")  # column of values of mixed types, each tagged
+ANY_BYTE = bytes((ANY,))
+TAGGED_BYTE = struct.Struct(">Bb")  # ints from -128 to 127, in a byte
+TAGGED_INT = struct.Struct(">Bq")
+TAGGED_FLOAT = struct.Struct(">Bd")
+TAGGED_SIZE = struct.Struct(">BI")  # tag and length (or count) of a str, bytes or container
+TINY = range(-2 ** 7, 2 ** 7)
+SMALL = range(-2 ** 63, 2 ** 63)
+INT_WIDTHS = [(TINY, ord("b")), (range(-2 ** 15, 2 ** 15), ord("h")), (range(-2 ** 31, 2 ** 31), ord("i")), (SMALL, ord("q"))]  # struct formats of int columns
+WIDTH_SIZES = {width: struct.calcsize(chr(width)) for _, width in INT_WIDTHS}
+SINGLE = {None: bytes((NONE,)), True: bytes((TRUE,)), False: bytes((FALSE,))}
+
+
+def encode_value(value, depth=0):
+    """ Tagged value: a type byte and its data. """
+    kind = type(value)
+    if kind is str:
+        data = value.encode("utf-8")
+        return TAGGED_SIZE.pack(STR_TAG, len(data)) + data
+    if kind is int:
+        if value in TINY:
+            return TAGGED_BYTE.pack(BYTE, value)
+        if value in SMALL:
+            return TAGGED_INT.pack(INT_TAG, value)
+        data = value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+        return TAGGED_SIZE.pack(BIG, len(data)) + data
+    if value is None or kind is bool:
+        return SINGLE[value]
+    if kind is float:
+        return TAGGED_FLOAT.pack(FLOAT_TAG, value)
+    if kind is bytes or kind is bytearray:
+        return TAGGED_SIZE.pack(BYTES_TAG, len(value)) + value
+    if depth >= MAX_DEPTH:
+        raise CodecError("Value nested too deep")
+    if kind is list or kind is tuple:
+        return TAGGED_SIZE.pack(LIST if kind is list else TUPLE, len(value)) + write_column(value, depth + 1)
+    if kind is dict:
+        return TAGGED_SIZE.pack(DICT, len(value)) + write_column(list(value), depth + 1) + write_column(list(value.values()), depth + 1)
+    raise CodecError(f"Cannot encode a value of type {kind.__name__}")
+
+
+def decode_value(payload, offset, depth=0):
+    """ Value tagged at offset; returns it and where it ends. """
+    tag = payload[offset]
+    if tag == BYTE:
+        return TAGGED_BYTE.unpack_from(payload, offset)[1], offset + TAGGED_BYTE.size
+    if tag == INT_TAG:
+        return TAGGED_INT.unpack_from(payload, offset)[1], offset + TAGGED_INT.size
+    if tag == STR_TAG:
+        end = offset + TAGGED_SIZE.size + TAGGED_SIZE.unpack_from(payload, offset)[1]
+        if end > len(payload):
+            raise IndexError("string past the end of the datagram")
+        return payload[offset + TAGGED_SIZE.size:end].decode("utf-8"), end
+    if tag == NONE:
+        return None, offset + 1
+    if tag == TRUE or tag == FALSE:
+        return tag == TRUE, offset + 1
+    if tag == FLOAT_TAG:
+        return TAGGED_FLOAT.unpack_from(payload, offset)[1], offset + TAGGED_FLOAT.size
+    if tag == BYTES_TAG or tag == BIG:
+        end = offset + TAGGED_SIZE.size + TAGGED_SIZE.unpack_from(payload, offset)[1]
+        value = data(payload, offset + TAGGED_SIZE.size, end)
+        return (value if tag == BYTES_TAG else int.from_bytes(value, "big", signed=True)), end
+    if tag != LIST and tag != TUPLE and tag != DICT:
+        raise CodecError(f"Unknown value tag {tag}")
+    if depth >= MAX_DEPTH:
+        raise CodecError("Value nested too deep")
+    count = TAGGED_SIZE.unpack_from(payload, offset)[1]
+    offset += TAGGED_SIZE.size
+    if count > len(payload) - offset:  # every item takes a byte at least
+        raise CodecError(f"{count} items cannot fit in the datagram")
+    if tag == DICT:
+        keys, offset = read_column(payload, offset, count, depth + 1)
+        values, offset = read_column(payload, offset, count, depth + 1)
+        try:
+            return dict(zip(keys, values)), offset
+        except TypeError as error:  # e.g. a list as key
+            raise CodecError("Unhashable dict key") from error
+    items, offset = read_column(payload, offset, count, depth + 1)
+    return (items if tag == LIST else tuple(items)), offset
+
+
+# Codecs a ring can use, by name
+CODECS = {codec.name: codec for codec in (PickleCodec(), BinaryCodec())}
@@ -0,0 +1,222 @@
+""" Many DHT nodes on one thread: a single loop drives their timers and datagrams. """
+import heapq
+import itertools
+import logging
+import math
+import random
+import selectors
+import socket
+import time
+from codec import CODECS, Chunker, CodecError
+from utils import RECV_SIZE
+
+
+class SimulatedSocket:
+    """ Stands in for the UDP socket of whoever is at addr on a SimulatedNetwork. """
+
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+
+    def sendto(self, payload, address):
+        self.network.send(self.addr, address, payload)
+        return len(payload)
+
+    def close(self):
+        self.network.receivers.pop(self.addr, None)
+
+
+class SimulatedNetwork:
+    """ Datagrams delivered in process after latency seconds (of simulated time), some lost.
+
+    Each datagram takes between latency / 2 and 3 * latency / 2 and is lost
+    with probability loss, so they can arrive out of order as UDP does.
+    """
+
+    def __init__(self, latency=0.001, loss=0.0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.now = 0.0  # simulated time, in seconds
+        self.queue = []  # heap of (delivery time, sequence, destination, payload, source)
+        self.sequence = itertools.count()
+        self.receivers = {}  # Dictorary: Key = address, Value = node or Endpoint receiving there
+        self.sent = 0
+        self.lost = 0
+        self.logger = logging.getLogger("SimulatedNetwork")
+
+    def clock(self):
+        return self.now
+
+    def socket(self, addr, receiver):
+        self.receivers[addr] = receiver
+        return SimulatedSocket(self, addr)
+
+    def send(self, source, destination, payload):
+        self.sent += 1
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return
+        delay = self.latency * (0.5 + self.random.random())
+        heapq.heappush(self.queue, (self.now + delay, next(self.sequence), destination, payload, source))
+
+    def next_delivery(self):
+        return self.queue[0][0] if self.queue else math.inf
+
+    def deliver(self):
+        """ Advance to the next datagram and hand it over; returns its receiver (None if nobody is there)."""
+        when, _, destination, payload, source = heapq.heappop(self.queue)
+        self.now = max(self.now, when)
+        receiver = self.receivers.get(destination)
+        if receiver is not None:
+            try:
+                receiver.receive(payload, source)
+            except Exception:  # one bad datagram must not stop the whole ring
+                self.logger.exception("%s failed on a datagram from %s", receiver.addr, source)
+        return receiver
+
+
+class Endpoint:
+    """ Client end of a Runtime, collecting the replies to its requests by request id. """
+
+    def __init__(self, addr, codec):
+        self.addr = addr
+        self.chunker = Chunker(codec, self.transmit)
+        self.socket = None
+        self.replies = {}  # Dictorary: Key = req, Value = reply
+        self.requests = itertools.count(1)
+        self.logger = logging.getLogger("Endpoint")
+
+    def transmit(self, payload, address):
+        self.socket.sendto(payload, address)
+
+    def receive(self, payload, addr):
+        try:
+            out = self.chunker.message(payload, addr)
+        except CodecError as error:
+            self.logger.warning("Dropping datagram from %s: %s", addr, error)
+            return
+        if out is not None:
+            self.replies[out.get("req")] = out
+
+
+class Runtime:
+    """ Runs many DHTNodes in one thread instead of a thread each.
+
+    With real sockets, a selector waits for the datagrams of every node at
+    once, until the earliest of their timers; with simulated=True they talk
+    over a SimulatedNetwork instead, in simulated time, so large rings run as
+    fast as the nodes can process their messages. Nodes are added with add()
+    instead of being started as threads, and stopped as threads are, with
+    done = True (or all at once with stop()).
+    """
+
+    def __init__(self, simulated=False, latency=0.001, loss=0.0, seed=None):
+        self.network = SimulatedNetwork(latency, loss, seed) if simulated else None
+        self.clock = self.network.clock if simulated else time.monotonic
+        self.selector = None if simulated else selectors.DefaultSelector()
+        self.nodes = []
+        self.timers = []  # heap of (clock() to wake, sequence, node)
+        self.scheduled = {}  # Dictorary: Key = node, Value = clock() its latest timer is due (older ones in the heap are stale)
+        self.sequence = itertools.count()
+        self.endpoint = None
+        self.logger = logging.getLogger("Runtime")
+
+    def add(self, node, delay=0):
+        """ Host node, starting it after delay seconds (a ring joins one node at a time). """
+        node.clock = node.chunker.clock = self.clock
+        if self.network is not None:
+            node.socket.close()
+            node.socket = self.network.socket(node.addr, node)
+        else:
+            node.socket.bind(node.addr)
+            node.socket.setblocking(False)
+            self.selector.register(node.socket, selectors.EVENT_READ, node)
+        self.nodes.append(node)
+        self.schedule(node, self.clock() + delay)
+
+    def schedule(self, node, when):
+        self.scheduled[node] = when
+        heapq.heappush(self.timers, (when, next(self.sequence), node))
+
+    def wake(self, node):
+        """ Run the due timers of node, or take it through leaving once done. """
+        if node.done and node.leave_deadline is None:
+            node.leave()
+        if node.leave_deadline is not None and not node.leaving():
+            self.remove(node)
+            return
+        self.schedule(node, node.tick())
+
+    def remove(self, node):
+        if self.selector is not None:
+            self.selector.unregister(node.socket)
+        node.close()
+        self.nodes.remove(node)
+        del self.scheduled[node]
+
+    def run(self, seconds=math.inf, until=None):
+        """ Run the nodes for seconds (of the runtime's clock), or until until() is true."""
+        end = self.clock() + seconds
+        while self.nodes and not (until is not None and until()):
+            now = self.clock()
+            while self.timers and self.timers[0][0] <= now:
+                when, _, node = heapq.heappop(self.timers)
+                if self.scheduled.get(node) == when:
+                    self.wake(node)
+            next_timer = self.timers[0][0] if self.timers else math.inf
+            if now >= end or not self.nodes:
+                break
+            if self.network is not None:
+                if self.network.next_delivery() <= min(next_timer, end):
+                    receiver = self.network.deliver()
+                    if receiver in self.scheduled:
+                        self.wake(receiver)
+                else:
+                    self.network.now = min(next_timer, end)
+                continue
+            for key, _ in self.selector.select(max(min(next_timer, end) - now, 0)):
+                self.drain(key.data, key.fileobj)
+
+    def drain(self, receiver, sock):
+        """ Hand every datagram waiting on sock to receiver. """
+        while True:
+            try:
+                payload, addr = sock.recvfrom(RECV_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+            try:
+                receiver.receive(payload, addr)
+            except Exception:  # one bad datagram must not stop the whole ring
+                self.logger.exception("%s failed on a datagram from %s", receiver.addr, addr)
+        if receiver in self.scheduled:
+            self.wake(receiver)
+
+    def stop(self):
+        """ Stop every node: each leaves the ring, handing its keys to its successor, and closes."""
+        for node in list(self.nodes):
+            node.done = True
+            self.schedule(node, self.clock())
+            self.run(until=lambda: node not in self.scheduled)
+
+    def request(self, address, method, args, timeout=2):
+        """ Send a request to the node at address and run the ring until its reply; None if it times out."""
+        if self.endpoint is None:
+            codec = self.nodes[0].chunker.codec if self.nodes else CODECS["pickle"]
+            self.endpoint = Endpoint(("client", 0), codec)
+            self.endpoint.chunker.clock = self.clock
+            if self.network is not None:
+                self.endpoint.socket = self.network.socket(self.endpoint.addr, self.endpoint)
+            else:
+                self.endpoint.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.endpoint.socket.bind(("localhost", 0))
+                self.endpoint.socket.setblocking(False)
+                self.endpoint.addr = self.endpoint.socket.getsockname()
+                self.selector.register(self.endpoint.socket, selectors.EVENT_READ, self.endpoint)
+        req = args["req"] = next(self.endpoint.requests)
+        self.endpoint.chunker.send({"method": method, "args": args}, address)
+        end = self.clock() + timeout
+        while self.nodes and req not in self.endpoint.replies and self.clock() < end:
+            # in steps, to ask again for the chunks of a large reply still missing
+            self.run(min(end, self.endpoint.chunker.tick()) - self.clock(), until=lambda: req in self.endpoint.replies)
+        return self.endpoint.replies.pop(req, None)
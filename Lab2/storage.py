@@ -0,0 +1,209 @@
+""" Where a node keeps its keys: in memory, or in a log on disk. """
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+HEADER = struct.Struct(">4s16s")  # magic and generation of a log file
+RECORD = struct.Struct(">IBII")  # crc32 of the rest, flags, key length, value length
+MAGIC = b"DHT1"
+TOMBSTONE = 1  # flag of a record deleting its key
+COMPACT_KEYS = 1024  # records copied per write while compacting
+COMPACT_BYTES = 1024 * 1024  # garbage left in a log before it is compacted, if it is also more than the live data
+
+
+class MemoryStore(dict):
+    """ The keystore as it always was: a dict, lost when the node stops. """
+
+    def close(self):
+        pass
+
+
+class LogStore(MutableMapping):
+    """ Keystore in an append-only log on disk, read through mmap.
+
+    Every put or delete appends a record (crc32, flags, key and pickled
+    value) and the index keeps, in memory, where the value of each key is.
+    On close the index is saved next to the log, so opening the store again
+    only scans what was appended after it; a torn record at the end (a crash
+    while writing) is cut off. Once the log holds more garbage (overwritten
+    or deleted values) than live data it is compacted. With cache > 0 that
+    many recently used values are also kept decoded in memory.
+    """
+
+    def __init__(self, path, cache=0, sync=False):
+        self.path = path
+        self.sync = sync
+        self.cache = OrderedDict() if cache > 0 else None  # Dictorary: Key = key, Value = value, least recently used first
+        self.cache_size = cache
+        self.index = {}  # Dictorary: Key = key, Value = (offset, length) of its pickled value in the log
+        self.live = 0  # bytes of the records the index points to
+        self.size = 0  # bytes of the log
+        self.generation = None
+        self.file = None
+        self.map = None
+        self.open()
+
+    def open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size
+        self.file = open(self.path, "w+b" if new else "r+b", buffering=0)
+        if new:
+            self.generation = os.urandom(16)
+            self.file.write(HEADER.pack(MAGIC, self.generation))
+            self.size = HEADER.size
+        else:
+            magic, self.generation = HEADER.unpack(self.file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not a DHT log")
+            self.size = os.path.getsize(self.path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.load()
+
+    def load(self):
+        """ Rebuild the index from the saved one and the records appended after it. """
+        start = HEADER.size
+        try:
+            with open(self.path + ".index", "rb") as file:
+                saved = pickle.load(file)
+            if saved["generation"] == self.generation and saved["size"] <= self.size:
+                self.index, self.live, start = saved["index"], saved["live"], saved["size"]
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            pass  # no usable index: scan the whole log
+        offset = start
+        while offset + RECORD.size <= self.size:
+            crc, flags, key_size, value_size = RECORD.unpack_from(self.map, offset)
+            end = offset + RECORD.size + key_size + value_size
+            if end > self.size or zlib.crc32(self.map[offset + 4:end]) != crc:
+                break
+            key = self.map[offset + RECORD.size:offset + RECORD.size + key_size].decode("utf-8")
+            self.forget(key)
+            if not flags & TOMBSTONE:
+                self.index[key] = (end - value_size, value_size)
+                self.live += end - offset
+            offset = end
+        if offset < self.size:  # torn record at the end
+            self.map.close()
+            self.file.truncate(offset)
+            self.size = offset
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def forget(self, key):
+        """ Drop key from the index, counting its record as garbage. """
+        place = self.index.pop(key, None)
+        if place is not None:
+            self.live -= RECORD.size + len(key.encode("utf-8")) + place[1]
+        if self.cache is not None:
+            self.cache.pop(key, None)
+
+    def append(self, records):
+        """ Write (key, pickled value, flags) records; returns where each value landed. """
+        chunks, places, offset = [], [], self.size
+        for key, body, flags in records:
+            data = key.encode("utf-8")
+            rest = RECORD.pack(0, flags, len(data), len(body))[4:] + data + body
+            chunks.append(struct.pack(">I", zlib.crc32(rest)) + rest)
+            offset += 4 + len(rest)
+            places.append((offset - len(body), len(body)))
+        self.file.seek(self.size)
+        self.file.write(b"".join(chunks))
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.size = offset
+        return places
+
+    def store(self, records):
+        """ Append (key, pickled value) records and point the index to them. """
+        records = list(records)
+        for (key, _), place in zip(records, self.append([(key, body, 0) for key, body in records])):
+            self.forget(key)
+            self.index[key] = place
+            self.live += RECORD.size + len(key.encode("utf-8")) + place[1]
+
+    def __setitem__(self, key, value):
+        self.update(((key, value),))
+
+    def update(self, items=(), **kwargs):
+        """ Store many values with a single write. """
+        items = list(items.items() if hasattr(items, "items") else items) + list(kwargs.items())
+        self.store((key, pickle.dumps(value)) for key, value in items)
+        for key, value in items:
+            self.remember(key, value)
+        self.maybe_compact()
+
+    def __getitem__(self, key):
+        if self.cache is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        value = pickle.loads(self.raw(key))
+        self.remember(key, value)
+        return value
+
+    def raw(self, key):
+        """ Pickled value of key, as in the log. """
+        offset, length = self.index[key]
+        if offset + length > len(self.map):  # appended since the log was mapped
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def remember(self, key, value):
+        if self.cache is not None:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def __delitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        self.append([(key, b"", TOMBSTONE)])
+        self.forget(key)
+        self.maybe_compact()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def maybe_compact(self):
+        garbage = self.size - HEADER.size - self.live
+        if garbage > COMPACT_BYTES and garbage > self.live:
+            self.compact()
+
+    def compact(self):
+        """ Rewrite the log with the live records only. """
+        for leftover in (self.path + ".compact", self.path + ".compact.index"):  # of a compaction that crashed
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        compacted = LogStore(self.path + ".compact")
+        keys = list(self.index)
+        for first in range(0, len(keys), COMPACT_KEYS):
+            compacted.store((key, self.raw(key)) for key in keys[first:first + COMPACT_KEYS])
+        compacted.close()
+        self.map.close()
+        self.file.close()
+        os.replace(self.path + ".compact", self.path)
+        os.replace(self.path + ".compact.index", self.path + ".index")
+        self.index, self.live = {}, 0
+        self.open()
+
+    def save_index(self):
+        with open(self.path + ".index.tmp", "wb") as file:
+            pickle.dump({"generation": self.generation, "size": self.size, "live": self.live, "index": self.index}, file)
+        os.replace(self.path + ".index.tmp", self.path + ".index")
+
+    def close(self):
+        if self.file is None:
+            return
+        os.fsync(self.file.fileno())
+        self.save_index()
+        self.map.close()
+        self.file.close()
+        self.file = None
@@ -0,0 +1,32 @@
+"""Helpers shared by the tests that run rings of DHTNode threads."""
+import time
+import pytest
+from DHTNode import DHTNode
+
+
+def wait_for(condition, seconds=15):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return condition()
+
+
+@pytest.fixture()
+def ring():
+    """ start(*ports, **settings) starts a node on each port, joining the first node started; all of them are stopped at the end """
+    nodes = []
+
+    def start(*ports, **settings):
+        started = []
+        for port in ports:
+            node = DHTNode(("localhost", port), nodes[0].addr if nodes else None, timeout=0.5, **settings)
+            node.start()
+            nodes.append(node)
+            started.append(node)
+            time.sleep(0.2)
+        return started
+
+    yield start
+    for node in nodes:  # one at a time, each handing its keys to one still running
+        node.done = True
+        node.join()
@@ -0,0 +1,61 @@
+"""Tests the asyncio client against the running DHT."""
+import asyncio
+from AsyncDHTClient import AsyncDHTClient
+
+
+def run(coroutine):
+    async def with_client():
+        async with AsyncDHTClient(("localhost", 5000)) as client:
+            return await coroutine(client)
+    return asyncio.run(with_client())
+
+
+def test_put_get():
+    async def scenario(client):
+        assert await client.put("aio", {"a": 1})
+        assert await client.get("aio") == {"a": 1}
+        assert await client.get("missing") is None
+
+    run(scenario)
+
+
+def test_gather():
+    async def scenario(client):
+        keys = [f"aio-{i}" for i in range(20)]
+        assert await asyncio.gather(*(client.put(key, key) for key in keys)) == [True] * 20
+        assert await asyncio.gather(*(client.get(key) for key in keys)) == keys
+
+    run(scenario)
+
+
+def test_many():
+    async def scenario(client):
+        items = {f"aio-many-{i}": i for i in range(6)}
+        assert await client.put_many(items)
+        assert await client.get_many(list(items)) == items
+
+    run(scenario)
+
+
+def test_many_retries():
+    async def scenario(client):
+        send, lost = client.send, []
+        client.send = lambda msg: send(msg) if lost else lost.append(msg)
+        assert await client.get_many(["aio", "unknown"], timeout=0.5) == {"aio": {"a": 1}, "unknown": None}
+        assert lost
+
+    run(scenario)
+
+
+def test_timeout():
+    async def scenario():
+        async with AsyncDHTClient(("localhost", 5999), timeout=0.1, retries=1) as client:
+            return await asyncio.gather(client.put("A", 1), client.get("A"))
+
+    assert asyncio.run(scenario()) == [False, None]
+
+    async def many():
+        async with AsyncDHTClient(("localhost", 5999), retries=1) as client:
+            return await client.get_many(["A"], timeout=0.1)
+
+    assert asyncio.run(many()) == {"A": None}
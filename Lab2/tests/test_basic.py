@@ -1,4 +1,5 @@
 """Tests two clients."""
+import socket
 import pytest
 from DHTClient import DHTClient
 
@@ -26,3 +27,62 @@ def test_put_remote(client):
 def test_get_remote(client):
     """ retrieve from DHT (this key is not on the first node -> remote search) """
     assert client.get("2") == "xpto"
+
+
+def test_hops(client):
+    """ replies carry the number of times the request was forwarded """
+    assert client.get("A") == [0, 1, 2]
+    assert client.hops == 0
+    assert client.get("2") == "xpto"
+    assert client.hops >= 1
+
+
+def test_put_get_many(client):
+    """ store and retrieve keys spread over the ring in batches """
+    items = {f"many-{i}": i for i in range(6)}
+    assert client.put_many(items)
+    assert client.get_many(list(items) + ["missing"]) == {**items, "missing": None}
+
+
+def test_many_retries():
+    """ batches lost on the way are sent again, and keys nobody answers come back as None """
+    client = DHTClient(("localhost", 5000), retries=1)
+    send, lost = client.send, []
+    client.send = lambda msg: send(msg) if lost else lost.append(msg)
+    assert client.get_many(["A", "2"], timeout=0.5) == {"A": [0, 1, 2], "2": "xpto"}
+    assert lost
+    client = DHTClient(("localhost", 5999), retries=1)
+    assert client.get_many(["A", "2"], timeout=0.1) == {"A": None, "2": None}
+    assert not client.put_many({"A": 1}, timeout=0.1)
+
+
+def test_pipeline(client):
+    """ many requests in flight, each result matched to its request """
+    operations = [("put", f"pipe-{i}", i) for i in range(6)] + [("get", f"pipe-{i}") for i in range(6)]
+    assert client.pipeline(operations, window=4) == [True] * 6 + list(range(6))
+    assert client.get("missing") is None
+
+
+def test_timeout():
+    """ requests nobody answers are retried and then given up """
+    client = DHTClient(("localhost", 5999), timeout=0.1, retries=1)
+    assert client.pipeline([("put", "A", 1), ("get", "A")]) == [False, None]
+    client.chunker.tick = lambda: 0  # a resend already due: the socket must still block, if briefly
+    assert client.pipeline([("get", "A")]) == [None]
+    assert client.get_many(["A"], timeout=0.1) == {"A": None}
+
+
+def test_large_value(client):
+    """ values larger than a datagram go in chunks, both ways """
+    blob = bytes(range(256)) * 2000  # 500 KiB
+    assert client.put("blob", blob)
+    assert client.get("blob") == blob
+    assert client.get_many(["blob", "A"]) == {"blob": blob, "A": [0, 1, 2]}
+
+
+def test_large_value_small_buffer(client):
+    """ chunks are paced to fit a stock socket buffer (net.core.rmem_max of 208 KiB) """
+    client.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 212992)
+    blob = bytes(range(256)) * 2000
+    for _ in range(5):
+        assert client.get("blob") == blob
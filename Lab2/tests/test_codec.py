@@ -0,0 +1,122 @@
+"""Tests the message codecs."""
+import pickle
+import socket
+import time
+import pytest
+from codec import CHUNK_BYTES, CHUNK_GAP, CHUNK_WINDOW, CODECS, MAGIC, METHODS, Chunker, CodecError
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from bench.codec import MESSAGES
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_round_trip(name):
+    """ every message decodes to what was encoded """
+    codec = CODECS[name]
+    for msg in MESSAGES.values():
+        assert codec.decode(codec.encode(msg)) == msg
+    for method in ("ACK_MANY", "NACK", "PREDECESSOR"):
+        msg = {"method": method, "hops": 1, "req": 3} if method != "PREDECESSOR" else {"method": method}
+        if method == "ACK_MANY":
+            msg["args"] = {"values": {"a": None, "b": -5}}
+        assert codec.decode(codec.encode(msg)) == msg
+
+
+def test_binary_is_smaller():
+    """ binary datagrams are a fraction of the pickled ones """
+    for msg in MESSAGES.values():
+        assert len(CODECS["binary"].encode(msg)) < len(CODECS["pickle"].encode(msg))
+
+
+def test_binary_rejects():
+    """ anything but a well formed binary message is a CodecError """
+    codec = CODECS["binary"]
+    payload = codec.encode(MESSAGES["PUT"])
+    with pytest.raises(CodecError):
+        codec.decode(pickle.dumps(MESSAGES["PUT"]))
+    with pytest.raises(CodecError):
+        codec.decode(payload[:-1])
+    with pytest.raises(CodecError):
+        codec.decode(payload + b"\x00")
+    with pytest.raises(CodecError):  # no fields at all
+        codec.decode(bytes([MAGIC, METHODS.index("PUT"), 0]))
+    with pytest.raises(CodecError):
+        codec.encode({"method": "PUT", "args": {"id": 1, "value": 2}})
+    with pytest.raises(CodecError):
+        codec.encode({"method": "PUT", "args": {"key": 5, "value": 2}})
+    with pytest.raises(CodecError):
+        codec.encode({"method": "SUCCESSOR", "args": {"id": 2 ** 40, "from": ("localhost", 1)}})
+    with pytest.raises(CodecError):
+        codec.encode({"method": "PUT", "args": {"key": "A", "id": 1, "value": object()}})
+    nested = []
+    for _ in range(40):
+        nested = [nested]
+    with pytest.raises(CodecError):
+        codec.encode({"method": "ACK", "args": nested})
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_chunks(name):
+    """ a large message is split in chunks and joined back in any order """
+    sender, receiver = Chunker(CODECS[name]), Chunker(CODECS[name])
+    msg = {"method": "PUT", "args": {"key": "blob", "id": 7, "value": b"x" * (3 * CHUNK_BYTES), "req": 1}}
+    datagrams = sender.datagrams(msg)
+    assert len(datagrams) == 4 and all(len(datagram) < 65507 for datagram in datagrams)
+    assert [receiver.message(datagram, "a") for datagram in datagrams[:0:-1]] == [None] * 3
+    assert receiver.message(datagrams[1], "b") is None  # a chunk from another address is another transfer
+    assert receiver.message(datagrams[0], "a") == msg
+    assert sender.datagrams(MESSAGES["PUT"]) == [CODECS[name].encode(MESSAGES["PUT"])]
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_chunk_window(name):
+    """ chunks go a window at a time, as the receiver asks, and only lost ones are sent again """
+    now = [0.0]
+    sent = {"a": [], "b": []}  # datagrams in flight to each address
+    sender = Chunker(CODECS[name], lambda payload, address: sent[address].append(payload))
+    receiver = Chunker(CODECS[name], lambda payload, address: sent[address].append(payload))
+    sender.clock = receiver.clock = lambda: now[0]
+    msg = {"method": "PUT", "args": {"key": "blob", "id": 7, "value": bytes(range(256)) * 2000, "req": 1}}
+    sender.send(msg, "b")
+    assert len(sent["b"]) == CHUNK_WINDOW
+    sent["b"].pop(2)  # lost
+    received, chunks = None, 0
+    while received is None:
+        if not sent["a"] and not sent["b"]:
+            now[0] += CHUNK_GAP
+            assert receiver.tick() == now[0] + CHUNK_GAP  # asked again for the lost chunk
+        assert len(sent["b"]) <= CHUNK_WINDOW
+        for payload in sent["a"]:
+            assert sender.message(payload, "b") is None
+        sent["a"].clear()
+        delivered, sent["b"] = sent["b"], []
+        for payload in delivered:
+            received, chunks = receiver.message(payload, "a"), chunks + 1
+    assert received == msg and chunks == len(sender.datagrams(msg)) and receiver.tick() == float("inf")
+    with pytest.raises(CodecError):
+        sender.message(CODECS[name].encode({"method": "RESEND", "args": {"id": 1, "seqs": [99]}}), "b")
+
+
+def test_binary_ring():
+    """ a ring speaking the binary codec answers binary clients only """
+    node = DHTNode(("localhost", 4500), timeout=0.5, codec="binary")
+    node.start()
+    try:
+        client = DHTClient(("localhost", 4500), codec="binary")
+        assert client.put("A", {"x": [1, 2.5, None]})
+        assert client.get("A") == {"x": [1, 2.5, None]}
+        assert client.put_many({"b": b"bytes", "c": (1, 2)})
+        assert client.get_many(["b", "c"]) == {"b": b"bytes", "c": (1, 2)}
+
+        other = DHTClient(("localhost", 4500), timeout=0.2, retries=0)
+        assert other.get("A") is None
+
+        junk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        junk.sendto(bytes([MAGIC, METHODS.index("PUT"), 0]), ("localhost", 4500))
+        junk.sendto(CODECS["binary"].encode({"method": "GET", "args": {"key": "A", "from": ("no.such.host.invalid", 1)}}), ("localhost", 4500))
+        junk.close()
+        time.sleep(0.2)
+        assert node.is_alive() and client.get("A") == {"x": [1, 2.5, None]}
+    finally:
+        node.done = True
+        node.join()
@@ -3,6 +3,7 @@ import pytest
 import time
 from DHTClient import DHTClient
 from DHTNode import DHTNode
+from utils import contains, dht_hash
 from unittest.mock import patch, MagicMock
 
 
@@ -61,7 +62,9 @@ def test_put_keystore(node, client):
         (257, ('localhost', 5003))
     ] 
 
-    assert node.keystore == {"10": "Aveiro"}
+    assert node.keystore["10"] == "Aveiro"
+    # with the keys put before it joined that are its own now
+    assert all(contains(260, 581, dht_hash(key)) for key in node.keystore)
 
 
 def test_actual_node_finger_table(node1, node2):
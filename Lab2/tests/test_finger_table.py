@@ -35,3 +35,34 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_find_wraps_around():
+    """ closest preceding finger is measured clockwise from the node, across 0 """
+    f = FingerTable(10, ("localhost", 5000), 4)
+    f.update(1, 11, ("localhost", 5001))
+    f.update(2, 13, ("localhost", 5003))
+    f.update(3, 15, ("localhost", 5005))
+    f.update(4, 3, ("localhost", 5006))
+
+    assert f.find(2) == ("localhost", 5005)
+    assert f.find(5) == ("localhost", 5006)
+    assert f.find(10) == ("localhost", 5001)
+    assert f.find(12) == ("localhost", 5001)
+
+
+def test_find_matches_scan():
+    """ binary search over the sorted ring gives the closest preceding finger of a full scan """
+    import random
+
+    rng = random.Random(7)
+    f = FingerTable(700, ("localhost", 5000))
+    for _ in range(200):
+        index = rng.randint(1, 10)
+        node_id = rng.randrange(1024)
+        f.update(index, node_id, ("localhost", node_id))
+        key = rng.randrange(1024)
+
+        preceding = [(node_id - 700) % 1024 for node_id, _ in f.as_list if 0 < (node_id - 700) % 1024 < (key - 700) % 1024]
+        expected = f.as_list[0][1] if not preceding else ("localhost", (max(preceding) + 700) % 1024)
+        assert f.find(key) == expected
@@ -0,0 +1,60 @@
+"""Tests keys moving between nodes as they join and leave."""
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from bench.routing import converged, ring_ports, start_runtime
+from tests.conftest import wait_for
+from utils import contains, dht_hash, key_hash
+
+
+def test_join_and_leave(ring):
+    """ a node joining takes its keys from its successor, and gives them back when it leaves """
+    first, = ring(4600)
+    client = DHTClient(("localhost", 4600))
+    items = {f"move-{i}": i for i in range(50)}
+    assert client.put_many(items)
+
+    second, = ring(4601)
+    assert wait_for(lambda: first.predecessor_id == second.identification and second.predecessor_id == first.identification)
+    mine = {key for key in items if contains(first.identification, second.identification, dht_hash(key))}
+    assert mine and wait_for(lambda: set(second.keystore) == mine and set(first.keystore) == set(items) - mine)
+    assert client.get_many(list(items)) == items
+
+    second.done = True
+    second.join()
+    assert set(first.keystore) == set(items)
+    assert first.successor_id == first.identification
+
+
+def test_leave_fixes_fingers():
+    """ once a node left, no finger points to it and every key is still found """
+    runtime = start_runtime(ring_ports(4620, 16), timeout=3, simulated=True)
+    runtime.run(seconds=10)
+    start = runtime.clock()
+    while not converged(runtime.nodes) and runtime.clock() - start < 60:
+        runtime.run(seconds=1)
+    keys = [f"leave-{i}" for i in range(100)]
+    for i, key in enumerate(keys):
+        assert runtime.request(runtime.nodes[i % 16].addr, "PUT", {"key": key, "value": i, "id": key_hash(key)})["method"] == "ACK"
+
+    gone = runtime.nodes[3:12:3]
+    for node in gone:
+        node.done = True
+        runtime.schedule(node, runtime.clock())
+        runtime.run(until=lambda: node not in runtime.scheduled)
+        runtime.run(seconds=1)
+    assert not any(addr == node.addr for node in gone for other in runtime.nodes for _, addr in other.finger_table.as_list)
+    for i, key in enumerate(keys):
+        assert runtime.request(runtime.nodes[i % 13].addr, "GET", {"key": key, "id": key_hash(key)})["args"] == i
+    runtime.stop()
+
+
+def test_handoff_overwrites():
+    """ a handed off value replaces an older copy, but not a value put here since """
+    node = DHTNode(("localhost", 4640), timeout=0.5)
+    try:
+        node.keystore["old"] = "stale"
+        node.put("new", "fresh", ("localhost", 4641))
+        node.handoff([("old", dht_hash("old"), "handed"), ("new", dht_hash("new"), "handed")], ("localhost", 4641))
+        assert node.keystore["old"] == "handed" and node.keystore["new"] == "fresh"
+    finally:
+        node.close()
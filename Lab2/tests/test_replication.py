@@ -0,0 +1,50 @@
+"""Tests keys copied to the nodes after their owner."""
+from DHTClient import DHTClient
+from tests.conftest import wait_for
+from utils import contains, dht_hash
+
+
+def test_replicas(ring):
+    """ with replication 2 each key is also on the successor of its owner, which can answer reads """
+    nodes = ring(4700, 4701, 4702, replication=2)
+    by_id = sorted(nodes, key=lambda node: node.identification)
+    assert wait_for(lambda: all(node.successors == [(after.identification, after.addr) for after in by_id[i + 1:] + by_id[:i + 1]][:2]
+                                for i, node in enumerate(by_id)))
+
+    client = DHTClient(("localhost", 4700))
+    items = {f"copy-{i}": i for i in range(30)}
+    assert client.put_many(items)
+    assert client.put("single", "value")
+    items["single"] = "value"
+
+    def owner(key):
+        return next((node for node in by_id if node.identification >= dht_hash(key)), by_id[0])
+
+    def replica(key):
+        return by_id[(by_id.index(owner(key)) + 1) % len(by_id)]
+
+    assert wait_for(lambda: all(key in owner(key).keystore and replica(key).replicas.get(key) == value for key, value in items.items()))
+    assert DHTClient(("localhost", 4700), read="nearest").get_many(list(items)) == items
+    nearest = DHTClient(("localhost", 4701), read="nearest")
+    assert [nearest.get(key) for key in items] == list(items.values())
+
+
+def test_stale_replicas_dropped(ring):
+    """ a node joining in between takes over copies: the node that held them before drops its own """
+    nodes = ring(4760, 4761, 4762, 4763, replication=2)
+    client = DHTClient(("localhost", 4760))
+    items = {f"stale-{i}": i for i in range(60)}
+    assert client.put_many(items)
+    assert wait_for(lambda: sum(len(node.replicas) for node in nodes) == len(items))
+
+    nodes += ring(4764, replication=2)
+
+    def copies_of_predecessor():
+        by_id = sorted(nodes, key=lambda node: node.identification)
+        for i, node in enumerate(by_id):
+            before, last = by_id[i - 2].identification, by_id[i - 1].identification
+            if any(not contains(before, last, dht_hash(key)) for key in node.replicas):
+                return False
+        return sum(len(node.replicas) for node in nodes) == len(items)
+
+    assert wait_for(copies_of_predecessor)
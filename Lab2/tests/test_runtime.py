@@ -0,0 +1,94 @@
+"""Tests many nodes running on one event loop."""
+from bench.routing import converged, ring_ports, start_runtime
+from utils import key_hash
+
+
+def test_simulated_ring():
+    """ a simulated ring of 32 nodes settles, routes requests and stops """
+    runtime = start_runtime(ring_ports(4800, 32, 10, "fnv"), timeout=0.5, bits=10, simulated=True)
+    runtime.run(seconds=5)
+    assert len(runtime.nodes) == 32
+    start = runtime.clock()
+    while not converged(runtime.nodes) and runtime.clock() - start < 60:
+        runtime.run(seconds=1)
+    assert converged(runtime.nodes)
+
+    owner, other = runtime.nodes[3], runtime.nodes[17]
+    out = runtime.request(owner.addr, "PUT", {"key": "A", "value": [0, 1, 2], "id": key_hash("A", 10)})
+    assert out["method"] == "ACK"
+    out = runtime.request(other.addr, "GET", {"key": "A", "id": key_hash("A", 10)})
+    assert out["method"] == "ACK" and out["args"] == [0, 1, 2]
+
+    runtime.stop()
+    assert runtime.nodes == [] and runtime.network.sent > 0
+
+
+def test_loop_over_udp():
+    """ nodes on real sockets share one loop """
+    runtime = start_runtime([4900, 4901, 4902], timeout=0.5)
+    try:
+        runtime.run(seconds=3)
+        out = runtime.request(("localhost", 4902), "PUT", {"key": "B", "value": "xpto", "id": key_hash("B")})
+        assert out["method"] == "ACK"
+        out = runtime.request(("localhost", 4900), "GET", {"key": "B", "id": key_hash("B")})
+        assert out["args"] == "xpto"
+        assert all(node.inside_dht for node in runtime.nodes)
+    finally:
+        runtime.stop()
+    assert runtime.nodes == []
+
+
+def test_simulated_errors_and_chunks():
+    """ a node failing on a datagram does not stop the loop, and lost chunks are asked again in simulated time """
+    runtime = start_runtime(ring_ports(4850, 4, 10, "fnv"), timeout=0.5, bits=10, simulated=True)
+    runtime.run(seconds=5)
+    node = runtime.nodes[1]
+    node.receive = lambda payload, addr: 1 / 0
+    runtime.run(seconds=1)
+    del node.receive
+    start = runtime.clock()
+    while not converged(runtime.nodes) and runtime.clock() - start < 60:
+        runtime.run(seconds=1)
+    assert converged(runtime.nodes)
+
+    send, dropped = runtime.network.send, []
+
+    def lossy(source, destination, payload):
+        if not dropped and b"CHUNK" in payload:
+            dropped.append(payload)  # the first chunk is lost, and only it is sent again
+            return
+        send(source, destination, payload)
+
+    runtime.network.send = lossy
+    blob = bytes(range(256)) * 2000
+    out = runtime.request(node.addr, "PUT", {"key": "blob", "value": blob, "id": key_hash("blob", 10)})
+    assert dropped and out["method"] == "ACK"
+    out = runtime.request(runtime.nodes[2].addr, "GET", {"key": "blob", "id": key_hash("blob", 10)})
+    assert out["args"] == blob
+    runtime.stop()
+
+
+def test_nearest_hops():
+    """ nearest reads take no more hops than owner reads: the replica a request is sent to answers it """
+    runtime = start_runtime(ring_ports(4950, 16, 10, "fnv"), timeout=0.5, bits=10, simulated=True, replication=3)
+    runtime.run(seconds=5)
+    start = runtime.clock()
+    while not converged(runtime.nodes) and runtime.clock() - start < 60:
+        runtime.run(seconds=1)
+    keys = [f"near-{i}" for i in range(40)]
+    for i, key in enumerate(keys):
+        assert runtime.request(runtime.nodes[i % 16].addr, "PUT", {"key": key, "value": i, "id": key_hash(key, 10)})["method"] == "ACK"
+    runtime.run(seconds=3)  # for the copies to be made
+
+    hops = {False: [], True: []}
+    for nearest in hops:
+        for node in runtime.nodes:
+            for i, key in enumerate(keys):
+                args = {"key": key, "id": key_hash(key, 10)}
+                if nearest:
+                    args["nearest"] = True
+                out = runtime.request(node.addr, "GET", args)
+                assert out["args"] == i
+                hops[nearest].append(out["hops"])
+    assert sum(hops[True]) <= sum(hops[False]) and max(hops[True]) <= max(hops[False])
+    runtime.stop()
@@ -0,0 +1,62 @@
+"""Tests the node keystores."""
+import os
+import pytest
+import storage
+from storage import LogStore, MemoryStore
+
+
+@pytest.fixture(params=["memory", "log", "cached"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    return LogStore(str(tmp_path / "node.log"), cache=2 if request.param == "cached" else 0)
+
+
+def test_store(store):
+    """ every store behaves as the dict the nodes used """
+    store["A"] = [0, 1, 2]
+    store.update([("2", "xpto"), ("big", b"x" * 100000)])
+    store["A"] = {"replaced": True}
+    assert store["A"] == {"replaced": True}
+    assert store.get("missing") is None and "2" in store
+    del store["2"]
+    assert "2" not in store and len(store) == 2
+    assert store == {"A": {"replaced": True}, "big": b"x" * 100000}
+    if getattr(store, "cache", None) is not None:
+        assert len(store.cache) == 2  # at most 2 values decoded in memory
+    store.close()
+
+
+def test_warm_start(tmp_path):
+    """ a log opened again has the keys it had, with or without its saved index """
+    path = str(tmp_path / "node.log")
+    store = LogStore(path)
+    store.update((f"key-{i}", i) for i in range(100))
+    del store["key-0"]
+    store.close()
+
+    store = LogStore(path)
+    store["key-1"] = "after the index"
+    assert len(store) == 99 and store["key-99"] == 99
+    os.fsync(store.file.fileno())  # as if the node crashed here: no index for the last put
+
+    crashed = LogStore(path)
+    assert crashed["key-1"] == "after the index" and "key-0" not in crashed
+    crashed.close()
+    os.remove(path + ".index")
+    with open(path, "ab") as file:
+        file.write(b"torn record")
+    assert dict(LogStore(path)) == dict(store.items())
+
+
+def test_compaction(tmp_path, monkeypatch):
+    """ overwritten values are dropped from the log once they outweigh the live ones """
+    monkeypatch.setattr(storage, "COMPACT_BYTES", 10000)
+    path = str(tmp_path / "node.log")
+    store = LogStore(path)
+    for round in range(10):
+        store.update((f"key-{i}", b"%d" % round * 100) for i in range(50))
+    assert os.path.getsize(path) < 3 * 50 * 200
+    assert store["key-7"] == b"9" * 100 and len(store) == 50
+    store.close()
+    assert LogStore(path)["key-49"] == b"9" * 100
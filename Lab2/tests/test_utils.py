@@ -1,6 +1,7 @@
 """Tests two clients."""
 import pytest
-from utils import contains
+import pickle
+from utils import contains, dht_hash, digest_hash, hash_many, item_size, key_hash, split_batch
 
 
 def test_contains():
@@ -17,3 +18,31 @@ def test_contains():
     assert contains(800, 300, 300)
     assert not contains(800, 300, 700)
     assert not contains(800, 300, 400)
+
+
+def test_dht_hash():
+    assert dht_hash("d") == 115
+    assert dht_hash("f") == 921
+    assert dht_hash("('localhost', 5000)") == 770
+    # wider key spaces extend the same hash
+    assert dht_hash("d", maximum=2 ** 64) % 1024 == 115
+
+
+def test_identifier_width():
+    for bits in (10, 32, 160):
+        ids = [key_hash(str(i), bits, "blake2b") for i in range(100)]
+        assert all(0 <= i < 2 ** bits for i in ids)
+        assert ids == hash_many([str(i) for i in range(100)], bits, "blake2b")
+        assert hash_many(["a", "b"], bits) == [key_hash("a", bits), key_hash("b", bits)]
+
+    assert digest_hash("chord", 32) == digest_hash(b"chord", 32)
+    assert len(set(hash_many([str(i) for i in range(2000)], 64, "blake2b"))) == 2000
+
+
+def test_split_batch():
+    items = [("key", 7, "value"), ("chave", 8, "canção" * 10), ("b", 9, b"\x00" * 100), ("n", 10, [None, 1.5, True, {"a": 2 ** 70}])]
+    for item in items:
+        assert item_size(item) >= len(pickle.dumps(item))
+    batches = list(split_batch([("key", i, "x" * 100) for i in range(100)], limit=1000))
+    assert sum(batches, []) == [("key", i, "x" * 100) for i in range(100)]
+    assert all(sum(map(item_size, batch)) <= 1000 for batch in batches)
@@ -1,14 +1,90 @@
-def dht_hash(text, seed=0, maximum=2 ** 10):
+import hashlib
+import pickle
+
+M_BITS = 10  # default width of the identifier space: ids are in [0, 2 ** M_BITS)
+RECV_SIZE = 65535  # largest UDP datagram
+RECV_BUFFER = 4 * 1024 * 1024  # socket receive buffer asked for, to hold the chunks of large values (the kernel may cap it)
+BATCH_BYTES = 32 * 1024  # encoded items per PUT_MANY/GET_MANY datagram, leaving room for the rest of the message
+ITEM_OVERHEAD = 16  # bytes an encoded value takes beyond its contents, at most for the usual types
+
+
+def dht_hash(text, seed=0, maximum=2 ** M_BITS):
     """ FNV-1a Hash Function. """
     fnv_prime = 16777619
     offset_basis = 2166136261
     h = offset_basis + seed
+    if maximum & (maximum - 1) == 0:  # for a power of two only the low bits matter, so keep h small
+        mask = maximum - 1
+        h &= mask
+        for char in text:
+            h = ((h ^ ord(char)) * fnv_prime) & mask
+        return h
     for char in text:
         h = h ^ ord(char)
         h = h * fnv_prime
     return h % maximum
 
 
+def digest_hash(key, bits=M_BITS):
+    """ BLAKE2b of the UTF-8 bytes of key (or of key itself, if bytes), cut to bits. """
+    data = key.encode("utf-8") if isinstance(key, str) else key
+    digest = hashlib.blake2b(data, digest_size=min(64, (bits + 7) // 8)).digest()
+    return int.from_bytes(digest, "big") % 2 ** bits
+
+
+def fnv_hash(key, bits=M_BITS):
+    return dht_hash(key, maximum=2 ** bits)
+
+
+# Hash functions a ring can be built with, by name
+HASHES = {"fnv": fnv_hash, "blake2b": digest_hash}
+
+
+def key_hash(key, bits=M_BITS, algorithm="fnv"):
+    """ Identifier of key in a ring of 2 ** bits ids. """
+    return HASHES[algorithm](key, bits)
+
+
+def hash_many(keys, bits=M_BITS, algorithm="fnv"):
+    """ Identifiers of many keys at once, for bulk loads. """
+    if algorithm == "blake2b":
+        size = min(64, (bits + 7) // 8)
+        modulus = 2 ** bits
+        blake2b, from_bytes = hashlib.blake2b, int.from_bytes
+        return [from_bytes(blake2b(key.encode("utf-8") if isinstance(key, str) else key, digest_size=size).digest(), "big") % modulus for key in keys]
+    function = HASHES[algorithm]
+    return [function(key, bits) for key in keys]
+
+
+def item_size(value):
+    """ Bound on the bytes value takes once encoded, without encoding it: the length of text and bytes, summed over containers."""
+    if isinstance(value, str):
+        return (len(value) if value.isascii() else 4 * len(value)) + ITEM_OVERHEAD  # UTF-8 takes up to 4 bytes a character
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) + ITEM_OVERHEAD
+    if isinstance(value, (list, tuple)):
+        return sum(map(item_size, value)) + ITEM_OVERHEAD
+    if isinstance(value, dict):
+        return sum(item_size(key) + item_size(item) for key, item in value.items()) + ITEM_OVERHEAD
+    if value is None or isinstance(value, (bool, float)) or isinstance(value, int) and value.bit_length() < 64:
+        return ITEM_OVERHEAD
+    return len(pickle.dumps(value))  # anything else, measured the slow way
+
+
+def split_batch(items, limit=BATCH_BYTES):
+    """ Split items into lists whose encodings take about limit bytes at most (by item_size). """
+    batch, size = [], 0
+    for item in items:
+        size_of = item_size(item)
+        if batch and size + size_of > limit:
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += size_of
+    if batch:
+        yield batch
+
+
 def contains(begin, end, node):
     """Check node is contained between begin and end in a ring."""
     if begin < end: